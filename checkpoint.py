@@ -0,0 +1,218 @@
+"""Checkpoints of extraction runs, so a crashed or killed run resumes where it
+stopped instead of at params.START.
+
+Every params.CHECKPOINT_INTERVAL frames the serial pipeline hands a copy of
+the current magnetogram to the checkpoint. As soon as the inserter reports
+the features of that frame as inserted, the checkpoint file is replaced by a
+compressed .npz file holding the date_obs, time, FITS header and data of the
+frame. On restart this magnetogram is the previous frame of the first
+missing one, so it is neither downloaded nor decoded again. With tracking,
+the active tracks of the frame are stored as well (Tracker.state).
+
+Frames whose features the property database already holds are skipped
+(stored_times and plan), only the runs of missing frames are processed,
+each together with the frame before it. Frames without features are not in
+the database: frames up to the checkpoint frame are skipped by their time,
+the checkpoint file keeps the date_obs of the inserted frames after it
+("processed", e.g. of a batch inserted before the one of the checkpoint
+frame), so they are skipped as well.
+"""
+from __future__ import print_function
+
+import bisect
+import os
+import tempfile
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+import astropy.io.fits as fits
+import iso8601
+import numpy as np
+import requests
+
+from hmi_magnetogram import HMIMagnetogram
+import params
+
+
+def parse_time(value):
+    """Naive UTC datetime of an ISO 8601 string (or datetime)."""
+    if not isinstance(value, datetime):
+        value = iso8601.parse_date(value)
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return value
+
+
+class Checkpoint:
+    """Usage:
+      checkpoint = Checkpoint(path)
+      frame, mag = checkpoint.load()  # (None, None) without checkpoint
+      inserter = RegionInserter(client, on_inserted=checkpoint.inserted)
+      if checkpoint.tracks is not None:
+          tracker.restore(checkpoint.tracks)
+      results = pipeline.extract_serial(metadata, tracker, checkpoint,
+                                        first_mag=mag)
+    """
+
+    def __init__(self, path, interval=None):
+        self.path = path
+        if interval is None:
+            interval = params.CHECKPOINT_INTERVAL
+        self.interval = max(1, interval)
+        self.frame = None
+        # Tracker.state() of the checkpoint frame, None without tracking
+        self.tracks = None
+        self._offered = 0
+        # (date_obs, (time, header, data), tracks) of the frames waiting for
+        # their insertion, in the order they were offered
+        self._pending = []
+        # date_obs of the inserted frames after 'frame', also those without
+        # features, the frames up to 'frame' are done by their time
+        self.processed = set()
+        self._lock = threading.Lock()
+
+    def offer(self, meta, mag=None, tracker=None):
+        """Called for every processed frame, keeps a copy of every
+        interval-th one until its features are inserted. Without 'mag' only
+        the date_obs is stored (the parallel path). 'tracker' is the
+        tracking.Tracker, after the update of this frame.
+        """
+        self._offered += 1
+        if (self._offered - 1) % self.interval:
+            return
+        state = None
+        if mag is not None:
+            state = (mag.time, mag.header.tostring(), np.array(mag.data))
+        tracks = None if tracker is None else tracker.state()
+        with self._lock:
+            self._pending.append((meta["date_obs"], state, tracks))
+            # bounds the memory if the inserter falls behind
+            del self._pending[:-2]
+
+    def inserted(self, frames):
+        """Inserter callback: 'frames' (date_obs) were inserted."""
+        frames = set(frames)
+        with self._lock:
+            self.processed.update(frames)
+            done = [k for k, pending in enumerate(self._pending)
+                    if pending[0] in frames]
+            if not done:
+                return
+            frame, state, tracks = self._pending[done[-1]]
+            del self._pending[:done[-1] + 1]
+            self._prune(frame)
+            processed = sorted(self.processed)
+        try:
+            self._write(frame, state, processed, tracks)
+        except Exception:
+            print("Error while writing the checkpoint:\n%s" %
+                  traceback.format_exc())
+
+    def _prune(self, frame):
+        """Drops the processed frames up to the checkpoint frame 'frame'."""
+        done_until = parse_time(frame)
+        self.processed = set(i for i in self.processed
+                             if parse_time(i) > done_until)
+
+    def _write(self, frame, state, processed, tracks=None):
+        arrays = {"frame": np.array(frame),
+                  "processed": np.array(processed, "U")}
+        if tracks is not None:
+            arrays["tracks"] = np.array(tracks)
+        if state is not None:
+            time, header, data = state
+            arrays.update(time=np.array(time.isoformat()),
+                          header=np.array(header), data=data)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, **arrays)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self.frame = frame
+        self.tracks = tracks
+
+    def load(self):
+        """Returns the date_obs and the magnetogram (None if it was not
+        stored) of the checkpoint, (None, None) if there is none. Sets
+        processed, see plan(): the frames up to the date_obs are done as
+        well, and tracks.
+        """
+        if not os.path.exists(self.path):
+            return None, None
+        with np.load(self.path) as checkpoint:
+            self.frame = str(checkpoint["frame"])
+            if "processed" in checkpoint.files:
+                self.processed.update(checkpoint["processed"].tolist())
+                self._prune(self.frame)
+            if "tracks" in checkpoint.files:
+                self.tracks = str(checkpoint["tracks"])
+            if "data" not in checkpoint.files:
+                return self.frame, None
+            header = fits.Header.fromstring(str(checkpoint["header"]))
+            mag = HMIMagnetogram.from_array(checkpoint["data"], header)
+        return self.frame, mag
+
+
+def stored_times(url, provenance, start, end):
+    """Returns the sorted times of the features of 'provenance' which the
+    property service at 'url' holds between 'start' and 'end', None if the
+    service could not be queried.
+    """
+    try:
+        answer = requests.get(
+            url + params.CHECKPOINT_QUERY % provenance,
+            params={"time_start": "between(%s,%s)" % (
+                start.isoformat() + "Z", end.isoformat() + "Z"),
+                "fields": "time_start"},
+            timeout=params.DOWNLOAD_TIMEOUT)
+        answer.raise_for_status()
+        regions = answer.json()
+        if isinstance(regions, dict):
+            regions = regions.get("data", [])
+        return sorted(set(parse_time(region["time_start"])
+                          for region in regions))
+    except Exception:
+        print("Warning: stored frames could not be queried:\n%s" %
+              traceback.format_exc())
+        return None
+
+
+def _is_stored(time, stored, tolerance):
+    # date_obs and the time of the features (T_REC) differ slightly
+    k = bisect.bisect_left(stored, time - tolerance)
+    return k < len(stored) and stored[k] <= time + tolerance
+
+
+def plan(metadata, stored=(), done_until=None, tolerance=None,
+         processed=()):
+    """Splits 'metadata' into runs of frames which still have to be
+    processed, every run starts with the frame before its first missing
+    frame. Frames are done if their time is in 'stored' (sorted datetimes),
+    not after the date_obs 'done_until' or their date_obs is in 'processed'
+    (Checkpoint.processed). 'tolerance' (seconds, default:
+    params.CHECKPOINT_TIME_TOLERANCE) applies to 'stored'.
+    """
+    if tolerance is None:
+        tolerance = params.CHECKPOINT_TIME_TOLERANCE
+    tolerance = timedelta(seconds=tolerance)
+    stored = list(stored or ())
+    done_until = None if done_until is None else parse_time(done_until)
+    runs = []
+    for k in range(1, len(metadata)):
+        time = parse_time(metadata[k]["date_obs"])
+        if (done_until is not None and time <= done_until) or \
+                metadata[k]["date_obs"] in processed or \
+                _is_stored(time, stored, tolerance):
+            continue
+        if runs and runs[-1][-1] is metadata[k - 1]:
+            runs[-1].append(metadata[k])
+        else:
+            runs.append([metadata[k - 1], metadata[k]])
+    return runs
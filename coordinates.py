@@ -0,0 +1,193 @@
+"""Vectorized coordinate transformations for rectangular windows of a
+magnetogram. Feature characterization only needs the coordinates inside the
+bounding boxes of the features, so instead of converting the whole frame
+with sunpy, helioprojective, heliocentric and heliographic (Stonyhurst)
+coordinates are computed on demand for the requested windows only.
+
+The transformations follow sunpy.wcs (convert_pixel_to_data, convert_hpc_hcc,
+convert_hcc_hg with b0 = l0 = 0), but are rearranged to avoid catastrophic
+cancellation, so the maps can be evaluated in float32. The trigonometry is
+separable into rows and columns and done in float64 on 1-d arrays, only the
+distance to the limb is evaluated in float64 on the window. Compared to the
+float64 sunpy path the results agree within (4096x4096 HMI geometry):
+  helioprojective coordinates: 1e-4 arcsec
+  heliocentric coordinates: 1e-6 solar radii
+  heliographic longitude/latitude: 5e-5 degrees
+  cosine map: 1e-6
+Off-disk pixels are NaN, like in sunpy.
+"""
+import numpy as np
+
+RSUN_METERS = 695508000.0  # sunpy.sun.constants.radius
+ARCSEC = np.pi / (180 * 3600)  # radians
+
+
+class CoordinateProvider:
+    """Coordinate maps of a magnetogram, computed per window.
+
+    The parameters are the same as for sunpy.wcs.convert_pixel_to_data and
+    convert_hpc_hcc: 'scale' (arcsec/pixel), 'reference_pixel' (counted
+    from 1), 'reference_coordinate' (arcsec) are (x, y) pairs, x runs along
+    the columns of the image.
+
+    Usage:
+      provider = CoordinateProvider(shape, scale, crpix, crval, dsun)
+      longitude, latitude = provider.heliographic(x, y, width, height)
+    """
+
+    def __init__(self, shape, scale, reference_pixel, reference_coordinate,
+                 dsun_meters, dtype=np.float32):
+        self.shape = shape
+        self.scale = scale
+        self.reference_pixel = reference_pixel
+        self.reference_coordinate = reference_coordinate
+        self.dsun_meters = dsun_meters
+        self.dtype = dtype
+        self._z_range = None
+
+    def _angles(self, start, stop, axis):
+        """Helioprojective angles in radians of the pixels start..stop-1."""
+        pixels = np.arange(start, stop, dtype=np.float64)
+        return ((pixels - (self.reference_pixel[axis] - 1)) *
+                self.scale[axis] + self.reference_coordinate[axis]) * ARCSEC
+
+    def helioprojective(self, x, y, width, height):
+        """Returns the helioprojective x and y maps (arcsec) of the window."""
+        hpc_x = (self._angles(x, x + width, 0) / ARCSEC).astype(self.dtype)
+        hpc_y = (self._angles(y, y + height, 1) / ARCSEC).astype(self.dtype)
+        return (np.broadcast_to(hpc_x, (height, width)).copy(),
+                np.broadcast_to(hpc_y[:, None], (height, width)).copy())
+
+    def _heliocentric(self, hpc_x, hpc_y, dtype):
+        """Heliocentric x, y, z in solar radii for helioprojective angles in
+        radians, hpc_x and hpc_y have to be broadcastable.
+        """
+        d = self.dsun_meters / RSUN_METERS
+        sinx = np.sin(hpc_x).astype(dtype)
+        cosx = np.cos(hpc_x).astype(dtype)
+        siny = np.sin(hpc_y).astype(dtype)
+        cosy = np.cos(hpc_y).astype(dtype)
+
+        cos_rho = cosy * cosx
+        # sin^2 of the angle to the sun center, without subtracting from 1
+        sin2_rho = sinx * sinx + cosx * cosx * (siny * siny)
+        # 1 - d^2 * sin2_rho cancels at the limb, so it is evaluated in
+        # float64 from the separable terms (1 - d^2 sin^2 y) and
+        # d^2 cos^2 y sin^2 x
+        sin2y = np.sin(hpc_y) ** 2
+        with np.errstate(invalid="ignore"):
+            root = np.sqrt((1 - d * d * sin2y) -
+                           (d * d * (1 - sin2y)) * np.sin(hpc_x) ** 2)
+        root = root.astype(dtype)
+        distance = dtype(d) * cos_rho - root
+
+        rx = distance * (cosy * sinx)
+        ry = distance * siny
+        # = d - distance * cos_rho
+        rz = dtype(d) * sin2_rho + root * cos_rho
+        return rx, ry, rz
+
+    def _window_heliocentric(self, x, y, width, height):
+        return self._heliocentric(self._angles(x, x + width, 0)[None, :],
+                                  self._angles(y, y + height, 1)[:, None],
+                                  self.dtype)
+
+    def _pixel_heliocentric(self, cols, rows):
+        return self._heliocentric(self._angles(0, self.shape[1], 0)[cols],
+                                  self._angles(0, self.shape[0], 1)[rows],
+                                  self.dtype)
+
+    def heliocentric(self, x, y, width, height):
+        """Returns the heliocentric x, y and z maps (meters) of the window."""
+        return tuple(c * self.dtype(RSUN_METERS)
+                     for c in self._window_heliocentric(x, y, width, height))
+
+    def heliographic(self, x, y, width, height):
+        """Returns the Stonyhurst longitude and latitude maps (degrees) of
+        the window.
+        """
+        return self._heliographic(*self._window_heliocentric(x, y, width,
+                                                             height))
+
+    @staticmethod
+    def _heliographic(rx, ry, rz):
+        # arcsin(y / r) of sunpy, arctan2 is better conditioned at the poles
+        return (np.rad2deg(np.arctan2(rx, rz)),
+                np.rad2deg(np.arctan2(ry, np.sqrt(rx * rx + rz * rz))))
+
+    def cosine(self, x, y, width, height):
+        """Returns the cosine map of the window: heliocentric z normalized to
+        0..1 by the minimum and maximum over all on-disk pixels of the
+        frame, like cv2.normalize(z, None, 0, 1, cv2.NORM_MINMAX).
+        """
+        return self._normalize(self._window_heliocentric(x, y, width,
+                                                         height)[2])
+
+    def _normalize(self, rz):
+        z_min, z_max = self.z_range()
+        return (rz - self.dtype(z_min)) * self.dtype(1.0 / (z_max - z_min))
+
+    def pixels(self, cols, rows):
+        """Returns the Stonyhurst longitude, latitude and the cosine map
+        values of the pixels at the index arrays 'cols' and 'rows'. The
+        values are equal to the ones of windows containing the pixels.
+        """
+        rx, ry, rz = self._pixel_heliocentric(cols, rows)
+        longitude, latitude = self._heliographic(rx, ry, rz)
+        return longitude, latitude, self._normalize(rz)
+
+    def z_range(self):
+        """Minimum and maximum heliocentric z (solar radii) of the frame.
+        Only the pixels closest to the limb of every row and the pixels
+        around the disk center are evaluated, since z decreases
+        monotonically with the distance to the disk center.
+        """
+        if self._z_range is None:
+            rows, cols = self._limb_pixels()
+            center_row = self._nearest_pixels(1)
+            center_col = self._nearest_pixels(0)
+            rows = np.concatenate([rows, np.repeat(center_row,
+                                                   len(center_col))])
+            cols = np.concatenate([cols, np.tile(center_col,
+                                                 len(center_row))])
+            rz = self._heliocentric(self._angles(0, self.shape[1], 0)[cols],
+                                    self._angles(0, self.shape[0], 1)[rows],
+                                    np.float64)[2]
+            self._z_range = (np.nanmin(rz), np.nanmax(rz))
+        return self._z_range
+
+    def _nearest_pixels(self, axis, margin=2):
+        """Pixel indices around the disk center along 'axis'."""
+        center = (self.reference_pixel[axis] - 1 -
+                  self.reference_coordinate[axis] / self.scale[axis])
+        size = self.shape[1 - axis]
+        start = max(0, int(np.floor(center)) - margin)
+        stop = min(size, int(np.ceil(center)) + margin + 1)
+        return np.arange(start, stop)
+
+    def _limb_pixels(self, margin=2):
+        """Row and column indices of the outermost on-disk pixels of every
+        row (plus 'margin' pixels on both sides).
+        """
+        d = self.dsun_meters / RSUN_METERS
+        height, width = self.shape[0], self.shape[1]
+        siny = np.sin(self._angles(0, height, 1))
+        # sin^2(x) * cos^2(y) + sin^2(y) <= 1 / d^2 on the disk
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sinx2 = (1.0 / (d * d) - siny * siny) / (1 - siny * siny)
+        on_disk = np.nonzero(sinx2 >= 0)[0]
+        x_limit = np.arcsin(np.sqrt(sinx2[on_disk])) / ARCSEC
+
+        rows = []
+        cols = []
+        offsets = np.arange(-margin, margin + 2)
+        for sign in (-1, 1):
+            col = ((sign * x_limit - self.reference_coordinate[0]) /
+                   self.scale[0] + self.reference_pixel[0] - 1)
+            col = np.floor(col)[:, None] + offsets
+            rows.append(np.repeat(on_disk, len(offsets)))
+            cols.append(col.ravel())
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        valid = (cols >= 0) & (cols < width)
+        return rows[valid], cols[valid].astype(np.intp)
@@ -0,0 +1,280 @@
+"""Export of the per-feature arrays (the cutouts of the magnetogram, mask, flux
+map, polarity separation lines, ...) to chunked, compressed HDF5 files, e.g.
+as training data. Requires h5py.
+
+Every process appends to its own file in params.CUTOUT_STORE_DIR, the
+features of params.CUTOUT_BATCH_FRAMES frames at a time. In a file, every
+array (params.CUTOUT_ARRAYS) is one flat dataset, the cutouts of all
+features are concatenated; the datasets "time" (datetime64[us] as int64),
+"index", "x", "y", "width", "height" and "offset" (start of the cutout in
+the flat datasets) index the features. The datasets are chunked
+(params.CUTOUT_CHUNK elements) and gzip compressed, reading one cutout only
+reads the chunks it covers.
+
+The arrays are those of SMARTFeature (smart_feature.ARRAYS, the masked
+arrays filled with zero) and "data", the magnetogram inside of the bounding
+box of the feature. The features have to keep the arrays: the pipeline
+characterizes them with keep_arrays=writer.feature_arrays, so the arrays
+are built once, in the batch characterization.
+
+Usage:
+  cutout_store.get().write(features, mag_t1)  # pipeline
+  store = CutoutStore("/data/smart-cutouts")
+  store.read(time, index, "phi_map")
+"""
+import glob
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+
+import params
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+# index datasets and their types
+_INDEX = (("time", np.int64), ("index", np.int32), ("x", np.int32),
+          ("y", np.int32), ("width", np.int32), ("height", np.int32),
+          ("offset", np.int64))
+_DTYPES = {"data": np.float32, "mask": np.uint8, "cos_map": np.float32,
+           "abs_data": np.float32, "hg_longitude_map": np.float32,
+           "hg_latitude_map": np.float32, "area_map": np.float32,
+           "phi_map": np.float32, "phi_delta": np.float32,
+           "psl_mask": np.uint8, "psl_thin_mask": np.uint8}
+
+
+def _time(value):
+    """datetime (naive UTC or aware) as microseconds since the epoch."""
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    return np.datetime64(value, "us").astype(np.int64)
+
+
+def cutouts(features, hmi_magnetogram, names=None):
+    """Returns a dict name -> array for every feature of 'hmi_magnetogram',
+    the features have to keep the arrays (except "data"). 'names' default
+    to params.CUTOUT_ARRAYS.
+    """
+    if names is None:
+        names = params.CUTOUT_ARRAYS
+    result = []
+    for feature in features:
+        x, y, w, h = feature.get_shape()
+        arrays = {}
+        for name in names:
+            if name == "data":
+                value = hmi_magnetogram.data[y:y + h, x:x + w]
+            elif feature.has_array(name):
+                value = getattr(feature, name)
+            else:
+                raise ValueError(
+                    "%s of feature %s is not kept, characterize the features "
+                    "with keep_arrays=CutoutWriter.feature_arrays" %
+                    (name, feature.index))
+            arrays[name] = np.ma.filled(value, 0).astype(_DTYPES[name])
+        result.append(arrays)
+    return result
+
+
+class CutoutWriter:
+    """Appends the cutouts of the features of every 'batch_frames' frames
+    to the HDF5 file 'path'.
+    """
+
+    def __init__(self, path, names=None, batch_frames=None, chunk=None):
+        if h5py is None:
+            raise RuntimeError("the cutout store requires h5py")
+        if names is None:
+            names = params.CUTOUT_ARRAYS
+        if batch_frames is None:
+            batch_frames = params.CUTOUT_BATCH_FRAMES
+        if chunk is None:
+            chunk = params.CUTOUT_CHUNK
+        for name in names:
+            if name not in _DTYPES:
+                raise ValueError("unknown cutout array: %s" % name)
+        self.path = path
+        self.names = tuple(names)
+        # the arrays the features have to keep
+        self.feature_arrays = tuple(name for name in self.names
+                                    if name != "data")
+        self.batch_frames = batch_frames
+        self.written_features = 0
+        self._frames = 0
+        self._rows = []
+        self._arrays = []
+        self._file = h5py.File(path, "a")
+        for name, dtype in _INDEX:
+            self._dataset(name, dtype, min(chunk, 4096))
+        for name in self.names:
+            self._dataset(name, _DTYPES[name], chunk)
+        self._file.attrs["arrays"] = ",".join(self.names)
+
+    def _dataset(self, name, dtype, chunk):
+        if name not in self._file:
+            self._file.create_dataset(name, (0,), dtype, maxshape=(None,),
+                                      chunks=(chunk,), compression="gzip",
+                                      shuffle=True)
+
+    def write(self, features, hmi_magnetogram):
+        """Adds the cutouts of the features (SMARTFeature instances keeping
+        feature_arrays) of 'hmi_magnetogram', see cutouts().
+        """
+        time = _time(hmi_magnetogram.time)
+        for feature, arrays in zip(features, cutouts(
+                features, hmi_magnetogram, self.names)):
+            x, y, w, h = feature.get_shape()
+            self._rows.append((time, feature.index, x, y, w, h))
+            self._arrays.append(arrays)
+        self._frames += 1
+        if self._frames >= self.batch_frames:
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered cutouts and flushes the file."""
+        if self._rows:
+            start = self._file["offset"].shape[0]
+            end = start + len(self._rows)
+            base = 0
+            if start > 0:
+                last = self._file["offset"][start - 1]
+                base = last + self._file["width"][start - 1] * \
+                    self._file["height"][start - 1]
+            sizes = np.array([w * h for _, _, _, _, w, h in self._rows],
+                             np.int64)
+            offsets = base + np.concatenate([[0], np.cumsum(sizes)[:-1]])
+            columns = list(zip(*self._rows)) + [offsets]
+            for (name, dtype), values in zip(_INDEX, columns):
+                dataset = self._file[name]
+                dataset.resize((end,))
+                dataset[start:end] = np.asarray(values, dtype)
+            for name in self.names:
+                values = np.concatenate([arrays[name].ravel()
+                                         for arrays in self._arrays])
+                dataset = self._file[name]
+                dataset.resize((base + len(values),))
+                dataset[base:] = values
+            self.written_features += len(self._rows)
+            self._rows = []
+            self._arrays = []
+        self._frames = 0
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CutoutStore:
+    """Reads single cutouts from the HDF5 files of a directory (or a list of
+    files). 'index' holds the index datasets of all files and "file", the
+    number of the file of every feature.
+    """
+
+    def __init__(self, paths):
+        if h5py is None:
+            raise RuntimeError("the cutout store requires h5py")
+        if isinstance(paths, str):
+            paths = sorted(glob.glob(os.path.join(paths, "cutouts_*.h5")))
+        self._files = [h5py.File(path, "r") for path in paths]
+        columns = dict((name, []) for name, _ in _INDEX)
+        columns["file"] = []
+        for k, f in enumerate(self._files):
+            for name, _ in _INDEX:
+                columns[name].append(f[name][:])
+            columns["file"].append(np.full(f["offset"].shape[0], k,
+                                           np.int32))
+        self.index = {}
+        for name, dtype in _INDEX + (("file", np.int32),):
+            values = columns[name]
+            self.index[name] = np.concatenate(values) if values else \
+                np.zeros(0, dtype)
+        self.index["time"] = self.index["time"].astype("datetime64[us]")
+        self._rows = dict(((int(time), int(index)), row) for row, (time, index)
+                          in enumerate(zip(self.index["time"].astype(np.int64),
+                                           self.index["index"])))
+
+    def __len__(self):
+        return len(self.index["offset"])
+
+    def row(self, time, index):
+        """Row of the feature 'index' of the frame at 'time' (datetime)."""
+        return self._rows[(int(_time(time)), int(index))]
+
+    def read(self, time, index, name):
+        """The array 'name' of the feature 'index' at 'time' (datetime)."""
+        return self.read_row(self.row(time, index), name)
+
+    def read_row(self, row, name):
+        offset = self.index["offset"][row]
+        shape = (self.index["height"][row], self.index["width"][row])
+        dataset = self._files[self.index["file"][row]][name]
+        return dataset[offset:offset + shape[0] * shape[1]].reshape(shape)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get():
+    """Returns the writer of this process, None if params.CUTOUT_STORE_DIR
+    is None. Every process (e.g. every parallel worker) appends to its own
+    file, named after the time it was created and the process ID.
+    """
+    global _writer, _writer_pid
+    if params.CUTOUT_STORE_DIR is None:
+        return None
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            if not os.path.isdir(params.CUTOUT_STORE_DIR):
+                os.makedirs(params.CUTOUT_STORE_DIR)
+            name = "cutouts_%s_%d.h5" % (
+                datetime.utcnow().strftime("%Y%m%dT%H%M%S"), os.getpid())
+            _writer = CutoutWriter(os.path.join(params.CUTOUT_STORE_DIR,
+                                                name))
+            _writer_pid = os.getpid()
+        return _writer
+
+
+def _current():
+    return _writer if _writer_pid == os.getpid() else None
+
+
+def flush():
+    """Flushes the writer of this process, if there is one."""
+    writer = _current()
+    if writer is not None:
+        writer.flush()
+
+
+def close():
+    """Closes the writer of this process, if there is one."""
+    global _writer
+    writer = _current()
+    if writer is not None:
+        writer.close()
+        _writer = None
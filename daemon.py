@@ -0,0 +1,235 @@
+"""Near-real-time extraction: the source is polled for new frames, every new
+frame is processed as soon as it appears and its features are flushed to the
+sink right away.
+
+The process stays up, so nothing is paid twice: the previous magnetogram
+(the first of the next pair) stays decoded in memory, the geometry and
+rotation caches, the tile threads of img_operations, the HTTP session and
+the tracker stay warm. Polls are sent every params.DAEMON_POLL_INTERVAL
+seconds; after a failed poll the interval doubles, up to
+params.DAEMON_MAX_BACKOFF seconds.
+
+The latency of every frame, from the poll which found it to the insertion
+of its features (the on_inserted callback of the sink), is printed and
+recorded as the counters ingest_latency_seconds and ingested_frames (their
+ratio is the mean latency); latency_summary() covers the last
+params.DAEMON_LATENCY_WINDOW frames.
+
+On start the frames of the last params.DAEMON_LOOKBACK seconds which the
+sink does not hold yet are processed.
+
+The sink is flushed after every frame, with a DiskSink every frame is one
+file of the feature store.
+
+Usage:
+  python main.py --daemon --output /data/smart-features  # Python 3.5+
+"""
+from __future__ import print_function
+
+import asyncio
+import signal
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import checkpoint
+import cutout_store
+import downloader
+import instrumentation
+import params
+import pipeline
+import tracking
+
+
+class Daemon:
+    """Usage:
+      daemon = Daemon(source, sink)
+      asyncio.get_event_loop().run_until_complete(daemon.run())
+      # daemon.stop() ends run() after the frames found so far
+
+    The defaults of the arguments are the params.DAEMON_* values.
+    """
+
+    def __init__(self, source, sink, poll_interval=None, max_backoff=None,
+                 lookback=None):
+        self.source = source
+        self.sink = sink
+        self.poll_interval = params.DAEMON_POLL_INTERVAL \
+            if poll_interval is None else poll_interval
+        self.max_backoff = params.DAEMON_MAX_BACKOFF \
+            if max_backoff is None else max_backoff
+        self.lookback = params.DAEMON_LOOKBACK if lookback is None \
+            else lookback
+        self.tracker = tracking.Tracker() if params.TRACKING else None
+        self.latencies = deque(maxlen=params.DAEMON_LATENCY_WINDOW)
+        self.session = None
+        # the last frame and its magnetogram (None if it was not loaded)
+        self._last = None
+        self._mag = None
+        # date_obs -> time of the poll which found the frame, until the
+        # frame is inserted (at most params.DAEMON_MAX_PENDING frames)
+        self._found = OrderedDict()
+        self._loop = None
+        self._stop = None
+
+    def stop(self):
+        """Ends run() after the frames found so far, thread safe."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+
+    async def run(self):
+        self._loop = asyncio.get_event_loop()
+        self._stop = asyncio.Event()
+        self.session = downloader.create_session()
+        self.sink.on_inserted = self._inserted
+        queue = asyncio.Queue()
+        # one thread, the rotation buffers of pipeline are per thread
+        executor = ThreadPoolExecutor(1)
+        try:
+            with self.sink:
+                poller = asyncio.ensure_future(self._poll(queue))
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    await self._loop.run_in_executor(executor, self._process,
+                                                     *item)
+                await poller
+                await self._loop.run_in_executor(executor,
+                                                 cutout_store.close)
+        finally:
+            executor.shutdown()
+            self.session.close()
+
+    async def _poll(self, queue):
+        """Puts (metadata, missing) of every new frame into 'queue', None
+        after stop(). 'missing' is False for frames the sink already holds.
+        """
+        metrics = instrumentation.get()
+        since = datetime.utcnow() - timedelta(seconds=self.lookback)
+        last = None
+        stored = await self._loop.run_in_executor(
+            None, self.sink.stored_times, since, datetime.utcnow())
+        backoff = self.poll_interval
+        while not self._stop.is_set():
+            delay = self.poll_interval
+            try:
+                metadata = await self._loop.run_in_executor(
+                    None, self.source.metadata, since, datetime.utcnow(),
+                    self.session)
+            except Exception:
+                print("Error while polling the source:\n%s" %
+                      metrics.error("poll"))
+                backoff = min(2 * backoff, self.max_backoff)
+                delay = backoff
+            else:
+                backoff = self.poll_interval
+                found = time.time()
+                new = [i for i in metadata if last is None or
+                       checkpoint.parse_time(i["date_obs"]) > last]
+                missing = None
+                if last is None:
+                    # catch up on the frames of the lookback
+                    missing = set(i["date_obs"] for run in
+                                  checkpoint.plan(new, stored)
+                                  for i in run[1:])
+                for i in new:
+                    is_missing = missing is None or i["date_obs"] in missing
+                    if is_missing:
+                        self._found[i["date_obs"]] = found
+                        if len(self._found) > params.DAEMON_MAX_PENDING:
+                            # never inserted, e.g. the insert failed
+                            self._found.popitem(last=False)
+                    await queue.put((i, is_missing))
+                if new:
+                    since = last = checkpoint.parse_time(new[-1]["date_obs"])
+            try:
+                await asyncio.wait_for(self._stop.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        await queue.put(None)
+
+    def _process(self, i, missing):
+        """Extracts the features of the frame 'i' and writes them to the
+        sink, runs on the executor thread.
+        """
+        frame = i["date_obs"]
+        if not missing:
+            self._last, self._mag = i, None
+            return
+        try:
+            mag = downloader.url2magnetogram(i["url"], self.session, frame)
+            if self._last is None:
+                # the first frame, the previous one of the next pair
+                self._found.pop(frame, None)
+                self._last, self._mag = i, mag
+                return
+            if self._mag is None:
+                self._mag = downloader.url2magnetogram(
+                    self._last["url"], self.session, self._last["date_obs"])
+            print("processing magnetogram %s" % frame)
+            features = pipeline.process_pair(self._mag, mag, frame,
+                                             self.sink.json_features)
+            if self.tracker is not None:
+                pipeline.track_features(self.tracker, mag, features, frame)
+            self.sink.write(frame, features)
+            self.sink.flush()
+            cutout_store.flush()
+        except Exception:
+            print("Error while processing %s:\n%s" % (
+                frame, instrumentation.get().error("process", frame)))
+            self._found.pop(frame, None)
+            self._last, self._mag = i, None
+        else:
+            self._last, self._mag = i, mag
+
+    def _inserted(self, frames):
+        """Sink callback, records the latency of the inserted frames."""
+        now = time.time()
+        metrics = instrumentation.get()
+        for frame in frames:
+            found = self._found.pop(frame, None)
+            if found is None:
+                continue
+            latency = now - found
+            self.latencies.append(latency)
+            metrics.count("ingest_latency_seconds", latency, frame)
+            metrics.count("ingested_frames", 1, frame)
+            age = (datetime.utcnow() -
+                   checkpoint.parse_time(frame)).total_seconds()
+            print("%s inserted %.1f s after it was found (%.1f s after "
+                  "date_obs)" % (frame, latency, age))
+
+    def latency_summary(self):
+        """Median, 95th percentile and maximum of the recent latencies in
+        seconds, None without inserted frames.
+        """
+        if not self.latencies:
+            return None
+        latencies = np.array(self.latencies)
+        return {"frames": len(latencies),
+                "median": float(np.median(latencies)),
+                "p95": float(np.percentile(latencies, 95)),
+                "max": float(latencies.max())}
+
+
+def run(source, sink):
+    """Runs a Daemon until SIGINT or SIGTERM."""
+    daemon = Daemon(source, sink)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, daemon.stop)
+        except (NotImplementedError, RuntimeError):
+            # no signal handlers on Windows
+            pass
+    try:
+        loop.run_until_complete(daemon.run())
+    finally:
+        loop.close()
+    print("latency: %s" % daemon.latency_summary())
+    instrumentation.get().close()
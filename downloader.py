@@ -0,0 +1,165 @@
+"""Download stage of the SMART pipeline. Magnetograms are fetched through a
+pooled HTTP session and decoded into HMIMagnetogram instances on background
+threads, so the next frames are already in memory when the extraction loop
+needs them.
+"""
+from __future__ import print_function
+
+import threading
+from io import BytesIO
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from hmi_magnetogram import HMIMagnetogram
+import instrumentation
+import magnetogram_cache
+import params
+
+
+def create_session(retries=None, pool_size=None):
+    """Returns a requests session with keep-alive connection pooling and
+    automatic retries on connection errors and 5xx answers. Default:
+    params.DOWNLOAD_RETRIES retries, params.DOWNLOAD_POOL_SIZE connections.
+    """
+    if retries is None:
+        retries = params.DOWNLOAD_RETRIES
+    if pool_size is None:
+        pool_size = params.DOWNLOAD_POOL_SIZE
+    retry = Retry(total=retries, connect=retries, read=retries,
+                  backoff_factor=params.DOWNLOAD_BACKOFF,
+                  status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def url2magnetogram(url, session=None, date_obs=None):
+    """Downloads and decodes a single magnetogram, returns None on failure.
+    The local magnetogram cache is used, if it is configured. A local path
+    (or file:// URL) is read directly.
+    """
+    getter = requests if session is None else session
+    cache = magnetogram_cache.default_cache()
+    metrics = instrumentation.get()
+    frame = url if date_obs is None else date_obs
+    try:
+        if url.startswith("file://") or "://" not in url:
+            with metrics.stage("decode", frame):
+                return HMIMagnetogram(url[len("file://"):]
+                                      if url.startswith("file://") else url)
+
+        mag = None
+        if cache is not None:
+            with metrics.stage("cache", frame):
+                mag = cache.get(url, date_obs)
+            metrics.count("cache_misses" if mag is None else "cache_hits", 1,
+                          frame)
+        if mag is None:
+            with metrics.stage("download", frame):
+                img_stream = getter.get(url, timeout=params.DOWNLOAD_TIMEOUT)
+                img_stream.raise_for_status()
+                content = img_stream.content
+            metrics.count("bytes_downloaded", len(content), frame)
+            metrics.count("retries", _retries(img_stream), frame)
+            with metrics.stage("decode", frame):
+                if cache is None:
+                    mag = HMIMagnetogram(BytesIO(content))
+                else:
+                    mag = cache.put(url, date_obs, content)
+    except Exception:
+        print("Error while downloading %s:\n%s" % (
+            url, metrics.error("download", frame)))
+        mag = None
+    return mag
+
+
+def _retries(response):
+    """Number of retries urllib3 needed for 'response'."""
+    retries = getattr(response.raw, "retries", None)
+    return 0 if retries is None else len(retries.history)
+
+
+class MagnetogramPrefetcher:
+    """Iterates over (metadata, HMIMagnetogram) pairs in the order of
+    'metadata', while 'workers' threads download and decode up to 'prefetch'
+    frames ahead of the consumer. The magnetogram is None if the frame could
+    not be downloaded.
+
+    Usage:
+      with MagnetogramPrefetcher(metadata) as frames:
+          for meta, mag in frames:
+              ...
+    """
+
+    def __init__(self, metadata, prefetch=None, session=None, workers=1):
+        if prefetch is None:
+            prefetch = params.PREFETCH_FRAMES
+        self.metadata = list(metadata)
+        self.session = create_session() if session is None else session
+        # frames handed out to the workers but not yet consumed, this bounds
+        # the number of decoded frames held in memory
+        self._prefetch = max(1, prefetch, workers)
+        self._next = 0
+        self._consumed = 0
+        self._results = {}
+        self._stop = False
+        self._cond = threading.Condition()
+        self._threads = []
+        for n in range(workers):
+            thread = threading.Thread(target=self._run,
+                                      name="smart-prefetch-%d" % n)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stop and \
+                        self._next - self._consumed >= self._prefetch:
+                    self._cond.wait()
+                if self._stop or self._next >= len(self.metadata):
+                    return
+                index = self._next
+                self._next += 1
+
+            meta = self.metadata[index]
+            mag = url2magnetogram(meta["url"], self.session,
+                                  meta.get("date_obs"))
+
+            with self._cond:
+                self._results[index] = (meta, mag)
+                self._cond.notify_all()
+
+    def __iter__(self):
+        for index in range(len(self.metadata)):
+            with self._cond:
+                while index not in self._results and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                item = self._results.pop(index)
+                self._consumed += 1
+                self._cond.notify_all()
+            yield item
+
+    def close(self):
+        """Stops the worker threads, frames not yet consumed are dropped."""
+        with self._cond:
+            self._stop = True
+            self._results.clear()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
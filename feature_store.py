@@ -0,0 +1,422 @@
+"""Columnar output of extracted features, an alternative to the JSON documents
+of SMARTFeature.json() for long time ranges.
+
+The features of params.FEATURE_STORE_BATCH_FRAMES frames are written as one
+file, every property is one column (float64, int32, the time as
+datetime64[us], the class as string). Contours are delta encoded: the first
+vertex of every contour is stored absolute, the other ones as the difference
+to their predecessor, all contours are concatenated into one int16 array
+("contour_values", n x 2) with the start offset of every contour in
+"contour_offsets". The format is a compressed .npz file or, with pyarrow
+installed, a Parquet file (params.FEATURE_STORE_FORMAT).
+
+read() loads the columns of many files at once into NumPy arrays, without a
+Python object per feature, features() rebuilds SMARTFeature instances from
+them. A frame written again (e.g. by a rerun of its time range) is read from
+the most recently written file only.
+
+Usage:
+  with FeatureWriter("/data/smart-features") as writer:
+      writer.write(date_obs, features)  # SMARTFeature or JSON dicts
+  table = read("/data/smart-features")
+  table["phi_abs"], table["time"], contours(table, 17)
+"""
+import glob
+import json
+import os
+import re
+import tempfile
+from datetime import datetime
+
+import numpy as np
+
+import cv2
+
+import params
+from smart_feature import SMARTFeature
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+
+# properties of SMARTFeature and JSON data with the same name
+FLOAT_PROPERTIES = ("max", "min", "sum", "abs_sum", "mean", "variance",
+                    "skewness", "kurtosis", "area", "phi_pos", "phi_neg",
+                    "phi_abs", "phi_imb", "phi_net_emrg", "R_star",
+                    "WL_sg_star")
+INT_PROPERTIES = ("index", "PSL_len", "SG_len")
+# column and key of SMARTFeature.shape
+_SHAPE = (("pos_x", "x"), ("pos_y", "y"), ("width", "width"),
+          ("height", "height"))
+
+_SUFFIXES = {"npz": ".npz", "parquet": ".parquet"}
+
+
+def encode_contours(contours):
+    """Returns the delta encoded values (int16 or int32, n x 2) and the
+    start offsets (int64, one more than contours) of a list of contours.
+    """
+    contours = [np.asarray(c).reshape(-1, 2) for c in contours]
+    offsets = np.zeros(len(contours) + 1, np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in contours])
+    if offsets[-1] == 0:
+        return np.zeros((0, 2), np.int16), offsets
+    points = np.concatenate(contours).astype(np.int64)
+    values = np.empty_like(points)
+    values[1:] = points[1:] - points[:-1]
+    starts = offsets[:-1][np.diff(offsets) > 0]
+    values[starts] = points[starts]
+    dtype = np.int16 if np.abs(values).max() < 2 ** 15 else np.int32
+    return values.astype(dtype), offsets
+
+
+def decode_contours(values, offsets):
+    """Inverse of encode_contours, returns all vertices (int32, n x 2), the
+    contour k are the rows offsets[k]:offsets[k + 1].
+    """
+    points = np.cumsum(values, axis=0, dtype=np.int64)
+    lengths = np.diff(offsets)
+    starts = offsets[:-1][lengths > 0]
+    # the running sum up to the start of every contour
+    base = np.zeros((len(starts), 2), np.int64)
+    base[starts > 0] = points[starts[starts > 0] - 1]
+    points -= np.repeat(base, lengths[lengths > 0], axis=0)
+    return points.astype(np.int32)
+
+
+def _columns(features):
+    """Columns of a list of SMARTFeature instances or JSON dicts."""
+    columns = {}
+    if features and isinstance(features[0], dict):
+        data = [f["data"] for f in features]
+        for names, dtype in ((FLOAT_PROPERTIES, np.float64),
+                             (INT_PROPERTIES, np.int32)):
+            for name in names:
+                columns[name] = np.array([d[name] for d in data], dtype)
+        for name, _ in _SHAPE:
+            columns[name] = np.array([d[name] for d in data], np.int32)
+        columns["lat_hg"] = np.array([f["lat_hg"] for f in features],
+                                     np.float64)
+        columns["long_hg"] = np.array([f["long_hg"] for f in features],
+                                      np.float64)
+        columns["time"] = np.array([f["time_start"].rstrip("Z")
+                                    for f in features], "datetime64[us]")
+        columns["class"] = np.array([d["class"] for d in data], "U3")
+        columns["track_id"] = np.array([d.get("track_id") or ""
+                                        for d in data], "U")
+        contours = [d["contour"] for d in data]
+    else:
+        for names, dtype in ((FLOAT_PROPERTIES, np.float64),
+                             (INT_PROPERTIES, np.int32)):
+            for name in names:
+                columns[name] = np.array([getattr(f, name) for f in features],
+                                         dtype)
+        for name, key in _SHAPE:
+            columns[name] = np.array([f.shape[key] for f in features],
+                                     np.int32)
+        columns["lat_hg"] = np.array([f.position["latitude"]
+                                      for f in features], np.float64)
+        columns["long_hg"] = np.array([f.position["longitude"]
+                                       for f in features], np.float64)
+        columns["time"] = np.array([f.time for f in features],
+                                   "datetime64[us]")
+        columns["class"] = np.array([f.classification() for f in features],
+                                    "U3")
+        columns["track_id"] = np.array([f.track_id or "" for f in features],
+                                       "U")
+        contours = [f.contour for f in features]
+    columns["contour_values"], columns["contour_offsets"] = \
+        encode_contours(contours)
+    return columns
+
+
+def _name(frame):
+    """The frame (e.g. date_obs) as part of a file name."""
+    return re.sub(r"[^0-9A-Za-z]", "", str(frame))
+
+
+class FeatureWriter:
+    """Buffers the features of 'batch_frames' frames and writes them as one
+    file to 'directory', named after its first and last frame, the time it
+    was written and the process ID. Files are written to a temporary file
+    and renamed, readers never see partial files. 'on_inserted' is called
+    with the list of frames of every written file (e.g.
+    Checkpoint.inserted).
+    """
+
+    def __init__(self, directory, batch_frames=None, format=None,
+                 on_inserted=None):
+        if batch_frames is None:
+            batch_frames = params.FEATURE_STORE_BATCH_FRAMES
+        if format is None:
+            format = params.FEATURE_STORE_FORMAT
+        if format not in _SUFFIXES:
+            raise ValueError("unknown feature store format: %s" % format)
+        if format == "parquet" and pyarrow is None:
+            raise RuntimeError("the parquet format requires pyarrow")
+        self.directory = directory
+        self.batch_frames = batch_frames
+        self.format = format
+        self.on_inserted = on_inserted
+        self.written_features = 0
+        self._frames = []
+        self._features = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self, frame, features):
+        """Adds the features (SMARTFeature instances or JSON dicts) of the
+        frame 'frame' (e.g. its date_obs).
+        """
+        self._frames.append(frame)
+        self._features.append(features)
+        if len(self._frames) >= self.batch_frames:
+            self.flush()
+
+    def flush(self):
+        if not self._frames:
+            return
+        features = [f for frame_features in self._features
+                    for f in frame_features]
+        columns = _columns(features)
+        columns["frames"] = np.array([str(f) for f in self._frames], "U")
+        columns["frame_index"] = np.repeat(
+            np.arange(len(self._frames), dtype=np.int32),
+            [len(f) for f in self._features])
+
+        # unique, a rerun of the same frames must not replace a file which
+        # may hold other frames as well
+        name = "smart_%s_%s_%s_%d%s" % (
+            _name(self._frames[0]), _name(self._frames[-1]),
+            datetime.utcnow().strftime("%Y%m%dT%H%M%S%f"), os.getpid(),
+            _SUFFIXES[self.format])
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            raise IOError("%s exists already" % path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if self.format == "npz":
+                    np.savez_compressed(f, **columns)
+                else:
+                    parquet.write_table(_arrow_table(columns), f)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+        frames = self._frames
+        self.written_features += len(features)
+        self._frames = []
+        self._features = []
+        if self.on_inserted is not None:
+            self.on_inserted(frames)
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _arrow_table(columns):
+    """One row per feature, the contours become list columns and the frames
+    are stored in the metadata of the table.
+    """
+    offsets = columns["contour_offsets"]
+    values = columns["contour_values"]
+    arrays = {}
+    for name, column in columns.items():
+        if name in ("frames", "contour_values", "contour_offsets"):
+            continue
+        arrays[name] = pyarrow.array(column)
+    for axis, name in enumerate(("contour_x", "contour_y")):
+        arrays[name] = pyarrow.ListArray.from_arrays(
+            pyarrow.array(offsets.astype(np.int32)),
+            pyarrow.array(np.ascontiguousarray(values[:, axis])))
+    return pyarrow.table(arrays).replace_schema_metadata(
+        {"frames": json.dumps(columns["frames"].tolist())})
+
+
+def _read_parquet(path):
+    table = parquet.read_table(path)
+    columns = {}
+    for name in table.column_names:
+        if name in ("contour_x", "contour_y"):
+            continue
+        column = table.column(name).to_numpy()
+        if column.dtype == object:
+            column = column.astype("U")
+        columns[name] = column
+    columns["frames"] = np.array(json.loads(
+        table.schema.metadata[b"frames"].decode("utf-8")), "U")
+    lists = [table.column(name).combine_chunks()
+             for name in ("contour_x", "contour_y")]
+    columns["contour_offsets"] = lists[0].offsets.to_numpy().astype(np.int64)
+    columns["contour_values"] = np.stack([l.values.to_numpy() for l in lists],
+                                         axis=1)
+    return columns
+
+
+def _read_file(path):
+    if path.endswith(".parquet"):
+        if pyarrow is None:
+            raise RuntimeError("reading %s requires pyarrow" % path)
+        return _read_parquet(path)
+    with np.load(path) as f:
+        return dict((name, f[name]) for name in f.files)
+
+
+def _paths(directory):
+    return sorted(glob.glob(os.path.join(directory, "smart_*.npz")) +
+                  glob.glob(os.path.join(directory, "smart_*.parquet")))
+
+
+def stored_frames(directory):
+    """Returns the sorted frames (e.g. date_obs) of all files in
+    'directory', every frame once. Only the frame column is read.
+    """
+    frames = set()
+    for path in _paths(directory):
+        if path.endswith(".parquet"):
+            if pyarrow is None:
+                raise RuntimeError("reading %s requires pyarrow" % path)
+            metadata = parquet.read_schema(path).metadata
+            frames.update(json.loads(metadata[b"frames"].decode("utf-8")))
+        else:
+            with np.load(path) as f:
+                frames.update(f["frames"].tolist())
+    return sorted(frames)
+
+
+def read(paths):
+    """Loads and concatenates the columns of the files 'paths' (a list, or a
+    directory written by FeatureWriter) in time order. Returns a dict of
+    column name -> array, one row per feature, plus "frames" (one row per
+    frame), "frame_index" (row in "frames" of every feature) and the delta
+    encoded contours (see contours()). A frame held by several files is
+    taken from the file written last.
+    """
+    if isinstance(paths, str):
+        paths = _paths(paths)
+    tables = [_read_file(path) for path in paths]
+    if not tables:
+        return {}
+    duplicates = _unique_frames(tables, paths)
+    result = {}
+    frames = 0
+    vertices = 0
+    frame_index = []
+    offsets = [np.zeros(1, np.int64)]
+    for table in tables:
+        frame_index.append(table["frame_index"] + frames)
+        offsets.append(table["contour_offsets"][1:] + vertices)
+        frames += len(table["frames"])
+        vertices += int(table["contour_offsets"][-1])
+    for name in tables[0]:
+        if name not in ("frame_index", "contour_offsets"):
+            result[name] = np.concatenate([table[name] for table in tables])
+    result["frame_index"] = np.concatenate(frame_index)
+    result["contour_offsets"] = np.concatenate(offsets)
+    if duplicates:
+        # the files overlapped, the remaining frames may be out of order
+        result = _select_frames(result, np.argsort(result["frames"],
+                                                   kind="stable"))
+    return result
+
+
+def _unique_frames(tables, paths):
+    """Removes the frames held by several tables from all of them but the
+    one of the file written last (by modification time). Returns whether
+    there were such frames.
+    """
+    owner = {}
+    duplicates = False
+    order = sorted(range(len(paths)),
+                   key=lambda k: (os.path.getmtime(paths[k]), k))
+    for k in order:
+        for frame in tables[k]["frames"].tolist():
+            duplicates = duplicates or frame in owner
+            owner[frame] = k
+    if duplicates:
+        for k, table in enumerate(tables):
+            keep = [j for j, frame in enumerate(table["frames"].tolist())
+                    if owner[frame] == k]
+            if len(keep) != len(table["frames"]):
+                tables[k] = _select_frames(table, keep)
+    return duplicates
+
+
+def _select_frames(table, selected):
+    """The table of the frames 'selected' (rows of table["frames"]) with
+    their features, in the order of 'selected'.
+    """
+    selected = np.asarray(selected, np.int64)
+    position = np.full(len(table["frames"]), -1, np.int64)
+    position[selected] = np.arange(len(selected))
+    feature_position = position[table["frame_index"]]
+    rows = np.flatnonzero(feature_position >= 0)
+    rows = rows[np.argsort(feature_position[rows], kind="stable")]
+    offsets = table["contour_offsets"]
+    lengths = offsets[rows + 1] - offsets[rows]
+    new_offsets = np.zeros(len(rows) + 1, np.int64)
+    new_offsets[1:] = np.cumsum(lengths)
+    # the vertex rows of the selected contours, in their new order
+    vertices = np.repeat(offsets[rows] - new_offsets[:-1], lengths) + \
+        np.arange(new_offsets[-1])
+    result = {}
+    for name, column in table.items():
+        if name == "frames":
+            result[name] = column[selected]
+        elif name == "frame_index":
+            result[name] = feature_position[rows].astype(column.dtype)
+        elif name == "contour_offsets":
+            result[name] = new_offsets
+        elif name == "contour_values":
+            result[name] = column[vertices]
+        else:
+            result[name] = column[rows]
+    return result
+
+
+def contours(table, k=None):
+    """Returns the contour of feature 'k' (int32, n x 2), or all vertices
+    if 'k' is None (feature k are the rows contour_offsets[k]:[k + 1]).
+    """
+    offsets = table["contour_offsets"]
+    if k is None:
+        return decode_contours(table["contour_values"], offsets)
+    values = table["contour_values"][offsets[k]:offsets[k + 1]]
+    return np.cumsum(values, axis=0, dtype=np.int64).astype(np.int32)
+
+
+def features(table, masks=True):
+    """Rebuilds a SMARTFeature for every row of 'table' (see read), with the
+    properties of SMARTFeature.from_json. 'masks' draws the feature masks.
+    """
+    points = contours(table)
+    offsets = table["contour_offsets"]
+    times = table["time"].astype("datetime64[us]").tolist()
+    result = []
+    for k in range(len(times)):
+        o = SMARTFeature()
+        o.time = times[k]
+        o.position = {"latitude": float(table["lat_hg"][k]),
+                      "longitude": float(table["long_hg"][k])}
+        o.shape = dict((key, int(table[name][k])) for name, key in _SHAPE)
+        for name in FLOAT_PROPERTIES + INT_PROPERTIES:
+            setattr(o, name, table[name][k].item())
+        o.contour = points[offsets[k]:offsets[k + 1]]
+        o.track_id = str(table["track_id"][k]) or None
+        if masks:
+            o.mask = np.zeros((o.shape["height"], o.shape["width"]),
+                              np.uint8)
+            cv2.drawContours(o.mask, [o.contour - (o.shape["x"],
+                                                   o.shape["y"])], 0, 1, -1)
+        result.append(o)
+    return result
@@ -0,0 +1,131 @@
+"""Process-wide cache for full-frame arrays which only depend on the image
+geometry (disk masks, cosine maps, coordinate maps). The geometry of HMI
+magnetograms barely changes between consecutive frames, so the header values
+are quantized (see params.GEOMETRY_*_QUANTUM) and the arrays are always built
+from the quantized values: all frames with the same key share the same,
+read-only arrays. Floating point arrays are stored as float32, unless a map
+needs double precision (the cosine correction of process_stl).
+
+If params.GEOMETRY_CACHE_DIR is set, arrays are additionally stored on disk
+and memory-mapped, so they survive restarts and are shared between
+processes through the page cache.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import params
+
+
+def quantize(value, step):
+    """Rounds 'value' to a multiple of 'step'."""
+    return round(float(value) / step) * step
+
+
+class GeometryCache:
+    """LRU cache of read-only arrays, limited to 'max_bytes'.
+
+    Usage:
+      mask = cache.get("circle_mask", (radius, center, shape),
+                       lambda: create_circle_mask(radius, center, shape))
+    """
+
+    def __init__(self, max_bytes=None, directory=None):
+        self.max_bytes = params.GEOMETRY_CACHE_MAX_BYTES \
+            if max_bytes is None else max_bytes
+        self.directory = params.GEOMETRY_CACHE_DIR if directory is None \
+            else directory
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, name, key, builder, dtype=np.float32):
+        """Returns the array stored for (name, key). On a miss it is loaded
+        from disk or built by calling 'builder', which has to return an
+        array or a tuple of equally shaped arrays. Tuples are returned as
+        read-only stacked arrays, so they can be unpacked like the tuple.
+        Floating point arrays are stored as 'dtype'.
+        """
+        full_key = (name,) + tuple(key)
+        if np.dtype(dtype) != np.float32:
+            full_key += (np.dtype(dtype).str,)
+        with self._lock:
+            value = self._entries.pop(full_key, None)
+            if value is not None:
+                self._entries[full_key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = self._load(full_key)
+        if value is None:
+            value = self._store(full_key, self._prepare(builder(), dtype))
+
+        with self._lock:
+            if full_key not in self._entries:
+                self._entries[full_key] = value
+                self._bytes += value.nbytes
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    @staticmethod
+    def _prepare(value, dtype):
+        if isinstance(value, tuple):
+            value = np.stack(value)
+        value = np.asarray(value)
+        if value.dtype.kind == "f" and value.dtype != dtype:
+            value = value.astype(dtype)
+        value.flags.writeable = False
+        return value
+
+    def _path(self, full_key):
+        digest = hashlib.sha1(repr(full_key).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "%s_%s.npy" % (full_key[0],
+                                                           digest))
+
+    def _load(self, full_key):
+        if self.directory is None:
+            return None
+        path = self._path(full_key)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode="r")
+
+    def _store(self, full_key, value):
+        if self.directory is None:
+            return value
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # write to a temporary file first, so concurrent processes never
+        # see a partially written array
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, value)
+        os.rename(tmp_path, self._path(full_key))
+        return np.load(self._path(full_key), mmap_mode="r")
+
+
+_cache = GeometryCache()
+
+
+def get(name, key, builder, dtype=np.float32):
+    """Looks up an array in the process-wide geometry cache."""
+    return _cache.get(name, key, builder, dtype)
+
+
+def cache():
+    """Returns the process-wide geometry cache."""
+    return _cache
@@ -3,123 +3,386 @@ method to extract feature/contours from the magnetogram. Magnetograms are
 considered to be from JSOC, otherwise some FITS-keyword may not be found.
 """
 
+import threading
+
 import astropy.io.fits as fits
 import numpy as np
 from datetime import datetime
 
-import sunpy.wcs.wcs as wcs
+try:
+    import sunpy.wcs.wcs as wcs
+except ImportError:
+    # removed in sunpy 0.8, only needed for the full-frame coordinate maps
+    wcs = None
 
 import cv2
 
+import coordinates
+import geometry_cache
 import img_operations
+import instrumentation
 import params
 
 ERROR_MSG = "%s seems not to be an HMI-magnetogram level 1.5"
 STRING_TO_DATETIME = "%Y.%m.%d_%H:%M:%S_TAI"
 
 
+# pixels closer than this to a multiple of 180 degrees are flipped exactly
+FLIP_ANGLE_TOLERANCE = 1e-6  # degree
+
+# version of the decoding (scaling, orientation and masking of the data),
+# increase it when the decoded data changes, see decode_version()
+DECODE_VERSION = 1
+
+_scratch = threading.local()
+
+# gray levels of as_image: the data is clipped to [-2048, 2047] Gauss and
+# shifted by 2048, the upper 8 of these 12 bits are the gray level
+IMAGE_LUT = (np.arange(4096) >> 4).astype(np.uint8)
+
+
 class HMIMagnetogram:
     def __init__(self, file_):
-        f = fits.open(file_)
-        f.verify("fix")
+        # the peak memory of loading is measured for every frame, if the
+        # instrumentation is enabled
+        with instrumentation.get().memory_window() as memory:
+            # files are memory-mapped, the raw (unscaled) data is
+            # decompressed once and scaled into a reusable buffer
+            with fits.open(file_, do_not_scale_image_data=True) as f:
+                f.verify("fix")
 
-        assert f[1].header["TELESCOP"] == "SDO/HMI", ERROR_MSG % file_
-        assert f[1].header["BUNIT"] == "Gauss", ERROR_MSG % file_
-        assert f[1].header["CONTENT"] == "MAGNETOGRAM", ERROR_MSG % file_
+                header = f[1].header
+                assert header["TELESCOP"] == "SDO/HMI", ERROR_MSG % file_
+                assert header["BUNIT"] == "Gauss", ERROR_MSG % file_
+                assert header["CONTENT"] == "MAGNETOGRAM", ERROR_MSG % file_
 
-        self.disk_center = (f[1].header["CRPIX1"], f[1].header["CRPIX2"])
-        # the border of the sun disk contains some artefacts, so reduce radius
-        rsun_obs = f[1].header["RSUN_OBS"]
-        self.pixel_scale = f[1].header["CDELT1"]
-        self.disk_radius = int(
-            params.USABLE_DISK_RADIUS * rsun_obs / self.pixel_scale)
+                self._init_metadata(header)
+                data = _scaled_data(f[1].data, header)
 
-        self.data = np.nan_to_num(np.array(f[1].data, np.float32))
+            # rotate and veritcal-flip data, to get the right view
+            self.data = _orient(data, self.disk_center,
+                                self.header["CROTA2"])
 
-        # rotate and veritcal-flip data, to get the right view
-        rotation = f[1].header["CROTA2"]
-        rotation_matrix = cv2.getRotationMatrix2D(self.disk_center, rotation,
-                                                  1)
-        self.data = cv2.warpAffine(cv2.flip(self.data, 0), rotation_matrix,
-                                   self.data.shape)
+            # set the values outside of the sun to 0
+            self.shape = self.data.shape
+            self.data_mask = self._get_data_mask()
+            self.data *= self.data_mask
+        # resident memory added by loading this frame, at its peak, None
+        # without instrumentation
+        self.peak_memory = memory.growth()
 
-        # set the values outside of the sun to 0
-        self.data_mask = img_operations.create_circle_mask(self.disk_radius,
-                                                           self.disk_center,
-                                                           self.data.shape)
-        self.data *= self.data_mask
+    @classmethod
+    def from_array(cls, data, header):
+        """Creates a magnetogram from already decoded data, e.g. data shared
+        between processes. 'data' has to be rotated and masked like the data
+        of a magnetogram loaded from a FITS file, it is not copied.
+        """
+        o = cls.__new__(cls)
+        o._init_metadata(header)
+        o.data = data
+        o.shape = data.shape
+        o.data_mask = o._get_data_mask()
+        o.peak_memory = None
+        return o
 
-        self.header = f[1].header
+    def _init_metadata(self, header):
+        self.disk_center = (header["CRPIX1"], header["CRPIX2"])
+        # the border of the sun disk contains some artefacts, so reduce radius
+        rsun_obs = header["RSUN_OBS"]
+        self.pixel_scale = header["CDELT1"]
+        self.disk_radius = int(
+            params.USABLE_DISK_RADIUS * rsun_obs / self.pixel_scale)
+
+        self.header = header
         self.noise_level = params.STATIC_BACKGROUND_THRESHOLD
         self.minimal_feature_area = params.MINIMAL_FEATURE_AREA
         self.delta_magnetogram = None
-        self.shape = self.data.shape
+        self.smoothed = None
 
         self.helioprojective_coordinates = None
         self.heliocentric_coordinates = None
         self.heliographic_coordinates = None
         self.cosine_map = None
+        self.coordinate_provider = None
 
         self.time = datetime.strptime(self.header["T_REC"],
                                       STRING_TO_DATETIME)
 
     def as_image(self, size=None, contours=None):
-        tmp = self.data
-        if size:
-            tmp = cv2.resize(self.data, size)
-        tmp[tmp < -2048] = -2048
-        tmp[tmp > 2047] = 2047
-        tmp += 2048
-        tmp *= cv2.resize(self.data_mask, size)
-        tmp = np.right_shift(tmp.astype(np.uint32), 4)
-
-        tmp = tmp.astype(np.uint8)
+        """8 bit gray image of the data (see IMAGE_LUT), resized to 'size'
+        (width, height) if given. 'contours' (in pixels of the data) are
+        drawn in white. The data is not modified.
+        """
+        data = self.data if size is None else cv2.resize(self.data, size)
+        levels = np.clip(data, -2048, 2047)
+        np.nan_to_num(levels, copy=False)
+        levels += 2048
+        levels = levels.astype(np.uint16)
+        levels *= self._image_mask(size)
+        image = IMAGE_LUT[levels]
 
         if contours:
-            cv2.drawContours(tmp, contours, -1, (255, 0, 0), 2)
+            cv2.drawContours(image, img_operations.scale_contours(
+                contours, self.shape, size), -1, 255, 2)
 
-        return tmp
+        return image
 
-    def get_contours(self, delta_magnetogram=None):
-        """delta_magnetogram should be differential rotated"""
-        if self.delta_magnetogram is None:
+    def _image_mask(self, size):
+        """data_mask resized to 'size', cached for every disk geometry."""
+        if size is None:
+            return self.data_mask
+        quantum = params.GEOMETRY_PIXEL_QUANTUM
+        center = (geometry_cache.quantize(self.disk_center[0], quantum),
+                  geometry_cache.quantize(self.disk_center[1], quantum))
+        return geometry_cache.get(
+            "image_mask", (self.disk_radius, center, self.shape, tuple(size)),
+            lambda: cv2.resize(self.data_mask, tuple(size)))
+
+    def get_contours(self, delta_magnetogram=None, smoothed_delta=None):
+        """delta_magnetogram should be differential rotated, it is only used
+        with params.USE_DELTA_MAGNETOGRAM. smoothed_delta may be the
+        differentially rotated get_smoothed() of the previous magnetogram
+        (incremental smoothing), to avoid smoothing delta_magnetogram.
+        """
+        if delta_magnetogram is None or not params.USE_DELTA_MAGNETOGRAM:
             delta_magnetogram = self
+            smoothed_delta = None
+        if params.DETECTION == "pyramid":
+            # smooths the windows around the candidates only
+            return img_operations.extract_features_pyramid(
+                self.data, delta_magnetogram.data, self.disk_center,
+                self.disk_radius, smoothed_dt=smoothed_delta)
         contours = img_operations.extract_features(self.data,
                                                    delta_magnetogram.data,
                                                    self.disk_center,
-                                                   self.disk_radius)
+                                                   self.disk_radius,
+                                                   self.get_smoothed(),
+                                                   smoothed_delta)
 
         return contours
 
+    def get_smoothed(self):
+        """Smoothed, thresholded data (img_operations.process_stl), call it
+        before the data gets rotated. It is only kept (as float32, in
+        'smoothed') if the next pair reuses it, i.e. with
+        params.INCREMENTAL_SMOOTHING and params.USE_DELTA_MAGNETOGRAM.
+        """
+        if self.smoothed is not None:
+            return self.smoothed
+        smoothed = img_operations.process_stl(self.data, self.disk_center,
+                                              self.disk_radius)
+        if params.INCREMENTAL_SMOOTHING and params.USE_DELTA_MAGNETOGRAM:
+            self.smoothed = smoothed.astype(np.float32)
+        return smoothed
+
+    def _get_data_mask(self):
+        quantum = params.GEOMETRY_PIXEL_QUANTUM
+        center = (geometry_cache.quantize(self.disk_center[0], quantum),
+                  geometry_cache.quantize(self.disk_center[1], quantum))
+        return geometry_cache.get(
+            "circle_mask", (self.disk_radius, center, self.shape),
+            lambda: img_operations.create_circle_mask(self.disk_radius,
+                                                      center, self.shape))
+
+    def _geometry(self):
+        """The header values which define the coordinate maps, rounded to
+        the quanta of the geometry cache.
+        """
+        q = geometry_cache.quantize
+        return (
+            tuple(self.shape),
+            q(self.header["CDELT1"], params.GEOMETRY_SCALE_QUANTUM),
+            q(self.header["CDELT2"], params.GEOMETRY_SCALE_QUANTUM),
+            q(self.header["CRPIX1"], params.GEOMETRY_PIXEL_QUANTUM),
+            q(self.header["CRPIX2"], params.GEOMETRY_PIXEL_QUANTUM),
+            q(self.header["CRVAL1"], params.GEOMETRY_ANGLE_QUANTUM),
+            q(self.header["CRVAL2"], params.GEOMETRY_ANGLE_QUANTUM),
+            q(self.header["DSUN_OBS"], params.GEOMETRY_DISTANCE_QUANTUM)
+        )
+
     def get_helioprojective_coordinates(self):
         if self.helioprojective_coordinates is None:
-            self.helioprojective_coordinates = wcs.convert_pixel_to_data(
-                self.data.shape,
-                [self.header["CDELT1"], -self.header["CDELT2"]],
-                # negate because we flipped the data?
-                [self.header["CRPIX1"], self.header["CRPIX2"]],
-                [self.header["CRVAL1"], self.header["CRVAL2"]])
+            geometry = self._geometry()
+            self.helioprojective_coordinates = geometry_cache.get(
+                "helioprojective", geometry,
+                lambda: _helioprojective_coordinates(geometry))
         return self.helioprojective_coordinates
 
     def get_heliocentric_coordinates(self):
         if self.heliocentric_coordinates is None:
-            x_coords, y_coords = self.get_helioprojective_coordinates()
-            self.heliocentric_coordinates = \
-                wcs.convert_hpc_hcc(x_coords, y_coords,
-                                    dsun_meters=self.header["DSUN_OBS"],
-                                    z=True)
+            geometry = self._geometry()
+            self.heliocentric_coordinates = geometry_cache.get(
+                "heliocentric", geometry,
+                lambda: _heliocentric_coordinates(geometry))
         return self.heliocentric_coordinates
 
     def get_cosine_map(self):
         if self.cosine_map is None:
-            hcc_z = self.get_heliocentric_coordinates()[2]
-            self.cosine_map = cv2.normalize(hcc_z, None, 0, 1, cv2.NORM_MINMAX)
+            self.cosine_map = self._get_heliographic_maps()[2]
         return self.cosine_map
 
     def get_heliographic_coordinates(self):
         if self.heliographic_coordinates is None:
-            hcc_x, hcc_y, hcc_z = self.get_heliocentric_coordinates()
-            self.heliographic_coordinates = wcs.convert_hcc_hg(hcc_x, hcc_y,
-                                                               hcc_z)[0:2]
+            self.heliographic_coordinates = self._get_heliographic_maps()[0:2]
 
         return self.heliographic_coordinates
+
+    def get_coordinate_provider(self):
+        """Returns a coordinates.CoordinateProvider for windows of this
+        magnetogram, using the same geometry as the full-frame maps.
+        """
+        if self.coordinate_provider is None:
+            shape, cdelt1, cdelt2, crpix1, crpix2, crval1, crval2, dsun = \
+                self._geometry()
+            self.coordinate_provider = coordinates.CoordinateProvider(
+                shape, [cdelt1, -cdelt2], [crpix1, crpix2], [crval1, crval2],
+                dsun)
+        return self.coordinate_provider
+
+    def get_heliographic_window(self, x, y, width, height):
+        """Heliographic longitude and latitude maps of a window. With
+        params.LAZY_COORDINATES only the window is computed, otherwise it is
+        cut out of get_heliographic_coordinates().
+        """
+        if params.LAZY_COORDINATES:
+            return self.get_coordinate_provider().heliographic(x, y, width,
+                                                               height)
+        hg_lont_map, hg_latd_map = self.get_heliographic_coordinates()
+        return (hg_lont_map[y:y + height, x:x + width],
+                hg_latd_map[y:y + height, x:x + width])
+
+    def get_cosine_window(self, x, y, width, height):
+        """Cosine map of a window, see get_heliographic_window."""
+        if params.LAZY_COORDINATES:
+            return self.get_coordinate_provider().cosine(x, y, width, height)
+        return self.get_cosine_map()[y:y + height, x:x + width]
+
+    def get_coordinate_pixels(self, rows, cols):
+        """Heliographic longitude, latitude and cosine map values of the
+        pixels at the index arrays 'rows' and 'cols', see
+        get_heliographic_window.
+        """
+        if params.LAZY_COORDINATES:
+            return self.get_coordinate_provider().pixels(cols, rows)
+        hg_lont_map, hg_latd_map = self.get_heliographic_coordinates()
+        return (hg_lont_map[rows, cols], hg_latd_map[rows, cols],
+                self.get_cosine_map()[rows, cols])
+
+    def _get_heliographic_maps(self):
+        """Longitude, latitude and cosine map, built in one go because they
+        share the heliocentric coordinates.
+        """
+        geometry = self._geometry()
+        return geometry_cache.get("heliographic", geometry,
+                                  lambda: _heliographic_maps(geometry))
+
+
+# the coordinate maps are computed in float64 from the quantized geometry,
+# the geometry cache stores them as float32
+def _helioprojective_coordinates(geometry):
+    shape, cdelt1, cdelt2, crpix1, crpix2, crval1, crval2, _ = geometry
+    return wcs.convert_pixel_to_data(
+        shape,
+        [cdelt1, -cdelt2],
+        # negate because we flipped the data?
+        [crpix1, crpix2],
+        [crval1, crval2])
+
+
+def _heliocentric_coordinates(geometry):
+    x_coords, y_coords = _helioprojective_coordinates(geometry)
+    return wcs.convert_hpc_hcc(x_coords, y_coords, dsun_meters=geometry[-1],
+                               z=True)
+
+
+def _heliographic_maps(geometry):
+    hcc_x, hcc_y, hcc_z = _heliocentric_coordinates(geometry)
+    cosine_map = cv2.normalize(hcc_z, None, 0, 1, cv2.NORM_MINMAX)
+    hg_longitude, hg_latitude = wcs.convert_hcc_hg(hcc_x, hcc_y, hcc_z)[0:2]
+    return hg_longitude, hg_latitude, cosine_map
+
+
+def _scratch_buffer(shape):
+    """Float32 buffer of the calling thread, reused for every frame."""
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, np.float32)
+        _scratch.buffer = buffer
+    return buffer
+
+
+def decode_version():
+    """Identifies the decoded data: DECODE_VERSION and the parameters the
+    decoding depends on. The decoded frames of the magnetogram cache are
+    keyed by it.
+    """
+    return "%d|%r|%r|%r" % (DECODE_VERSION, params.USABLE_DISK_RADIUS,
+                            params.GEOMETRY_PIXEL_QUANTUM,
+                            FLIP_ANGLE_TOLERANCE)
+
+
+def _scaled_data(raw, header):
+    """Applies BSCALE, BZERO and BLANK of the header to the raw data, like
+    astropy would, and replaces missing values by 0 (np.nan_to_num). The
+    result is written to the scratch buffer of the thread.
+    """
+    out = _scratch_buffer(raw.shape)
+    if raw.dtype.kind in "iu":
+        bscale = header.get("BSCALE", 1.0)
+        bzero = header.get("BZERO", 0.0)
+        if bzero:
+            np.add(raw * bscale, bzero, out=out, casting="unsafe")
+        else:
+            np.multiply(raw, bscale, out=out, casting="unsafe")
+        if "BLANK" in header:
+            np.copyto(out, 0, where=raw == header["BLANK"])
+    else:
+        np.copyto(out, raw, casting="unsafe")
+        np.nan_to_num(out, copy=False)
+    return out
+
+
+def _orient(data, center, rotation):
+    """Returns cv2.warpAffine(cv2.flip(data, 0), rotation matrix) in a new
+    array. Flip and rotation are one inverse mapping; if the rotation is a
+    multiple of 180 degrees and maps pixels onto pixels, the data is only
+    flipped and shifted, without interpolation.
+    """
+    height, width = data.shape
+    out = np.empty_like(data)
+
+    turns = int(round(rotation / 180.0))
+    if abs(rotation - 180 * turns) < FLIP_ANGLE_TOLERANCE:
+        if turns % 2 == 0:
+            return cv2.flip(data, 0, dst=out)
+        # the vertical flip and the half turn around the center result in a
+        # horizontal flip, shifted by (2 * center - (size - 1))
+        shift_x = 2 * center[0] - (width - 1)
+        shift_y = 2 * center[1] - (height - 1)
+        if shift_x == int(shift_x) and shift_y == int(shift_y):
+            cv2.flip(data, 1, dst=out)
+            return _shift(out, int(shift_x), int(shift_y))
+
+    # dst(p) = flipped(M^-1 p) = data(F M^-1 p), F flips the rows
+    rotation_matrix = cv2.getRotationMatrix2D(center, rotation, 1)
+    inverse = np.vstack([cv2.invertAffineTransform(rotation_matrix),
+                         [0, 0, 1]])
+    flip = np.array([[1, 0, 0], [0, -1, height - 1], [0, 0, 1]], np.float64)
+    return cv2.warpAffine(data, np.dot(flip, inverse)[:2], (width, height),
+                          dst=out, flags=cv2.INTER_LINEAR |
+                          cv2.WARP_INVERSE_MAP)
+
+
+def _shift(data, shift_x, shift_y):
+    """Shifts 'data' in place, uncovered pixels become 0."""
+    height, width = data.shape
+    if shift_x or shift_y:
+        src = data[max(0, -shift_y):height - max(0, shift_y),
+                   max(0, -shift_x):width - max(0, shift_x)]
+        data[max(0, shift_y):height - max(0, -shift_y),
+             max(0, shift_x):width - max(0, -shift_x)] = src
+        data[:max(0, shift_y)] = 0
+        data[height - max(0, -shift_y):] = 0
+        data[:, :max(0, shift_x)] = 0
+        data[:, width - max(0, -shift_x):] = 0
+    return data
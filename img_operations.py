@@ -1,11 +1,19 @@
 """All necessary image operations for the SMART algorithm
 """
 
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 from math import tan, pi
 
 import cv2
 
+import geometry_cache
 import params
 
 
@@ -14,20 +22,50 @@ def cosine_corrected(img, center, disk_radius):
     all pixel with an angle smaller than 60 degrees to the view axis. Otherwise
     there would be extrem high correction factors.
     """
+    corrected = img / _cosine_correction(center, disk_radius, img.shape)
+
+    return np.nan_to_num(corrected)
+
+
+def _cosine_correction(center, disk_radius, shape):
+    quantum = params.GEOMETRY_PIXEL_QUANTUM
+    center = (geometry_cache.quantize(center[0], quantum),
+              geometry_cache.quantize(center[1], quantum))
+    # float64 like the original map, so process_stl returns float64 and
+    # the thresholds of binarize see the same values
+    return geometry_cache.get(
+        "cosine_correction", (center, disk_radius, shape),
+        lambda: cosine_correction_map(center, disk_radius, shape),
+        np.float64)
+
+
+def cosine_correction_map(center, disk_radius, shape):
+    """Returns the divisor used by cosine_corrected, NaN outside the disk."""
 
     # create coordinate grid, where 'center' is the origin of the coordinate
     # aka the center of the sun
-    x, y = np.mgrid[-center[0]:-center[0] + img.shape[0],
-                    -center[1]:-center[1] + img.shape[1]]
+    x, y = np.mgrid[-center[0]:-center[0] + shape[0],
+                    -center[1]:-center[1] + shape[1]]
     dist = np.sqrt(x * x + y * y)
 
     max_correction_angle = tan(pi / 3)
 
     cos_correction = np.sin(np.arccos(dist / disk_radius))
     cos_correction[cos_correction < max_correction_angle] = 1
-    corrected = img / cos_correction
 
-    return np.nan_to_num(corrected)
+    return cos_correction
+
+
+def scale_contours(contours, shape, size):
+    """The contours (in pixels of an image of 'shape') in pixels of the
+    image resized to 'size' (width, height), as int32 arrays for
+    cv2.drawContours.
+    """
+    contours = [np.asarray(c, np.int32).reshape(-1, 1, 2) for c in contours]
+    if size is None or tuple(size) == (shape[1], shape[0]):
+        return contours
+    scale = np.array([size[0] / float(shape[1]), size[1] / float(shape[0])])
+    return [np.round(c * scale).astype(np.int32) for c in contours]
 
 
 def binarize(img):
@@ -43,6 +81,9 @@ def process_stl(img, center, disk_radius):
     """Apply smoothing, thresholding and LOS-correction to an LOS-magnetogram.
     LOS-correction with cosine: currently not in use, but implemented
     """
+    if params.TILE_SIZE:
+        return _process_stl_tiled(img, center, disk_radius)
+
     ret = cv2.GaussianBlur(img, (
         params.GAUSSIAN_BLUR_KERNEL_SIZE,
         params.GAUSSIAN_BLUR_KERNEL_SIZE),
@@ -67,35 +108,111 @@ def create_circle_mask(radius, center, shape):
     return circle.astype(np.uint8)
 
 
-def extract_features(hmi_t, hmi_dt, center, disk_radius):
+def dilate_circle(mask, radius, method=None):
+    """Dilates the binary (0 and 1) uint8 'mask' with the circular kernel
+    create_circle_mask(radius, (radius, radius), (2 * radius, 2 * radius)),
+    the result is identical to cv2.dilate with this kernel.
+
+    method: "kernel" uses cv2.dilate, its time grows with the kernel area.
+      "distance" sets the pixels whose Euclidean distance to the closest set
+      pixel is smaller than 'radius' (the kernel contains exactly these
+      offsets), the time does not depend on the radius. The distance
+      transform only runs in windows around the set pixels, which are found
+      on a grid of params.DILATION_BLOCK_SIZE pixels. Default:
+      params.DILATION_METHOD.
+    """
+    if method is None:
+        method = params.DILATION_METHOD
+    if method == "kernel":
+        return cv2.dilate(mask, create_circle_mask(radius, (radius, radius),
+                                                   (2 * radius, 2 * radius)))
+
+    height, width = mask.shape
+    out = np.zeros((height, width), np.uint8)
+    for x0, y0, x1, y1 in _occupied_windows(mask, radius):
+        distance = cv2.distanceTransform(
+            cv2.compare(mask[y0:y1, x0:x1], 0, cv2.CMP_EQ), cv2.DIST_L2,
+            cv2.DIST_MASK_PRECISE)
+        out[y0:y1, x0:x1] |= cv2.compare(distance, float(radius),
+                                         cv2.CMP_LT) & 1
+    return out
+
+
+def _occupied_windows(mask, margin):
+    """Disjoint windows (x0, y0, x1, y1) containing every set pixel of 'mask'
+    and its surrounding of 'margin' pixels.
+    """
+    height, width = mask.shape
+    b = params.DILATION_BLOCK_SIZE
+    blocks = np.zeros((-(-height // b) * b, -(-width // b) * b), np.uint8)
+    blocks[:height, :width] = mask
+    blocks = blocks.reshape(blocks.shape[0] // b, b,
+                            blocks.shape[1] // b, b).max(axis=(1, 3))
+    stats = cv2.connectedComponentsWithStats(blocks, connectivity=8)[2]
+    return _merge_windows(
+        _clip((x * b - margin, y * b - margin, (x + w) * b + margin,
+               (y + h) * b + margin), width, height)
+        for x, y, w, h, _ in stats[1:])
+
+
+def extract_features(hmi_t, hmi_dt, center, disk_radius, smoothed_t=None,
+                     smoothed_dt=None):
     """Extracts the contours of all features on a LOS-magnetogram.
 
     HMI_t: The HMI-magnetogram (line-of-sight) to examine.
     HMI_t_delta: A previous HMI-magnetogram, used to extract time-dependent
-      features.
+      features. If it is the same array as HMI_t, it is processed only once.
     center: The center of the sun disk in pixels on the image.
     delta_time: The time between HMI_t and HMI_t_delta.
     disk_radius: the radius of the sun in pixels.
+    smoothed_t: process_stl(HMI_t), if it is already known.
+    smoothed_dt: The process_stl output of the previous magnetogram,
+      differentially rotated to the time of HMI_t. If given, it replaces
+      process_stl(HMI_t_delta), see smoothing_difference for the error.
     """
 
-    m_t = process_stl(hmi_t, center, disk_radius)
-    m_t = binarize(m_t)
+    if smoothed_t is None:
+        smoothed_t = process_stl(hmi_t, center, disk_radius)
+    m_t = binarize(smoothed_t)
 
-    m_t_delta = process_stl(hmi_dt, center, disk_radius)
-    m_t_delta = binarize(m_t_delta)
+    if smoothed_dt is not None:
+        m_t_delta = binarize(smoothed_dt)
+    elif hmi_dt is hmi_t:
+        m_t_delta = m_t
+    else:
+        m_t_delta = binarize(process_stl(hmi_dt, center, disk_radius))
 
-    r = params.FEATURE_DILATION_RADIUS
-    kernel = create_circle_mask(r, (r, r), (2 * r, 2 * r))
-    m_t_grown = cv2.dilate(m_t, kernel)
-    m_t_delta_grown = cv2.dilate(m_t_delta, kernel)
-    diff = cv2.bitwise_xor(m_t_grown, m_t_delta_grown)
+    igm_t = _grow_features(m_t, m_t_delta, params.FEATURE_DILATION_RADIUS)
+
+    return _select_contours(igm_t)
+
+
+def _grow_features(m_t, m_t_delta, r, tiled=None):
+    """Removes the parts of the binary mask m_t which changed compared to
+    m_t_delta and grows the remaining regions by 'r' pixels. 'tiled'
+    (default: params.TILE_SIZE is set) runs on tiles of the frame, see
+    _grow_features_tiled.
+    """
+    if tiled is None:
+        tiled = bool(params.TILE_SIZE)
+    if tiled:
+        return _grow_features_tiled(m_t, m_t_delta, r)
+    if m_t_delta is m_t:
+        # the grown masks are equal, there are no differences to remove
+        igm_t = m_t
+    else:
+        m_t_grown = dilate_circle(m_t, r)
+        m_t_delta_grown = dilate_circle(m_t_delta, r)
+        diff = cv2.bitwise_xor(m_t_grown, m_t_delta_grown)
+
+        igm_t = cv2.subtract(m_t, diff)
+    return dilate_circle(igm_t, r)
 
-    igm_t = cv2.subtract(m_t, diff)
-    igm_t = cv2.dilate(igm_t, kernel)
 
+def _select_contours(igm_t, offset=(0, 0)):
     contours = cv2.findContours(
         igm_t, cv2.RETR_EXTERNAL,
-        cv2.CHAIN_APPROX_SIMPLE
+        cv2.CHAIN_APPROX_SIMPLE, offset=offset
     )[0]
 
     ret = []
@@ -105,3 +222,372 @@ def extract_features(hmi_t, hmi_dt, center, disk_radius):
                 ret.append(i)
 
     return ret
+
+
+def extract_features_pyramid(hmi_t, hmi_dt, center, disk_radius,
+                             factor=None, smoothed_dt=None):
+    """Same as extract_features, but detects candidate regions on a frame
+    downsampled by 'factor' (with blur and dilation radii scaled to match)
+    and extracts the contours at full resolution only inside windows around
+    the candidates. A window is processed with a halo of the blur radius
+    plus the dilation radii, so the contours inside of it are exactly the
+    ones of extract_features. Windows whose contours touch their border are
+    grown and processed again (params.PYRAMID_MAX_GROW times), the contours
+    of windows still touching their border after that are taken from
+    extract_features of the full frame. Regions missed by the coarse
+    detection are missing, see pyramid_accuracy.
+    'factor' defaults to params.PYRAMID_FACTOR, 'smoothed_dt' is the one of
+    extract_features.
+    """
+    if factor is None:
+        factor = params.PYRAMID_FACTOR
+    height, width = hmi_t.shape
+    r = params.FEATURE_DILATION_RADIUS
+    halo = params.GAUSSIAN_BLUR_KERNEL_SIZE // 2 + r
+    if hmi_dt is not hmi_t:
+        halo += r
+    margin = params.PYRAMID_MARGIN * factor
+
+    windows = []
+    for x0, y0, x1, y1 in _coarse_candidates(hmi_t, hmi_dt, center,
+                                             disk_radius, factor,
+                                             smoothed_dt):
+        windows.append(_clip((int(x0) - margin, int(y0) - margin,
+                              int(np.ceil(x1)) + margin,
+                              int(np.ceil(y1)) + margin), width, height))
+
+    results = {}
+    for _ in range(params.PYRAMID_MAX_GROW + 1):
+        windows = _merge_windows(windows)
+        grown = False
+        for i, window in enumerate(windows):
+            if window not in results:
+                results[window] = _refine_window(hmi_t, hmi_dt, center,
+                                                 disk_radius, window, halo,
+                                                 smoothed_dt)
+            contours, touching = results[window]
+            if touching:
+                windows[i] = _clip((window[0] - margin, window[1] - margin,
+                                    window[2] + margin, window[3] + margin),
+                                   width, height)
+                grown = grown or windows[i] != window
+        if not grown:
+            break
+
+    ret = []
+    full = None
+    taken = set()
+    for window in _merge_windows(windows):
+        if window not in results:
+            results[window] = _refine_window(hmi_t, hmi_dt, center,
+                                             disk_radius, window, halo,
+                                             smoothed_dt)
+        contours, touching = results[window]
+        if not touching:
+            ret.extend(contours)
+            continue
+        # the window could not be grown enough, its contours would be cut
+        if full is None:
+            full = extract_features(hmi_t, hmi_dt, center, disk_radius,
+                                    smoothed_dt=smoothed_dt)
+        x0, y0, x1, y1 = window
+        for k, contour in enumerate(full):
+            x, y, w, h = cv2.boundingRect(contour)
+            if k not in taken and x < x1 and x + w > x0 and y < y1 and \
+                    y + h > y0:
+                taken.add(k)
+                ret.append(contour)
+    return ret
+
+
+def _coarse_candidates(hmi_t, hmi_dt, center, disk_radius, factor,
+                       smoothed_dt=None):
+    """Bounding boxes (x0, y0, x1, y1) in full resolution pixels of the
+    regions detected on the downsampled frames. 'smoothed_dt' replaces the
+    smoothing of hmi_dt, it is downsampled.
+    """
+    height, width = hmi_t.shape
+    size = (max(1, width // factor), max(1, height // factor))
+    scale = (size[0] / float(width), size[1] / float(height))
+    small_center = (center[0] * scale[0], center[1] * scale[1])
+    small_radius = int(disk_radius * min(scale))
+
+    kernel_size = max(3, int(round(params.GAUSSIAN_BLUR_KERNEL_SIZE /
+                                   float(factor))) // 2 * 2 + 1)
+    sigma = params.GAUSSIAN_BLUR_SIGMA / float(factor)
+
+    def smoothed(img):
+        small = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        ret = cv2.GaussianBlur(small, (kernel_size, kernel_size), sigma)
+        ret *= (~cv2.inRange(ret, -params.STATIC_BACKGROUND_THRESHOLD,
+                             params.STATIC_BACKGROUND_THRESHOLD)) & 1
+        return cosine_corrected(ret, small_center, small_radius)
+
+    m_t = binarize(smoothed(hmi_t))
+    if smoothed_dt is not None:
+        m_t_delta = binarize(cv2.resize(smoothed_dt, size,
+                                        interpolation=cv2.INTER_AREA))
+    elif hmi_dt is hmi_t:
+        m_t_delta = m_t
+    else:
+        m_t_delta = binarize(smoothed(hmi_dt))
+    r = max(1, int(round(params.FEATURE_DILATION_RADIUS / float(factor))))
+    igm_t = _grow_features(m_t, m_t_delta, r, tiled=False)
+
+    contours = cv2.findContours(igm_t, cv2.RETR_EXTERNAL,
+                                cv2.CHAIN_APPROX_SIMPLE)[0]
+    boxes = []
+    for x, y, w, h in (cv2.boundingRect(c) for c in contours):
+        boxes.append((x / scale[0], y / scale[1],
+                      (x + w) / scale[0], (y + h) / scale[1]))
+    return boxes
+
+
+def _refine_window(hmi_t, hmi_dt, center, disk_radius, window, halo,
+                   smoothed_dt=None):
+    """Extracts the contours inside of 'window' (x0, y0, x1, y1) at full
+    resolution. Returns the contours and whether one of them touches the
+    border of the window (inside of the image). 'smoothed_dt' replaces the
+    smoothing of hmi_dt, like in extract_features.
+    """
+    height, width = hmi_t.shape
+    x0, y0, x1, y1 = window
+    crop = _clip((x0 - halo, y0 - halo, x1 + halo, y1 + halo), width, height)
+
+    m_t = binarize(_process_stl_window(hmi_t, center, disk_radius, crop))
+    if smoothed_dt is not None:
+        m_t_delta = binarize(smoothed_dt[crop[1]:crop[3], crop[0]:crop[2]])
+    elif hmi_dt is hmi_t:
+        m_t_delta = m_t
+    else:
+        m_t_delta = binarize(_process_stl_window(hmi_dt, center, disk_radius,
+                                                 crop))
+    igm_t = _grow_features(m_t, m_t_delta, params.FEATURE_DILATION_RADIUS,
+                           tiled=False)
+    igm_t = np.ascontiguousarray(igm_t[y0 - crop[1]:y1 - crop[1],
+                                       x0 - crop[0]:x1 - crop[0]])
+
+    contours = _select_contours(igm_t, (x0, y0))
+    touching = False
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if (x == x0 and x0 > 0) or (y == y0 and y0 > 0) or \
+                (x + w == x1 and x1 < width) or (y + h == y1 and y1 < height):
+            touching = True
+    return contours, touching
+
+
+def _process_stl_window(img, center, disk_radius, window):
+    """process_stl of the part 'window' (x0, y0, x1, y1) of the frame. The
+    values closer to the window border than the blur radius differ from the
+    full frame result.
+    """
+    x0, y0, x1, y1 = window
+    ret = cv2.GaussianBlur(img[y0:y1, x0:x1], (
+        params.GAUSSIAN_BLUR_KERNEL_SIZE,
+        params.GAUSSIAN_BLUR_KERNEL_SIZE),
+        params.GAUSSIAN_BLUR_SIGMA)
+    ret *= (~cv2.inRange(ret, -params.STATIC_BACKGROUND_THRESHOLD,
+                         params.STATIC_BACKGROUND_THRESHOLD)) & 1
+    cos_correction = _cosine_correction(center, disk_radius, img.shape)
+    return np.nan_to_num(ret / cos_correction[y0:y1, x0:x1])
+
+
+# tiled execution (params.TILE_SIZE)-----------------------------------------
+# Every tile is computed from a crop which extends it by the radius of the
+# operation (the halo), so its pixels are exactly those of the monolithic
+# call. The tiles run on a thread pool, OpenCV and NumPy release the GIL.
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def _tile_pool():
+    global _pool, _pool_pid
+    with _pool_lock:
+        # a pool inherited by a forked process has no threads
+        if _pool is None or _pool_pid != os.getpid():
+            threads = params.TILE_THREADS or multiprocessing.cpu_count()
+            _pool = ThreadPool(max(1, threads))
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@atexit.register
+def _close_tile_pool():
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.close()
+        _pool.join()
+
+
+def _tiles(shape, size):
+    height, width = shape
+    return [(x0, y0, min(width, x0 + size), min(height, y0 + size))
+            for y0 in range(0, height, size) for x0 in range(0, width, size)]
+
+
+def _disk_tiles(center, disk_radius, shape):
+    """The tiles (x0, y0, x1, y1) of params.TILE_SIZE pixels with at least
+    one pixel on the disk of cosine_correction_map. process_stl is zero on
+    all other pixels.
+    """
+    quantum = params.GEOMETRY_PIXEL_QUANTUM
+    center = (geometry_cache.quantize(center[0], quantum),
+              geometry_cache.quantize(center[1], quantum))
+    size = params.TILE_SIZE
+
+    def build():
+        on_disk = ~np.isnan(_cosine_correction(center, disk_radius, shape))
+        return np.array([tile for tile in _tiles(shape, size)
+                         if on_disk[tile[1]:tile[3], tile[0]:tile[2]].any()],
+                        np.int64).reshape(-1, 4)
+
+    return [tuple(int(v) for v in tile) for tile in geometry_cache.get(
+        "disk_tiles", (center, disk_radius, shape, size), build)]
+
+
+def _inner(tile, crop):
+    """Slices of 'tile' inside of the array of 'crop'."""
+    return (slice(tile[1] - crop[1], tile[3] - crop[1]),
+            slice(tile[0] - crop[0], tile[2] - crop[0]))
+
+
+def _process_stl_tiled(img, center, disk_radius):
+    """process_stl on the tiles intersecting the disk, with a halo of the
+    blur radius. The result is identical, the tiles off the disk stay zero.
+    """
+    height, width = img.shape
+    halo = params.GAUSSIAN_BLUR_KERNEL_SIZE // 2
+    cos_correction = _cosine_correction(center, disk_radius, img.shape)
+    ret = np.zeros(img.shape, np.result_type(img, cos_correction))
+
+    def process(tile):
+        crop = _clip((tile[0] - halo, tile[1] - halo, tile[2] + halo,
+                      tile[3] + halo), width, height)
+        window = _process_stl_window(img, center, disk_radius, crop)
+        ret[tile[1]:tile[3], tile[0]:tile[2]] = window[_inner(tile, crop)]
+
+    _tile_pool().map(process, _disk_tiles(center, disk_radius, img.shape))
+    return ret
+
+
+def _grow_features_tiled(m_t, m_t_delta, r):
+    """_grow_features on tiles of params.TILE_SIZE pixels with a halo of the
+    dilation radii. Tiles without a set pixel of m_t within 'r' pixels stay
+    zero (among them the corners off the disk).
+    """
+    height, width = m_t.shape
+    halo = r if m_t_delta is m_t else 2 * r
+    igm_t = np.zeros(m_t.shape, np.uint8)
+
+    def grow(tile):
+        near = _clip((tile[0] - r, tile[1] - r, tile[2] + r, tile[3] + r),
+                     width, height)
+        if not m_t[near[1]:near[3], near[0]:near[2]].any():
+            return
+        crop = _clip((tile[0] - halo, tile[1] - halo, tile[2] + halo,
+                      tile[3] + halo), width, height)
+        m_crop = m_t[crop[1]:crop[3], crop[0]:crop[2]]
+        if m_t_delta is m_t:
+            delta_crop = m_crop
+        else:
+            delta_crop = m_t_delta[crop[1]:crop[3], crop[0]:crop[2]]
+        grown = _grow_features(m_crop, delta_crop, r, tiled=False)
+        igm_t[tile[1]:tile[3], tile[0]:tile[2]] = grown[_inner(tile, crop)]
+
+    _tile_pool().map(grow, _tiles(m_t.shape, params.TILE_SIZE))
+    return igm_t
+
+
+def _clip(window, width, height):
+    x0, y0, x1, y1 = window
+    return (max(0, x0), max(0, y0), min(width, x1), min(height, y1))
+
+
+def _merge_windows(windows):
+    """Merges overlapping windows into their bounding windows."""
+    windows = list(windows)
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for window in windows:
+            for i, other in enumerate(result):
+                if window[0] < other[2] and other[0] < window[2] and \
+                        window[1] < other[3] and other[1] < window[3]:
+                    result[i] = (min(window[0], other[0]),
+                                 min(window[1], other[1]),
+                                 max(window[2], other[2]),
+                                 max(window[3], other[3]))
+                    merged = True
+                    break
+            else:
+                result.append(window)
+        windows = result
+    return sorted(windows)
+
+
+def pyramid_accuracy(hmi_t, hmi_dt, center, disk_radius, factor=None,
+                     smoothed_dt=None):
+    """Compares extract_features_pyramid with extract_features on one frame.
+    Returns a dict with the number of features of both, the number of
+    identical contours, of full resolution features missed by the pyramid
+    (no overlap) and of extra pyramid features, the intersection over union
+    of the feature areas and the run times in seconds.
+    """
+    start = time.time()
+    full = extract_features(hmi_t, hmi_dt, center, disk_radius,
+                            smoothed_dt=smoothed_dt)
+    full_seconds = time.time() - start
+    start = time.time()
+    pyramid = extract_features_pyramid(hmi_t, hmi_dt, center, disk_radius,
+                                       factor, smoothed_dt)
+    pyramid_seconds = time.time() - start
+
+    def area_mask(contours):
+        mask = np.zeros(hmi_t.shape, np.uint8)
+        cv2.drawContours(mask, contours, -1, 1, -1)
+        return mask
+
+    def overlaps(contour, mask):
+        x, y, w, h = cv2.boundingRect(contour)
+        own = np.zeros((h, w), np.uint8)
+        cv2.drawContours(own, [contour - (x, y)], 0, 1, -1)
+        return bool(np.any(own & mask[y:y + h, x:x + w]))
+
+    full_mask = area_mask(full)
+    pyramid_mask = area_mask(pyramid)
+    union = np.count_nonzero(full_mask | pyramid_mask)
+    intersection = np.count_nonzero(full_mask & pyramid_mask)
+
+    full_keys = set(c.tobytes() for c in full)
+    return {
+        "full_features": len(full),
+        "pyramid_features": len(pyramid),
+        "identical": sum(c.tobytes() in full_keys for c in pyramid),
+        "missed": sum(not overlaps(c, pyramid_mask) for c in full),
+        "extra": sum(not overlaps(c, full_mask) for c in pyramid),
+        "iou": float(intersection) / float(union) if union else 1.0,
+        "full_seconds": full_seconds,
+        "pyramid_seconds": pyramid_seconds
+    }
+
+
+def smoothing_difference(smoothed_dt, hmi_dt, center, disk_radius):
+    """Quantifies the error of carrying the smoothed previous magnetogram
+    forward: compares 'smoothed_dt', the differentially rotated process_stl
+    output of the previous magnetogram, with process_stl of the rotated
+    magnetogram 'hmi_dt'. Returns a dict with the maximal and mean absolute
+    difference (Gauss) and the fraction of on-disk pixels whose binarization
+    differs.
+    """
+    reference = process_stl(hmi_dt, center, disk_radius)
+    difference = np.abs(reference - smoothed_dt)
+    on_disk = create_circle_mask(disk_radius, center, hmi_dt.shape) > 0
+    mismatch = binarize(reference) != binarize(smoothed_dt)
+    return {
+        "max_abs": float(difference[on_disk].max()),
+        "mean_abs": float(difference[on_disk].mean()),
+        "binary_mismatch": float(mismatch[on_disk].mean())
+    }
@@ -0,0 +1,423 @@
+"""Per-stage instrumentation of the SMART pipeline. Every stage of a frame
+(download, decode, rotate, contour, characterize, insert) records its wall
+time, CPU time and peak memory, counters (features, bytes downloaded,
+retries, ...) are added per frame.
+
+CPU time and memory are those of the process: the CPU time includes the
+OpenMP threads of native_rotation and the tile threads of img_operations,
+the peak memory is measured per stage with a MemoryWindow (Linux only,
+None elsewhere). Stages running at the same time on other threads (e.g.
+the download and decode of the prefetcher) are included in each other's
+CPU time and peak memory.
+
+Every record is appended as one JSON line to params.METRICS_LOG, the totals
+are written to params.METRICS_PROMETHEUS_FILE in the text format of the
+Prometheus node exporter (textfile collector). If neither file is configured
+nothing is recorded, stage() returns a shared no-op context manager.
+
+Usage:
+  metrics = instrumentation.get()
+  with metrics.stage("rotate", frame=date_obs):
+      ...
+  metrics.count("features", len(features), frame=date_obs)
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+import params
+
+try:
+    # CPU time of the process, including the threads a stage starts
+    _cpu_time = time.process_time
+except AttributeError:
+    _cpu_time = time.clock
+
+
+def peak_memory():
+    """Peak resident memory of the process in bytes, None if unknown. On
+    Linux this is the high-water mark since the last reset by a
+    MemoryWindow, elsewhere the peak since the start of the process.
+    """
+    peak = _status_memory("VmHWM")
+    if peak is not None:
+        return peak
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _status_memory(field):
+    """The memory 'field' (e.g. VmRSS) of /proc/self/status in bytes, None
+    if it is not available (not Linux).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def _reset_peak_memory():
+    """Resets the high-water mark VmHWM to the current resident memory,
+    returns False if that is not possible.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+
+# the open MemoryWindows
+_windows = set()
+_windows_lock = threading.Lock()
+
+
+class MemoryWindow:
+    """Measures the peak resident memory of the process from the creation of
+    the window to close(), on Linux only (the high-water mark of
+    /proc/self/status, reset with /proc/self/clear_refs). The memory is
+    that of the whole process, windows open at the same time (other
+    threads) include the memory of each other; a reset does not lose the
+    peak of the other open windows.
+
+    Usage:
+      with instrumentation.MemoryWindow() as memory:
+          ...
+      memory.peak, memory.growth()
+    """
+
+    def __init__(self):
+        self.start = None
+        # peak resident memory in bytes, set by close(), None if unknown
+        self.peak = None
+        self._peak = 0
+        with _windows_lock:
+            _fold_peak()
+            if _reset_peak_memory():
+                self.start = _status_memory("VmRSS")
+            if self.start is not None:
+                _windows.add(self)
+
+    def close(self):
+        """Sets and returns peak."""
+        with _windows_lock:
+            if self in _windows:
+                _fold_peak()
+                _windows.discard(self)
+                self.peak = self._peak
+        return self.peak
+
+    def growth(self):
+        """peak above the resident memory at the creation of the window,
+        None if unknown.
+        """
+        if self.peak is None:
+            return None
+        return max(0, self.peak - self.start)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def _fold_peak():
+    """Adds the current high-water mark to the open windows, before it is
+    reset. Called with _windows_lock held.
+    """
+    if not _windows:
+        return
+    peak = _status_memory("VmHWM")
+    if peak is not None:
+        for window in _windows:
+            window._peak = max(window._peak, peak)
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _NullWindow(_NullStage):
+    """A MemoryWindow which measures nothing."""
+    start = None
+    peak = None
+
+    def close(self):
+        return None
+
+    def growth(self):
+        return None
+
+
+_NULL_WINDOW = _NullWindow()
+
+
+class NullMetrics:
+    """Used if the instrumentation is disabled, records nothing."""
+    enabled = False
+
+    def stage(self, name, frame=None):
+        return _NULL_STAGE
+
+    def memory_window(self):
+        """A MemoryWindow if the instrumentation is enabled, otherwise one
+        which measures nothing: resetting the high-water mark clears the
+        referenced bits of all pages of the process.
+        """
+        return _NULL_WINDOW
+
+    def count(self, name, value=1, frame=None):
+        pass
+
+    def error(self, stage, frame=None, trace=None):
+        """Returns the traceback of the exception being handled."""
+        return traceback.format_exc() if trace is None else trace
+
+    def take_totals(self):
+        return None
+
+    def merge(self, totals):
+        pass
+
+    def write_prometheus(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _Stage:
+    def __init__(self, metrics, name, frame):
+        self.metrics = metrics
+        self.name = name
+        self.frame = frame
+
+    def __enter__(self):
+        self.memory = MemoryWindow()
+        self.start = time.time()
+        self.start_cpu = _cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics._add_stage(self.name, self.frame,
+                                time.time() - self.start,
+                                _cpu_time() - self.start_cpu,
+                                self.memory.close(), exc_type is not None)
+        return False
+
+
+class Metrics(NullMetrics):
+    """Records stages, counters and errors.
+
+    log_path: JSON-lines file, records are appended, optional.
+    prometheus_path: text file with the totals, rewritten at most every
+      'interval' seconds and on close(), optional.
+    """
+    enabled = True
+
+    def __init__(self, log_path=None, prometheus_path=None, interval=None):
+        self.log_path = log_path
+        self.prometheus_path = prometheus_path
+        self.interval = params.METRICS_INTERVAL if interval is None \
+            else interval
+        self._lock = threading.Lock()
+        self._log = None
+        if log_path is not None:
+            # line buffered, every record reaches the file in one write
+            self._log = open(log_path, "a", 1)
+        self._last_write = time.time()
+        self._reset()
+
+    def _reset(self):
+        # stage -> [calls, wall seconds, CPU seconds, failures]
+        self._stages = {}
+        self._counters = {}
+        self._errors = {}
+        self._peak_memory = 0
+
+    def stage(self, name, frame=None):
+        """Context manager which records the stage 'name' of 'frame'."""
+        return _Stage(self, name, frame)
+
+    def memory_window(self):
+        return MemoryWindow()
+
+    def _add_stage(self, name, frame, wall, cpu, memory, failed):
+        with self._lock:
+            totals = self._stages.setdefault(name, [0, 0.0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += wall
+            totals[2] += cpu
+            totals[3] += failed
+            if memory is not None:
+                self._peak_memory = max(self._peak_memory, memory)
+        self._write({"stage": name, "frame": frame, "wall": wall,
+                     "cpu": cpu, "peak_memory": memory, "failed": failed})
+
+    def count(self, name, value=1, frame=None):
+        """Adds 'value' to the counter 'name'."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        self._write({"counter": name, "frame": frame, "value": value})
+
+    def error(self, stage, frame=None, trace=None):
+        """Records the exception being handled (or the traceback 'trace')
+        as an error of 'stage', returns the traceback.
+        """
+        if trace is None:
+            trace = traceback.format_exc()
+        with self._lock:
+            self._errors[stage] = self._errors.get(stage, 0) + 1
+        self._write({"error": stage, "frame": frame, "traceback": trace})
+        return trace
+
+    def take_totals(self):
+        """Returns the totals recorded since the last call and resets them,
+        e.g. to hand them from a worker process to the parent.
+        """
+        with self._lock:
+            totals = (self._stages, self._counters, self._errors,
+                      self._peak_memory)
+            self._reset()
+        return totals
+
+    def merge(self, totals):
+        """Adds totals returned by take_totals."""
+        if totals is None:
+            return
+        stages, counters, errors, memory = totals
+        with self._lock:
+            for name, values in stages.items():
+                own = self._stages.setdefault(name, [0, 0.0, 0.0, 0])
+                for k, value in enumerate(values):
+                    own[k] += value
+            for own, other in ((self._counters, counters),
+                               (self._errors, errors)):
+                for name, value in other.items():
+                    own[name] = own.get(name, 0) + value
+            self._peak_memory = max(self._peak_memory, memory)
+        self._write(None)
+
+    def _write(self, record):
+        if self._log is not None and record is not None:
+            record["time"] = time.time()
+            line = json.dumps(record) + "\n"
+            with self._lock:
+                self._log.write(line)
+        if self.prometheus_path is not None and \
+                time.time() - self._last_write >= self.interval:
+            self.write_prometheus()
+
+    def write_prometheus(self):
+        """Writes the totals to the Prometheus text file. The file is
+        replaced atomically, the collector never reads a partial file.
+        """
+        if self.prometheus_path is None:
+            return
+        with self._lock:
+            self._last_write = time.time()
+            lines = _prometheus_lines(self._stages, self._counters,
+                                      self._errors, self._peak_memory)
+        directory = os.path.dirname(os.path.abspath(self.prometheus_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.rename(tmp_path, self.prometheus_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def close(self):
+        self.write_prometheus()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+
+def _metric(lines, name, kind, description, samples):
+    lines.append("# HELP smart_%s %s" % (name, description))
+    lines.append("# TYPE smart_%s %s" % (name, kind))
+    for labels, value in samples:
+        lines.append("smart_%s%s %r" % (name, labels, float(value)))
+
+
+def _prometheus_lines(stages, counters, errors, memory):
+    lines = []
+    names = sorted(stages)
+    for k, (name, description) in enumerate((
+            ("stage_calls_total", "Number of runs of the stage."),
+            ("stage_seconds_total", "Wall time spent in the stage."),
+            ("stage_cpu_seconds_total", "CPU time spent in the stage."),
+            ("stage_failures_total", "Runs of the stage which raised."))):
+        _metric(lines, name, "counter", description,
+                [('{stage="%s"}' % stage, stages[stage][k])
+                 for stage in names])
+    _metric(lines, "errors_total", "counter", "Errors logged per stage.",
+            [('{stage="%s"}' % stage, errors[stage])
+             for stage in sorted(errors)])
+    for name in sorted(counters):
+        _metric(lines, name + "_total", "counter",
+                "Sum of the counter %s." % name, [("", counters[name])])
+    _metric(lines, "peak_memory_bytes", "gauge",
+            "Peak resident memory of the process during the stages.",
+            [("", memory)])
+    _metric(lines, "last_update_seconds", "gauge",
+            "Time of the last update of this file.", [("", time.time())])
+    return lines
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def configure(log_path=None, prometheus_path=None, enabled=None):
+    """Replaces the metrics returned by get(). They are disabled if both
+    paths are None, unless 'enabled' is set (e.g. to collect totals for
+    take_totals).
+    """
+    global _metrics
+    if enabled is None:
+        enabled = log_path is not None or prometheus_path is not None
+    with _metrics_lock:
+        # the previous metrics are not closed, a forked worker would
+        # overwrite the Prometheus file with the totals of its parent
+        if enabled:
+            _metrics = Metrics(log_path, prometheus_path)
+        else:
+            _metrics = NullMetrics()
+    return _metrics
+
+
+def get():
+    """Returns the metrics configured in params.py (or by configure)."""
+    if _metrics is None:
+        configure(params.METRICS_LOG, params.METRICS_PROMETHEUS_FILE)
+    return _metrics
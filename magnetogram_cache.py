@@ -0,0 +1,221 @@
+"""Local disk cache for downloaded magnetograms, so reprocessing a time range
+(e.g. after changing params.py) does not download every FITS file again.
+
+Entries are addressed by a hash of the metadata URL and date_obs. Either the
+FITS payload is stored, or, with params.MAGNETOGRAM_CACHE_DECODED, the
+decoded (flipped, rotated and masked) float32 frame as a .npy file plus its
+FITS header, which is memory-mapped on a hit, so a warm rerun skips both the
+network and the FITS decode. The key of a decoded frame includes
+decode_version(), frames decoded by another version or with
+other parameters (e.g. params.USABLE_DISK_RADIUS) are not used.
+
+Entries are written to temporary files (a temporary directory holding the
+.npy and header files of a decoded frame) and renamed, so concurrent
+workers never see partial entries. The total size is limited to
+params.MAGNETOGRAM_CACHE_MAX_BYTES, the least recently used entries (by
+modification time, which is updated on every hit) are evicted. Hits and
+misses are counted in the attributes hits and misses and by the downloader
+as the instrumentation counters cache_hits and cache_misses.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from io import BytesIO
+
+import astropy.io.fits as fits
+import numpy as np
+
+from hmi_magnetogram import HMIMagnetogram, decode_version
+import params
+
+# FITS files and directories of decoded frames, the flat .npy and .hdr files
+# of older versions are only evicted
+_SUFFIXES = (".fits", ".decoded", ".npy", ".hdr")
+_DATA = "data.npy"
+_HEADER = "header.hdr"
+
+
+class MagnetogramCache:
+    """Usage:
+      cache = MagnetogramCache("/data/smart-cache")
+      mag = cache.get(url, date_obs)
+      if mag is None:
+          content = download(url)
+          mag = cache.put(url, date_obs, content)
+    """
+
+    def __init__(self, directory, max_bytes=None, decoded=None):
+        self.directory = directory
+        self.max_bytes = params.MAGNETOGRAM_CACHE_MAX_BYTES \
+            if max_bytes is None else max_bytes
+        self.decoded = params.MAGNETOGRAM_CACHE_DECODED if decoded is None \
+            else decoded
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by a concurrent worker
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def key(url, date_obs=None, decoded=False):
+        """The key of the FITS file or, if 'decoded', of the decoded frame."""
+        value = "%s|%s" % (url, date_obs)
+        if decoded:
+            value += "|" + decode_version()
+        return hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, url, date_obs=None):
+        """Returns the cached magnetogram or None."""
+        try:
+            mag = self._load(url, date_obs)
+        except (IOError, OSError, ValueError):
+            # evicted by a concurrent worker or unreadable
+            mag = None
+        with self._lock:
+            if mag is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return mag
+
+    def _load(self, url, date_obs):
+        path = self._path(self.key(url, date_obs, True), ".decoded")
+        if os.path.isdir(path):
+            with open(os.path.join(path, _HEADER)) as f:
+                header = fits.Header.fromstring(f.read())
+            # copy-on-write, the cached file is never modified
+            data = np.load(os.path.join(path, _DATA), mmap_mode="c")
+            self._touch(path)
+            return HMIMagnetogram.from_array(data, header)
+
+        path = self._path(self.key(url, date_obs), ".fits")
+        if os.path.exists(path):
+            mag = HMIMagnetogram(path)
+            self._touch(path)
+            return mag
+        return None
+
+    def put(self, url, date_obs, content):
+        """Stores the FITS payload 'content' (bytes) and returns the decoded
+        magnetogram.
+        """
+        mag = HMIMagnetogram(BytesIO(content))
+        if self.decoded:
+            self._write_decoded(self._path(self.key(url, date_obs, True),
+                                           ".decoded"), mag)
+        else:
+            self._write(self._path(self.key(url, date_obs), ".fits"),
+                        content)
+        self._evict()
+        return mag
+
+    def _write(self, path, content):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def _write_decoded(self, path, mag):
+        """Writes data and header of 'mag' into a temporary directory, which
+        is renamed to 'path', so both appear at once.
+        """
+        tmp_path = tempfile.mkdtemp(dir=self.directory, suffix=".tmp")
+        try:
+            with open(os.path.join(tmp_path, _HEADER), "wb") as f:
+                f.write(mag.header.tostring().encode("ascii"))
+            np.save(os.path.join(tmp_path, _DATA), mag.data)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # written by a concurrent worker in the meantime
+                if not os.path.isdir(path):
+                    raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @staticmethod
+    def _touch(*paths):
+        for path in paths:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+
+    def _entries(self):
+        """Returns a list of (last use, size, paths) of all entries."""
+        entries = {}
+        for name in os.listdir(self.directory):
+            key, suffix = os.path.splitext(name)
+            if suffix not in _SUFFIXES:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                size = stat.st_size
+                if suffix == ".decoded":
+                    size = sum(os.path.getsize(os.path.join(path, f))
+                               for f in os.listdir(path))
+            except OSError:
+                continue
+            used, total, paths = entries.get(key, (0, 0, []))
+            entries[key] = (max(used, stat.st_mtime), total + size,
+                            paths + [path])
+        return list(entries.values())
+
+    def size(self):
+        """Total size of all entries in bytes."""
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[0])
+        total = sum(size for _, size, _ in entries)
+        for _, size, paths in entries:
+            if total <= self.max_bytes:
+                break
+            for path in paths:
+                try:
+                    if os.path.isdir(path):
+                        # renamed first, readers never see a partial entry
+                        tmp_path = tempfile.mkdtemp(dir=self.directory,
+                                                    suffix=".tmp")
+                        try:
+                            os.rename(path, os.path.join(tmp_path, "entry"))
+                        finally:
+                            shutil.rmtree(tmp_path, ignore_errors=True)
+                    else:
+                        os.remove(path)
+                except OSError:
+                    pass
+            total -= size
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """Returns the cache in params.MAGNETOGRAM_CACHE_DIR, None if it is not
+    configured.
+    """
+    global _default
+    if params.MAGNETOGRAM_CACHE_DIR is None:
+        return None
+    with _default_lock:
+        if _default is None or \
+                _default.directory != params.MAGNETOGRAM_CACHE_DIR:
+            _default = MagnetogramCache(params.MAGNETOGRAM_CACHE_DIR)
+    return _default
@@ -1,21 +1,26 @@
 """This is the main part of the S.M.A.R.T. algorithm. It will load the
-necessary magnetograms from the server (set in config.py) and do the
-extraction. The extracted features will be written back into the database.
-
+necessary magnetograms from a source (the HMI service, or a local archive)
+and do the extraction. The extracted features will be written to a sink (the
+property database, or a feature store on disk).
+
+Usage:
+  python main.py  # params.START - params.END, FlareCast services
+  python main.py --start 2014-01-01T00:00 --end 2014-02-01T00:00 \
+      --archive /data/hmi --output /data/smart-features
+  python main.py --daemon  # new frames as they appear, see daemon.py
 """
 from __future__ import print_function
 
+import argparse
+import sys
 
-import urllib2
-import requests
-import json
-import StringIO
-from io import BytesIO
-from flarecast.utils.property_db_client import PropertyDBClient
-
-from hmi_magnetogram import HMIMagnetogram
-from smart_feature import SMARTFeature
-from native_rotation import native_rotation
+import checkpoint
+import cutout_store
+import instrumentation
+import parallel
+import pipeline
+import sources
+import tracking
 try:
     import params1 as params
 except:
@@ -25,81 +30,131 @@ except:
 print("S.M.A.R.T. info: libdc1394 errors are okay, they can be ignored\n")
 
 
-def _url2magnetogram(url):
-    img_stream = requests.get(url)
-    img = BytesIO(img_stream.content)
-    try:
-        mag = HMIMagnetogram(img)
-    except Exception as e:
-        print("Error happend while downloading: %s" % e)
-        mag = None
-    return mag
-
-
-def extract(start_, end_, hmiservice, propertyservice_url):
-    client = PropertyDBClient(propertyservice_url)
-    client.insert_provenances(["smart-python"])
-
-    query_params = {
-        "start": start_.isoformat() + "Z",
-        "end": end_.isoformat() + "Z"
-    }
-    metadata = requests.get(hmiservice, params=query_params).json()
+def extract(start_, end_, source, sink):
+    """Extracts the features of all frames of 'source' between start_ and
+    end_ and writes them to 'sink' (see sources.py).
+    """
+    metadata = source.metadata(start_, end_)
 
     if len(metadata) == 0:
         print('Warning: No images found in given time range (%s - %s)' % (
             start_, end_))
         return
 
-    mag_t1 = _url2magnetogram(metadata[0]["url"])
-    last_i = None
-
-    for num, i in enumerate(metadata[1:]):
-        print("processing magnetogram %d of %d (%s)" % (
-            num + 1, len(metadata) - 1, i["date_obs"]))
-
-        try:
-            if mag_t1 is None:
-                mag_t1 = _url2magnetogram(last_i["url"])
-            mag_t0 = mag_t1
-            mag_t1 = _url2magnetogram(i["url"])
-
-            # differential rotation
-            delta_time = (mag_t1.time - mag_t0.time).total_seconds()
-            mag_t0.data = native_rotation.rotate(
-                mag_t0.data,
-                int(mag_t0.disk_center[0]),
-                int(mag_t0.disk_center[1]),
-                int(mag_t0.disk_radius),
-                delta_time
-            )
-
-            # feature extraction
-            contours = mag_t1.get_contours(mag_t0)
-
-            features = []
-            for j, contour in enumerate(contours):
-                feature = SMARTFeature.from_hmi(mag_t1, j, contour,
-                                                delta_time, mag_t0).json()
-                features.append(feature)
-
-            answer = client.insert_regions("smart-python", features)
-
-            if "message" in answer:
-                print("error while inserting property groups: %s" %
-                      answer["message"])
-                return
-
-        except Exception as e:
-            print("Error happend: %s" % e)
-            mag_t1 = None
+    tracker = None
+    if params.TRACKING:
+        if params.PARALLEL_PROCESSES == 1:
+            tracker = tracking.Tracker()
+        else:
+            print("Warning: tracking needs PARALLEL_PROCESSES = 1, the "
+                  "features are not tracked")
+
+    # resume: skip the frames up to the checkpoint and the frames which are
+    # already stored or were processed after it (also those without
+    # features)
+    resume = None
+    frame, first_mag = None, None
+    if params.CHECKPOINT_FILE is not None:
+        resume = checkpoint.Checkpoint(params.CHECKPOINT_FILE)
+        frame, first_mag = resume.load()
+        if tracker is not None and resume.tracks is not None:
+            # continue the tracks of the checkpoint frame
+            tracker.restore(resume.tracks)
+        sink.on_inserted = resume.inserted
+    stored = None
+    if params.CHECKPOINT_SKIP_STORED:
+        stored = sink.stored_times(start_, end_)
+    processed = () if resume is None else resume.processed
+    runs = checkpoint.plan(metadata, stored, frame, processed=processed)
+    print("%d of %d frames have to be processed" % (
+        sum(len(run) - 1 for run in runs), len(metadata) - 1))
+
+    with sink:
+        for i, features in _extract_runs(runs, tracker, resume, frame,
+                                         first_mag, sink.json_features):
+            sink.write(i["date_obs"], features)
+    cutout_store.close()
+    # final totals to the Prometheus file
+    instrumentation.get().close()
+
+
+def _extract_runs(runs, tracker, resume, first_frame, first_mag, as_json):
+    """Yields the (metadata, features) tuples of all runs of checkpoint.plan,
+    the first frame of a run is taken from the checkpoint if possible.
+    """
+    for run in runs:
+        mag = first_mag if run[0]["date_obs"] == first_frame else None
+        if params.PARALLEL_PROCESSES == 1:
+            results = pipeline.extract_serial(run, tracker, resume, mag,
+                                              as_json)
+        else:
+            results = parallel.extract_parallel(run,
+                                                params.PARALLEL_PROCESSES,
+                                                params.PARALLEL_SHARD_FRAMES,
+                                                as_json)
+        for i, features in results:
+            if resume is not None and params.PARALLEL_PROCESSES != 1:
+                # the magnetograms stay in the workers, only the date_obs
+                # is recorded
+                resume.offer(i)
+            yield i, features
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extracts SMART features from HMI magnetograms.")
+    parser.add_argument("--start", type=checkpoint.parse_time,
+                        default=params.START,
+                        help="ISO 8601 time, default params.START")
+    parser.add_argument("--end", type=checkpoint.parse_time,
+                        default=params.END,
+                        help="ISO 8601 time, default params.END")
+    parser.add_argument("--archive",
+                        help="directory tree of HMI FITS files, read instead "
+                             "of the HMI service")
+    parser.add_argument("--index",
+                        help="index file of the archive, default "
+                             ".smart_index.json in the archive")
+    parser.add_argument("--output",
+                        help="feature store directory, written instead of "
+                             "the property service")
+    parser.add_argument("--format", choices=("npz", "parquet"),
+                        default=params.FEATURE_STORE_FORMAT)
+    parser.add_argument("--daemon", action="store_true",
+                        help="process new frames as they appear until "
+                             "SIGINT or SIGTERM, --start and --end are "
+                             "ignored")
+    parser.add_argument("--hmi-service", default=params.HMI_SERVICE)
+    parser.add_argument("--property-service",
+                        default=params.PROPERTY_SERVICE)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    if args.archive:
+        source = sources.LocalArchiveSource(args.archive, args.index)
+    else:
+        source = sources.HMIServiceSource(args.hmi_service)
+
+    output = args.output or params.FEATURE_STORE_DIR
+    if output is not None:
+        sink = sources.DiskSink(output, args.format)
+    else:
+        sink = sources.PropertyServiceSink(args.property_service)
+
+    if args.daemon:
+        if sys.version_info < (3, 5):
+            sys.exit("the daemon requires Python 3.5 or newer")
+        # asyncio syntax, not importable by Python 2
+        import daemon
+        print("\n\nstart daemon")
+        daemon.run(source, sink)
+        return
 
-        last_i = i
+    print("\n\nstart extraction")
+    extract(args.start, args.end, source, sink)
 
 
 if __name__ == '__main__':
-    hmiservice = "http://hmi:8001/HMI/720"
-    propertyservice_url = "http://property:8002"
-
-    print("\n\nstart extraction")
-    extract(params.START, params.END, hmiservice, propertyservice_url)
+    main()
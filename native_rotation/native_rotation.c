@@ -5,6 +5,14 @@
 
 #include <math.h>
 #include <stdlib.h>
+#include <string.h>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#define MODE_FORWARD 0
+#define MODE_INVERSE 1
 
 
 float calculateRotationInRadians(float latitude, float timeDifferenceInSeconds) {
@@ -15,117 +23,236 @@ float calculateRotationInRadians(float latitude, float timeDifferenceInSeconds)
 }
 
 
-static PyObject *rotate(PyObject *self, PyObject *args) {
-  PyObject *in_obj;
-  PyArrayObject *in,*out;
+/* original algorithm: every on-disk pixel is moved to its rotated position,
+   pixels landing on the same position are averaged and gaps are filled by
+   linear interpolation */
+static void rotateRowForward(const float *img, float *ret, int cols, int y,
+                             int cx, int cy, int radius, float dt) {
+    int r2 = radius*radius;
+    int y2 = (y-cy) * (y-cy);
+    int last_new_x = -1;
+    int x;
+    float theta = asin((y-cy)/(float)radius);
+    float angle = calculateRotationInRadians(theta, dt);
+    /* double like the cos(angle) and sin(angle) calls of the original
+       inner loop, the products are rounded to float only once */
+    double cos_angle = cos(angle);
+    double sin_angle = sin(angle);
+
+    for(x=0; x<cols; ++x) ret[x] = 0;
+
+    for(x=0; x<cols; ++x) {
+        int dist = (x-cx) * (x-cx) + y2;
+        if(dist > r2) {
+            ret[x] = NAN;
+            continue;
+        }
+
+        float z = sqrt(r2 - dist);
+        float rot_x = (x-cx)*cos_angle - z * sin_angle;
+        float rot_z = (x-cx)*sin_angle + z * cos_angle;
+
+        if(rot_z <= 0) {
+            continue;
+        }
+
+        int new_x = roundf(cx + rot_x);
+        if(new_x < 0 || new_x >= cols) {
+            continue;
+        }
+
+        float orig_value = img[x];
+        float new_value = ret[new_x];
+        if(new_value == 0) new_value = orig_value;
+        else new_value = (orig_value + new_value)/2;
+        if(isnan(new_value)) new_value = 0;
+        ret[new_x] = new_value;
+
+        if(new_x > last_new_x+1 && new_x <= cx + cols/64) {
+            int i;
+            if(last_new_x == -1) {
+                for(i=x; i<new_x; ++i) ret[i] = 0;
+            } else {
+                int diff = new_x - last_new_x;
+                float last_color = ret[last_new_x];
+                float color_diff = ret[new_x] - last_color;
+                float color_step = color_diff / diff;
+                if(isnan(last_color)) last_color = 0;
+                if(isnan(color_step)) color_step = 0;
+                for(i=1; i<diff; ++i)
+                  ret[last_new_x+i] = last_color + i*color_step;
+            }
+        }
+        last_new_x = new_x;
+    }
+}
+
+
+/* every on-disk output pixel is rotated back to its source position, the
+   value is interpolated linearly between the two neighbouring source pixels
+   of the row. Pixels rotating in from the far side are 0, off-disk pixels
+   NaN like in the forward mode. */
+static void rotateRowInverse(const float *img, float *ret, int cols, int y,
+                             int cx, int cy, int radius, float dt) {
+    int r2 = radius*radius;
+    int y2 = (y-cy) * (y-cy);
+    int x;
+    float theta = asin((y-cy)/(float)radius);
+    float angle = calculateRotationInRadians(theta, dt);
+    double cos_angle = cos(angle);
+    double sin_angle = sin(angle);
+
+    for(x=0; x<cols; ++x) {
+        int dist = (x-cx) * (x-cx) + y2;
+        if(dist > r2) {
+            ret[x] = NAN;
+            continue;
+        }
+
+        float z = sqrt(r2 - dist);
+        float src_x = (x-cx)*cos_angle + z * sin_angle;
+        float src_z = z * cos_angle - (x-cx)*sin_angle;
+
+        if(src_z <= 0) {
+            ret[x] = 0;
+            continue;
+        }
+
+        float pos = cx + src_x;
+        int left = (int)floorf(pos);
+        float weight = pos - left;
+        float a = (left >= 0 && left < cols) ? img[left] : NAN;
+        float b = (left+1 >= 0 && left+1 < cols) ? img[left+1] : NAN;
+        float value;
+        if(isnan(a)) value = b;
+        else if(isnan(b)) value = a;
+        else value = a + weight * (b - a);
+        ret[x] = isnan(value) ? 0 : value;
+    }
+}
+
+
+static PyObject *rotate(PyObject *self, PyObject *args, PyObject *kwargs) {
+  static char *keywords[] = {"in", "cx", "cy", "radius", "dt", "out", "mode",
+                             "threads", NULL};
+  PyObject *in_obj, *out_obj = Py_None;
+  PyArrayObject *in, *out;
   float *img, *ret;
-  int dim_x, dim_y;
-  int cx,cy,radius, r2;
+  int rows, cols;
+  int cx, cy, radius;
+  int mode = MODE_FORWARD, threads = 0;
   float dt;
-  
-  if (!PyArg_ParseTuple(args, "Oiiif", &in_obj, &cx, &cy, &radius, &dt)) 
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "Oiiif|Oii", keywords,
+                                   &in_obj, &cx, &cy, &radius, &dt,
+                                   &out_obj, &mode, &threads))
     return NULL;
-  
-  
- 
-  in = (PyArrayObject *) PyArray_FromAny(in_obj, PyArray_DescrFromType(NPY_FLOAT32), 2, 2, 
-    NPY_ARRAY_IN_ARRAY | NPY_ARRAY_ENSUREARRAY, NULL);
-  
-  if (PyArray_NDIM(in) != 2 || PyArray_DTYPE(in)->type_num != NPY_FLOAT32) {
-    PyErr_SetString(PyExc_ValueError,
-                    "array must be two-dimensional and of type float32");
+
+  if (mode != MODE_FORWARD && mode != MODE_INVERSE) {
+    PyErr_SetString(PyExc_ValueError, "mode must be 0 (forward) or 1 (inverse)");
     return NULL;
   }
 
-  out = (PyArrayObject *) PyArray_NewLikeArray(in, NPY_ANYORDER, NULL, 0);
-  if(out == NULL) return NULL;
-  npy_intp *dims = PyArray_DIMS(out);
-  dim_x = dims[0];
-  dim_y = dims[1];
-  r2 = radius*radius;
-  
+  in = (PyArrayObject *) PyArray_FromAny(in_obj, PyArray_DescrFromType(NPY_FLOAT32), 2, 2,
+    NPY_ARRAY_IN_ARRAY | NPY_ARRAY_ENSUREARRAY, NULL);
+  if (in == NULL) return NULL;
+
+  rows = PyArray_DIM(in, 0);
+  cols = PyArray_DIM(in, 1);
+
+  if (out_obj == Py_None) {
+    out = (PyArrayObject *) PyArray_NewLikeArray(in, NPY_CORDER, NULL, 0);
+    if (out == NULL) {
+      Py_DECREF(in);
+      return NULL;
+    }
+  } else {
+    if (!PyArray_Check(out_obj) ||
+        PyArray_TYPE((PyArrayObject *) out_obj) != NPY_FLOAT32 ||
+        PyArray_NDIM((PyArrayObject *) out_obj) != 2 ||
+        PyArray_DIM((PyArrayObject *) out_obj, 0) != rows ||
+        PyArray_DIM((PyArrayObject *) out_obj, 1) != cols ||
+        !PyArray_ISCARRAY((PyArrayObject *) out_obj)) {
+      PyErr_SetString(PyExc_ValueError,
+                      "out must be a writeable, C-contiguous float32 array "
+                      "of the same shape as in");
+      Py_DECREF(in);
+      return NULL;
+    }
+    if (PyArray_DATA((PyArrayObject *) out_obj) == PyArray_DATA(in)) {
+      PyErr_SetString(PyExc_ValueError, "out must not be the input array");
+      Py_DECREF(in);
+      return NULL;
+    }
+    out = (PyArrayObject *) out_obj;
+    Py_INCREF(out);
+  }
+
   img = (float*)PyArray_DATA(in);
   ret = (float*)PyArray_DATA(out);
-  memset(ret, 0, dim_x*dim_y*sizeof(float));
-  
+
 //actual rotation algorithmus--------------------------------------------------
-  int x,y;
-  for(y=0; y<dim_y; ++y) {
-      int y2 = (y-cy) * (y-cy);
-      int last_new_x = -1;
-      int y_offset = y*dim_x;
-      float theta = asin((y-cy)/(float)radius);
-      float angle = calculateRotationInRadians(theta, dt);
-      for(x=0; x<dim_x; ++x) {
-          int dist = (x-cx) * (x-cx) + y2;
-          if(dist > r2) {
-              ret[y_offset + x] = NAN;
-              continue;
-          }
-
-          float z = sqrt(r2 - dist);
-          float rot_x = (x-cx)*cos(angle) - z * sin(angle);
-          float rot_z = (x-cx)*sin(angle) + z * cos(angle);
-          
-          if(rot_z <= 0) {
-              continue;
-          }
-          
-          int new_x = roundf(cx + rot_x);
-          
-          float orig_value = img[y_offset + x];
-          float new_value = ret[y_offset + new_x];
-          if(new_value == 0) new_value = orig_value;
-          else new_value = (orig_value + new_value)/2;
-          if(isnan(new_value)) new_value = 0;
-          ret[y_offset + new_x] = new_value;
-          
-
-          if(new_x > last_new_x+1 && new_x <= cx + dim_x/64) {
-              int i;
-              if(last_new_x == -1) {
-                  for(i=x; i<new_x; ++i) ret[y_offset + i] = 0;
-              } else {
-                  int diff = new_x - last_new_x;
-                  float last_color = ret[y_offset + last_new_x];
-                  float color_diff = ret[y_offset + new_x] - last_color;
-                  float color_step = color_diff / diff;
-                  if(isnan(last_color)) last_color = 0;
-                  if(isnan(color_step)) color_step = 0;
-                  for(i=1; i<diff; ++i)
-                    ret[y_offset + last_new_x+i] = last_color + i*color_step;
-              }
-          }
-          last_new_x = new_x;
-      }
+  /* the sun rotates around the vertical axis, so every row is independent */
+  Py_BEGIN_ALLOW_THREADS
+  int y;
+#ifdef _OPENMP
+  if (threads <= 0) threads = omp_get_max_threads();
+  #pragma omp parallel for schedule(dynamic, 16) num_threads(threads)
+#endif
+  for(y=0; y<rows; ++y) {
+    if (mode == MODE_INVERSE)
+      rotateRowInverse(img + (npy_intp)y*cols, ret + (npy_intp)y*cols, cols, y,
+                       cx, cy, radius, dt);
+    else
+      rotateRowForward(img + (npy_intp)y*cols, ret + (npy_intp)y*cols, cols, y,
+                       cx, cy, radius, dt);
   }
+  Py_END_ALLOW_THREADS
 //-----------------------------------------------------------------------------
 
   Py_DECREF(in);
-  //Py_DECREF(out);
-  
+
   return PyArray_Return(out);
 }
 
-static const char desc[500] = "rotate sun on an image by time\n\
+static const char desc[] = "rotate sun on an image by time\n\
 python function call:\n\
-  ret = native_rotation.rotate(in, cx, cy, radius, dt)\n\
+  ret = native_rotation.rotate(in, cx, cy, radius, dt, out=None, mode=0,\n\
+                               threads=0)\n\
 parameters:\n\
   in: 2d array, numpy, the image with the sphere on it\n\
   cx, xy: pixel offset of the rotation center from top left\n\
   radius: the radius of the sphere in pixels\n\
   dt: the the time in seconds to rotate the sun\n\
+  out: optional float32 array of the same shape to write the result to\n\
+  mode: 0 moves every pixel forward (original algorithm), 1 rotates every\n\
+    output pixel back and interpolates between the source pixels\n\
+  threads: number of OpenMP threads, 0 for all cores\n\
 returns:\n\
-  ret: 2d array of same shape and type as \"in\" with the rotated image";
+  ret: 2d array of same shape and type as \"in\" with the rotated image\n\
+The GIL is released during the rotation.";
 
 static PyMethodDef methods[] = {
-  {"rotate", rotate, METH_VARARGS, desc},
+  {"rotate", (PyCFunction) rotate, METH_VARARGS | METH_KEYWORDS, desc},
   {NULL, NULL, 0, NULL}
 };
 
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef moduledef = {
+  PyModuleDef_HEAD_INIT, "native_rotation", NULL, -1, methods
+};
+
+PyMODINIT_FUNC
+PyInit_native_rotation(void)
+{
+   import_array();
+   return PyModule_Create(&moduledef);
+}
+#else
 PyMODINIT_FUNC
 initnative_rotation(void)
 {
    (void)Py_InitModule("native_rotation", methods);
    import_array();
-}
\ No newline at end of file
+}
+#endif
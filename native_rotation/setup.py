@@ -3,6 +3,8 @@ import numpy
 
 native_rotation = Extension("native_rotation",
                             sources=["native_rotation.c"],
-                            include_dirs=[numpy.get_include()])
+                            include_dirs=[numpy.get_include()],
+                            extra_compile_args=["-O3", "-fopenmp"],
+                            extra_link_args=["-fopenmp"])
 
 setup(name="native_rotation", ext_modules=[native_rotation])
@@ -0,0 +1,221 @@
+"""Parallel extraction over a process pool. The metadata list is split into
+overlapping shards of consecutive frames (the last frame of a shard is the
+first frame of the next one), each shard is processed by one worker exactly
+like the serial path would process it. The frames are downloaded by the
+parent process and handed to the workers through shared memory, so a
+full-frame array is neither pickled nor copied per worker. Results are
+yielded in time order.
+
+Shared memory requires Python 3.8 or newer.
+"""
+from __future__ import print_function
+
+import multiprocessing
+
+import numpy as np
+import astropy.io.fits as fits
+
+import cutout_store
+import downloader
+import instrumentation
+import pipeline
+from hmi_magnetogram import HMIMagnetogram
+import params
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+
+def shard_metadata(metadata, shard_frames=None):
+    """Splits 'metadata' into shards of at most 'shard_frames' (default:
+    params.PARALLEL_SHARD_FRAMES) frames, every shard repeats the last frame
+    of its predecessor.
+    """
+    if shard_frames is None:
+        shard_frames = params.PARALLEL_SHARD_FRAMES
+    step = max(1, shard_frames - 1)
+    return [metadata[start:start + step + 1]
+            for start in range(0, max(1, len(metadata) - 1), step)]
+
+
+class SharedFrame:
+    """A decoded magnetogram whose data lives in a shared memory block. Only
+    the name of the block and the FITS header are pickled.
+    """
+
+    def __init__(self, mag):
+        self.shape = mag.data.shape
+        self.dtype = mag.data.dtype.str
+        self.header = mag.header.tostring()
+        self._shm = shared_memory.SharedMemory(create=True,
+                                               size=mag.data.nbytes)
+        self.name = self._shm.name
+        np.ndarray(self.shape, self.dtype, self._shm.buf)[:] = mag.data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_shm"]
+        return state
+
+    def attach(self):
+        """Worker side: attaches to the shared memory block. The block has to
+        be closed after its magnetogram is not used anymore.
+        """
+        return _attach(self.name)
+
+    def magnetogram(self, shm):
+        """Worker side: returns a magnetogram whose data is a view into the
+        attached block 'shm'.
+        """
+        data = np.ndarray(self.shape, self.dtype, shm.buf)
+        return HMIMagnetogram.from_array(data, fits.Header.fromstring(
+            self.header))
+
+    def release(self):
+        """Parent side: frees the shared memory block."""
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before Python 3.13 every attach is registered at the resource
+        # tracker, which would unlink the block when the worker exits
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _init_worker(rotation_threads, tile_threads):
+    # the workers share the cores, no oversubscription by OpenMP or the
+    # tile threads of img_operations
+    params.ROTATION_THREADS = rotation_threads
+    params.TILE_THREADS = tile_threads
+    # records go to the shared log, the totals are returned to the parent,
+    # which writes the Prometheus file
+    instrumentation.configure(params.METRICS_LOG,
+                              enabled=instrumentation.get().enabled)
+
+
+def _process_shard(shard, as_json=None):
+    """Worker: processes the frame pairs of one shard, returns a list of
+    (metadata, features) tuples in time order and the metrics totals of the
+    shard.
+    """
+    blocks = [None if frame is None else frame.attach()
+              for meta, frame in shard]
+    mags = [None if shm is None else frame.magnetogram(shm)
+            for (meta, frame), shm in zip(shard, blocks)]
+
+    results = []
+    try:
+        if params.INCREMENTAL_SMOOTHING and params.USE_DELTA_MAGNETOGRAM \
+                and mags and mags[0] is not None:
+            # the serial path smoothed the boundary frame as the current
+            # frame of the previous pair, before it got rotated
+            mags[0].get_smoothed()
+
+        mag_t1 = mags[0]
+        for k in range(1, len(shard)):
+            meta = shard[k][0]
+            try:
+                if mag_t1 is None:
+                    # like the serial path: the frame of a failed pair is
+                    # downloaded again as the first frame of the next pair
+                    last = shard[k - 1][0]
+                    mag_t1 = downloader.url2magnetogram(
+                        last["url"], date_obs=last.get("date_obs"))
+                mag_t0 = mag_t1
+                mag_t1 = mags[k]
+                if mag_t0 is None or mag_t1 is None:
+                    raise ValueError("magnetogram could not be downloaded")
+                # the rotation replaces the data of the previous magnetogram,
+                # the shared block stays untouched for the neighbouring shard
+                features = pipeline.process_pair(mag_t0, mag_t1,
+                                                 meta["date_obs"], as_json)
+            except Exception:
+                print("Error while processing %s:\n%s" % (
+                    meta["date_obs"], instrumentation.get().error(
+                        "process", meta["date_obs"])))
+                mag_t1 = None
+            else:
+                results.append((meta, features))
+        # the workers exit without closing their cutout files
+        cutout_store.flush()
+    finally:
+        # views into the blocks have to be gone before closing them
+        del mags[:]
+        mag_t0 = mag_t1 = None
+        for shm in blocks:
+            if shm is not None:
+                shm.close()
+    return results, instrumentation.get().take_totals()
+
+
+def extract_parallel(metadata, processes=None, shard_frames=None,
+                     as_json=None):
+    """Processes 'metadata' on a pool of 'processes' workers (default:
+    params.PARALLEL_PROCESSES, 0: one per core). Yields the same
+    (metadata, features) tuples as pipeline.extract_serial, in time order.
+    """
+    if shared_memory is None:
+        raise RuntimeError("parallel extraction requires Python 3.8+")
+    if processes is None:
+        processes = params.PARALLEL_PROCESSES
+    if processes is None or processes < 1:
+        processes = multiprocessing.cpu_count()
+
+    # frames are identified by their position in 'metadata', not by their
+    # URL, which may appear twice
+    shards = shard_metadata(list(range(len(metadata))), shard_frames)
+    # bounds the number of frames held in shared memory
+    max_pending = 2 * processes
+
+    share = max(1, multiprocessing.cpu_count() // processes)
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (params.ROTATION_THREADS or share,
+                                 params.TILE_THREADS or share))
+    prefetcher = downloader.MagnetogramPrefetcher(
+        metadata, prefetch=params.PREFETCH_FRAMES * processes,
+        workers=processes)
+    pending = []
+    frames = {}
+    try:
+        frame_iter = iter(prefetcher)
+        for num, shard in enumerate(shards):
+            shared = []
+            for k in shard:
+                if k not in frames:
+                    mag = next(frame_iter)[1]
+                    frames[k] = None if mag is None else SharedFrame(mag)
+                shared.append((metadata[k], frames[k]))
+            pending.append((shard, pool.apply_async(_process_shard,
+                                                    (shared, as_json))))
+            print("submitted shard %d of %d (%s - %s)" % (
+                num + 1, len(shards), metadata[shard[0]]["date_obs"],
+                metadata[shard[-1]]["date_obs"]))
+
+            while len(pending) >= max_pending or \
+                    (num == len(shards) - 1 and pending):
+                done_shard, result = pending.pop(0)
+                results, totals = result.get()
+                instrumentation.get().merge(totals)
+                for item in results:
+                    yield item
+                # the boundary frame is still needed by the next shard
+                for k in done_shard[:-1]:
+                    frame = frames.pop(k)
+                    if frame is not None:
+                        frame.release()
+    finally:
+        prefetcher.close()
+        pool.terminate()
+        pool.join()
+        for frame in frames.values():
+            if frame is not None:
+                frame.release()
@@ -17,3 +17,152 @@ SG_THRESHOLD = 50.0
 # time range to process
 START = datetime(2014, 1, 1, 0)
 END = datetime(2014, 1, 1, 1)
+
+# services of the FlareCast pipeline (sources.py)
+HMI_SERVICE = "http://hmi:8001/HMI/720"
+PROPERTY_SERVICE = "http://property:8002"
+
+# download stage
+PREFETCH_FRAMES = 2  # frames downloaded ahead of the extraction
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 0.5  # seconds, doubled on every retry
+DOWNLOAD_TIMEOUT = 60  # seconds
+DOWNLOAD_POOL_SIZE = 4  # connections kept alive per host
+
+# parallel extraction
+PARALLEL_PROCESSES = 1  # 1: serial extraction, None: one per core
+PARALLEL_SHARD_FRAMES = 8  # frames per shard, including the repeated one
+
+# insert stage
+INSERT_BATCH_SIZE = 200  # features per insert request
+INSERT_FLUSH_INTERVAL = 30  # seconds a feature may wait in the buffer
+INSERT_RETRIES = 3
+INSERT_BACKOFF = 1  # seconds, doubled on every retry
+INSERT_QUEUE_SIZE = 16  # frames waiting for the insert worker
+
+# geometry cache, header values are rounded to these steps before building
+# disk masks, cosine and coordinate maps
+GEOMETRY_CACHE_MAX_BYTES = 1024 ** 3
+GEOMETRY_CACHE_DIR = None  # directory for memory-mapped arrays, optional
+GEOMETRY_PIXEL_QUANTUM = 0.1  # pixel, CRPIX
+GEOMETRY_SCALE_QUANTUM = 1e-5  # arcsec/pixel, CDELT
+GEOMETRY_ANGLE_QUANTUM = 0.01  # arcsec, CRVAL
+GEOMETRY_DISTANCE_QUANTUM = 1e7  # meter, DSUN_OBS
+
+# compute coordinate maps only inside the feature bounding boxes (float32),
+# instead of converting the full frame with sunpy
+LAZY_COORDINATES = True
+
+# use the rotated previous magnetogram to remove changing regions from the
+# feature masks, off: every magnetogram is compared with itself
+USE_DELTA_MAGNETOGRAM = False
+# rotate the smoothed previous magnetogram instead of smoothing the rotated
+# one (only with USE_DELTA_MAGNETOGRAM), see img_operations.smoothing_difference
+INCREMENTAL_SMOOTHING = True
+
+# characterize all features of a magnetogram at once (feature_batch) instead
+# of one SMARTFeature.from_hmi call per feature
+BATCH_FEATURES = True
+
+# keep the arrays of the feature cutouts (mask, flux maps, polarity separation
+# lines, see smart_feature.ARRAYS) in every SMARTFeature; otherwise only the
+# scalars, shape and contour are kept and SMARTFeature.arrays recomputes them
+KEEP_FEATURE_ARRAYS = False
+
+# polarity separation lines: "thinning" (Zhang-Suen) or "legacy"
+# (morphological skeleton of the original implementation)
+PSL_THINNING = "thinning"
+PSL_THINNING_MAX_ITERATIONS = 100  # thinning passes, each removes one layer
+
+# differential rotation (native_rotation): "forward" moves every pixel to its
+# rotated position (original algorithm), "inverse" interpolates every output
+# pixel from its source position
+ROTATION_MODE = "forward"
+ROTATION_THREADS = 0  # OpenMP threads, 0 = all cores
+# "native" (C extension) or "remap" (cached cv2.remap tables, inverse mode
+# only, see rotation.py); "remap" is used if the C extension is not built
+ROTATION_METHOD = "native"
+ROTATION_CACHE_MAX_BYTES = 512 * 1024 ** 2
+ROTATION_CACHE_DIR = None  # directory for memory-mapped tables, optional
+ROTATION_DT_QUANTUM = 1.0  # seconds, time differences are rounded to it
+
+# feature detection: "full" resolution or "pyramid" (candidates on a frame
+# downsampled by PYRAMID_FACTOR, contours at full resolution around them)
+DETECTION = "full"
+PYRAMID_FACTOR = 4
+PYRAMID_MARGIN = 4  # downsampled pixels added around every candidate
+PYRAMID_MAX_GROW = 3  # regrowing of windows cutting a contour
+
+# circular dilations (img_operations.dilate_circle): "distance" (distance
+# transform in windows around the set pixels) or "kernel" (cv2.dilate),
+# both give identical masks
+DILATION_METHOD = "distance"
+DILATION_BLOCK_SIZE = 32  # pixel, grid used to find the windows
+
+# full frame smoothing, thresholding, cosine correction and dilations on
+# tiles of TILE_SIZE pixels in a thread pool (img_operations), tiles off the
+# disk are skipped; identical results, 0 = one call over the whole frame
+TILE_SIZE = 256
+TILE_THREADS = 0  # 0 = all cores
+
+# local magnetogram cache (magnetogram_cache.py), off if the directory is None
+MAGNETOGRAM_CACHE_DIR = None
+MAGNETOGRAM_CACHE_MAX_BYTES = 50 * 1024 ** 3
+# store decoded float32 frames (memory-mapped on a hit) instead of FITS files
+MAGNETOGRAM_CACHE_DECODED = False
+
+# instrumentation (instrumentation.py), off if both files are None:
+# JSON-lines log of every stage, counter and error
+METRICS_LOG = None
+# totals in the Prometheus text format, e.g. for the node exporter
+METRICS_PROMETHEUS_FILE = None
+METRICS_INTERVAL = 15  # seconds between rewrites of the Prometheus file
+
+# feature tracking (tracking.py), serial extraction only
+TRACKING = False
+TRACKING_MIN_OVERLAP = 0.1  # shared pixels / pixels of the smaller feature
+TRACKING_MAX_DISTANCE = 2.0  # degrees, links features without overlap
+TRACKING_MAX_MISSED = 2  # frames a track may be missing before it ends
+TRACKING_GRID_CELL = 5.0  # degrees, cell size of the spatial index
+
+# checkpoints of extraction runs (checkpoint.py), off if the file is None
+CHECKPOINT_FILE = None
+CHECKPOINT_INTERVAL = 10  # frames between checkpoints
+# skip frames whose features the property service already holds
+CHECKPOINT_SKIP_STORED = True
+CHECKPOINT_QUERY = "/region/%s/list"  # property service, % provenance
+CHECKPOINT_TIME_TOLERANCE = 120  # seconds between date_obs and T_REC
+
+# columnar feature output (feature_store.py) instead of the property service,
+# off if the directory is None
+FEATURE_STORE_DIR = None
+FEATURE_STORE_FORMAT = "npz"  # "npz" or "parquet" (requires pyarrow)
+FEATURE_STORE_BATCH_FRAMES = 100  # frames per file
+
+# local archive of HMI FITS files (sources.LocalArchiveSource)
+ARCHIVE_PATTERN = "*.fits"
+ARCHIVE_SCAN_WORKERS = 8  # threads walking directories and reading headers
+
+# near-real-time daemon (daemon.py, main.py --daemon)
+DAEMON_POLL_INTERVAL = 10  # seconds between polls of the source
+DAEMON_MAX_BACKOFF = 300  # seconds, the interval doubles after failed polls
+DAEMON_LOOKBACK = 3600  # seconds, missing frames processed on start
+DAEMON_LATENCY_WINDOW = 100  # frames in Daemon.latency_summary
+# frames waiting for their insertion, the latency of older ones (e.g. of
+# failed inserts) is not recorded
+DAEMON_MAX_PENDING = 1000
+
+# export of the feature cutouts to HDF5 files (cutout_store.py, requires
+# h5py), off if the directory is None
+CUTOUT_STORE_DIR = None
+# "data" (the magnetogram) and any of smart_feature.ARRAYS
+CUTOUT_ARRAYS = ("data", "mask", "phi_map", "psl_mask", "psl_thin_mask")
+CUTOUT_BATCH_FRAMES = 10  # frames appended at once
+CUTOUT_CHUNK = 65536  # elements per chunk of the flat datasets
+
+# quicklook images (quicklook.py), the pipeline writes a PNG of every frame
+# with its features to QUICKLOOK_DIR, off if the directory is None
+QUICKLOOK_DIR = None
+QUICKLOOK_SIZE = (1024, 1024)  # pixels (width, height), None = full size
+QUICKLOOK_PROCESSES = None  # quicklook.render_sequence, None = one per core
+QUICKLOOK_FPS = 24  # quicklook.make_video
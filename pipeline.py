@@ -0,0 +1,193 @@
+"""Processing steps of the SMART pipeline which are shared by the serial and
+the parallel extraction: differential rotation of the previous magnetogram,
+feature extraction and characterization of the current one.
+"""
+from __future__ import print_function
+
+import threading
+
+import numpy as np
+
+import cutout_store
+import downloader
+import feature_batch
+import instrumentation
+from smart_feature import SMARTFeature
+import params
+import quicklook
+import rotation
+import tracking
+
+try:
+    from native_rotation import native_rotation
+except ImportError:
+    native_rotation = None
+
+
+def process_pair(mag_t0, mag_t1, frame=None, as_json=None):
+    """Extracts the features of mag_t1 and returns them as JSON dicts, or as
+    SMARTFeature instances if 'as_json' is false (e.g. for a feature store,
+    see the json_features attribute of the sinks).
+
+    mag_t0: The previous magnetogram, its data gets differentially rotated
+      to the time of mag_t1 (the array is replaced by the rotation buffer of
+      the thread, not modified).
+    mag_t1: The magnetogram to extract the features from.
+    frame: Identifies mag_t1 in the metrics (e.g. its date_obs).
+    as_json: default: params.FEATURE_STORE_DIR is None
+    """
+    metrics = instrumentation.get()
+
+    # differential rotation
+    delta_time = (mag_t1.time - mag_t0.time).total_seconds()
+    with metrics.stage("rotate", frame):
+        mag_t0.data = _rotate(mag_t0, mag_t0.data, delta_time)
+
+        # incremental smoothing: the smoothed map of mag_t0 is left over
+        # from the previous pair, rotate it instead of smoothing the rotated
+        # data
+        smoothed_t0 = None
+        if params.INCREMENTAL_SMOOTHING and params.USE_DELTA_MAGNETOGRAM and \
+                mag_t0.smoothed is not None:
+            smoothed_t0 = _rotate(mag_t0, mag_t0.smoothed, delta_time,
+                                  "smoothed")
+            smoothed_t0 = np.nan_to_num(smoothed_t0, copy=False)
+
+    # feature extraction
+    with metrics.stage("contour", frame):
+        contours = mag_t1.get_contours(mag_t0, smoothed_t0)
+
+    cutouts = cutout_store.get()
+    keep_arrays = params.KEEP_FEATURE_ARRAYS
+    if cutouts is not None and not keep_arrays:
+        # the arrays of the cutout store are built by the characterization
+        # and released once they are written
+        keep_arrays = cutouts.feature_arrays
+
+    with metrics.stage("characterize", frame):
+        if params.BATCH_FEATURES:
+            features = feature_batch.features_from_hmi(
+                mag_t1, contours, delta_time, mag_t0, keep_arrays)
+        else:
+            features = [SMARTFeature.from_hmi(mag_t1, j, contour, delta_time,
+                                              mag_t0, keep_arrays)
+                        for j, contour in enumerate(contours)]
+
+    if cutouts is not None:
+        with metrics.stage("cutouts", frame):
+            cutouts.write(features, mag_t1)
+        if not params.KEEP_FEATURE_ARRAYS:
+            for feature in features:
+                feature.release_arrays()
+
+    if params.QUICKLOOK_DIR is not None:
+        with metrics.stage("quicklook", frame):
+            quicklook.write(mag_t1, features, params.QUICKLOOK_DIR)
+
+    if as_json is None:
+        as_json = params.FEATURE_STORE_DIR is None
+    if as_json:
+        features = [feature.json() for feature in features]
+
+    metrics.count("features", len(features), frame)
+    return features
+
+
+_ROTATION_MODES = {"forward": 0, "inverse": 1}
+_buffers = threading.local()
+
+
+def _rotate(mag, data, delta_time, buffer_name="data"):
+    # the rotated previous magnetogram is only needed until the next pair, so
+    # every thread rotates into the same output buffer again
+    out = getattr(_buffers, buffer_name, None)
+    if out is None or out.shape != data.shape:
+        out = np.empty(data.shape, np.float32)
+        setattr(_buffers, buffer_name, out)
+    if out is data:
+        out = None
+    if params.ROTATION_METHOD == "remap" or native_rotation is None:
+        return rotation.rotate(data, int(mag.disk_center[0]),
+                               int(mag.disk_center[1]), int(mag.disk_radius),
+                               delta_time, out)
+    return native_rotation.rotate(
+        data,
+        int(mag.disk_center[0]),
+        int(mag.disk_center[1]),
+        int(mag.disk_radius),
+        delta_time,
+        out=out,
+        mode=_ROTATION_MODES[params.ROTATION_MODE],
+        threads=params.ROTATION_THREADS
+    )
+
+
+def extract_serial(metadata, tracker=None, checkpoint=None, first_mag=None,
+                   as_json=None):
+    """Processes all frames of 'metadata' in order. Yields a tuple
+    (metadata, features) for every frame, except the first one, whose
+    features could be extracted. With a tracking.Tracker the track ID of
+    every feature is added to its data as "track_id", a checkpoint.Checkpoint
+    is offered every processed frame. 'first_mag' is the magnetogram of the
+    first frame, if it is already loaded (e.g. from a checkpoint). 'as_json'
+    selects the type of the features, see process_pair.
+    """
+    # frames are downloaded and decoded in the background, while the
+    # previous pair is processed
+    prefetcher = downloader.MagnetogramPrefetcher(
+        metadata if first_mag is None else metadata[1:])
+    with prefetcher:
+        frames = iter(prefetcher)
+        if first_mag is None:
+            last_i, mag_t1 = next(frames)
+        else:
+            last_i, mag_t1 = metadata[0], first_mag
+
+        for num, (i, mag) in enumerate(frames):
+            print("processing magnetogram %d of %d (%s)" % (
+                num + 1, len(metadata) - 1, i["date_obs"]))
+
+            try:
+                if mag_t1 is None:
+                    mag_t1 = downloader.url2magnetogram(
+                        last_i["url"], prefetcher.session,
+                        last_i.get("date_obs"))
+                mag_t0 = mag_t1
+                mag_t1 = mag
+                features = process_pair(mag_t0, mag_t1, i["date_obs"],
+                                        as_json)
+                if tracker is not None:
+                    track_features(tracker, mag_t1, features,
+                                   i["date_obs"])
+                if checkpoint is not None:
+                    checkpoint.offer(i, mag_t1, tracker)
+            except Exception:
+                print("Error while processing %s:\n%s" % (
+                    i["date_obs"], instrumentation.get().error(
+                        "process", i["date_obs"])))
+                mag_t1 = None
+            else:
+                yield i, features
+
+            last_i = i
+
+
+def track_features(tracker, mag, features, frame):
+    """Adds the track IDs of 'tracker' to the features of 'mag' (JSON dicts
+    or SMARTFeature instances).
+    """
+    if features and isinstance(features[0], dict):
+        observations = [tracking.Observation.from_json(f) for f in features]
+    else:
+        observations = [tracking.Observation.from_feature(f)
+                        for f in features]
+    track_ids = tracker.update(mag.time, observations, mag.disk_center,
+                               mag.disk_radius)
+    for feature, track_id in zip(features, track_ids):
+        if isinstance(feature, dict):
+            feature["data"]["track_id"] = track_id
+        else:
+            feature.track_id = track_id
+    metrics = instrumentation.get()
+    for event in tracker.events:
+        metrics.count("track_" + event["event"], 1, frame)
@@ -0,0 +1,139 @@
+"""Quicklook images and movies of magnetograms with their features.
+
+render() draws the magnetogram (HMIMagnetogram.as_image, gray levels from a
+lookup table) with the contours and classes of its features, the color
+shows the growth (red: emerging, blue: decaying), large features are drawn
+thicker. With params.QUICKLOOK_DIR set, the pipeline writes the PNG of every
+frame while the magnetogram is in memory anyway; render_sequence() renders
+already extracted frames with a process pool. make_video() joins the PNG
+files of a directory into a movie.
+
+Usage:
+  quicklook.render_sequence([(url, features), ...], "/data/quicklook")
+  quicklook.make_video("/data/quicklook", "/data/quicklook.mp4")
+"""
+from __future__ import print_function
+
+import glob
+import json
+import multiprocessing
+import os
+import tempfile
+import traceback
+
+import cv2
+
+import downloader
+import img_operations
+import params
+
+# BGR colors by the growth letter of the class
+_COLORS = {"E": (0, 0, 255), "D": (255, 128, 0)}
+
+
+def _overlay(feature):
+    """The contour and class of a SMARTFeature or a JSON dict."""
+    if isinstance(feature, dict):
+        contour = feature["data"]["contour"]
+        if not isinstance(contour, list):
+            contour = json.loads(contour)
+        return contour, feature["data"]["class"]
+    return feature.contour, feature.classification()
+
+
+def render(mag, features=(), size=None):
+    """BGR image of the magnetogram 'mag' resized to 'size' (default:
+    params.QUICKLOOK_SIZE), with the contours and class labels of 'features'
+    (SMARTFeature instances or JSON dicts) and the time of the frame.
+    """
+    if size is None:
+        size = params.QUICKLOOK_SIZE
+    image = cv2.cvtColor(mag.as_image(size), cv2.COLOR_GRAY2BGR)
+    overlays = [_overlay(feature) for feature in features]
+    contours = img_operations.scale_contours([c for c, _ in overlays],
+                                             mag.shape, size)
+    for contour, (_, label) in zip(contours, overlays):
+        color = _COLORS.get(label[2:3], (255, 255, 255))
+        cv2.drawContours(image, [contour], -1, color,
+                         2 if label[1:2] == "L" else 1)
+        x, y, _, _ = cv2.boundingRect(contour)
+        cv2.putText(image, label, (x, max(10, y - 3)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, color, 1, cv2.LINE_AA)
+    cv2.putText(image, mag.time.strftime("%Y-%m-%d %H:%M:%S"), (10, 20),
+                cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 1,
+                cv2.LINE_AA)
+    return image
+
+
+def write(mag, features, directory, size=None):
+    """Renders the frame to a PNG file in 'directory', named after its time
+    so the files sort in time order. Returns the path.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, "quicklook_%s.png" %
+                        mag.time.strftime("%Y%m%dT%H%M%S"))
+    ok, png = cv2.imencode(".png", render(mag, features, size))
+    if not ok:
+        raise IOError("%s could not be encoded" % path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(png.tobytes())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return path
+
+
+def _render_frame(task):
+    url, features, directory, size = task
+    try:
+        return write(downloader.url2magnetogram(url), features, directory,
+                     size)
+    except Exception:
+        print("Error while rendering %s:\n%s" % (url,
+                                                 traceback.format_exc()))
+        return None
+
+
+def render_sequence(frames, directory, size=None, processes=None):
+    """Renders the frames, (url, features) tuples, to PNG files in
+    'directory' with 'processes' processes (default:
+    params.QUICKLOOK_PROCESSES, None there: one per core). Returns the paths
+    in the order of 'frames', None for failed frames.
+    """
+    if processes is None:
+        processes = params.QUICKLOOK_PROCESSES
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_render_frame, [(url, features, directory, size)
+                                        for url, features in frames],
+                        chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def make_video(directory, path, fps=None):
+    """Joins the PNG files of 'directory' in time order into the MPEG-4
+    movie 'path' (default: params.QUICKLOOK_FPS frames per second). Returns
+    the number of frames.
+    """
+    if fps is None:
+        fps = params.QUICKLOOK_FPS
+    paths = sorted(glob.glob(os.path.join(directory, "quicklook_*.png")))
+    writer = None
+    try:
+        for png in paths:
+            image = cv2.imread(png)
+            if writer is None:
+                writer = cv2.VideoWriter(
+                    path, cv2.VideoWriter_fourcc(*"mp4v"), fps,
+                    (image.shape[1], image.shape[0]))
+            writer.write(image)
+    finally:
+        if writer is not None:
+            writer.release()
+    return len(paths)
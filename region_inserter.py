@@ -0,0 +1,168 @@
+"""Insert stage of the SMART pipeline. Features of several frames are buffered
+and written to the property service in batches by a background thread, so
+the extraction loop never waits for a database round-trip.
+"""
+from __future__ import print_function
+
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import instrumentation
+import params
+
+_CLOSE = object()
+_FLUSH = object()
+
+
+class InsertError(Exception):
+    pass
+
+
+class RegionInserter:
+    """Buffers features and inserts them with client.insert_regions.
+
+    A batch is flushed as soon as it holds 'batch_size' features or its
+    oldest feature waited 'flush_interval' seconds. Failed inserts are
+    retried 'retries' times with exponential backoff; batches which still
+    fail are collected in 'failed_batches' instead of aborting the run.
+    'add' blocks if 'queue_size' frames are waiting, which keeps the memory
+    bounded if the property service is slower than the extraction.
+    'on_inserted' is called with the list of frames of every inserted batch,
+    including frames without features, on the worker thread (e.g.
+    Checkpoint.inserted). The defaults are the params.INSERT_* values.
+
+    Usage:
+      with RegionInserter(client) as inserter:
+          inserter.add(features, frame=date_obs)
+    """
+
+    def __init__(self, client, provenance="smart-python", batch_size=None,
+                 flush_interval=None, retries=None, queue_size=None,
+                 on_inserted=None):
+        self.client = client
+        self.on_inserted = on_inserted
+        self.provenance = provenance
+        self.batch_size = params.INSERT_BATCH_SIZE if batch_size is None \
+            else batch_size
+        self.flush_interval = params.INSERT_FLUSH_INTERVAL \
+            if flush_interval is None else flush_interval
+        self.retries = params.INSERT_RETRIES if retries is None else retries
+        if queue_size is None:
+            queue_size = params.INSERT_QUEUE_SIZE
+        # list of (frames, features, error message) tuples
+        self.failed_batches = []
+        self.inserted_features = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._run,
+                                        name="smart-insert")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, features, frame=None):
+        """Queues the features of one frame, 'frame' identifies the frame in
+        failure reports (e.g. its date_obs).
+        """
+        self._queue.put((frame, features))
+
+    def _run(self):
+        frames = []
+        features = []
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _CLOSE:
+                if frames:
+                    self._flush(frames, features)
+                return
+
+            if item is _FLUSH:
+                if frames:
+                    self._flush(frames, features)
+                frames = []
+                features = []
+                deadline = None
+                continue
+
+            if item is not None:
+                frames.append(item[0])
+                features.extend(item[1])
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+
+            if len(features) >= self.batch_size or \
+                    (deadline is not None and time.time() >= deadline):
+                if frames:
+                    self._flush(frames, features)
+                frames = []
+                features = []
+                deadline = None
+
+    def _flush(self, frames, features):
+        """Inserts 'features' and reports 'frames' to on_inserted, frames
+        without features as well.
+        """
+        if features and not self._insert(frames, features):
+            return
+        if self.on_inserted is not None:
+            self.on_inserted(frames)
+
+    def _insert(self, frames, features):
+        """Returns whether the features could be inserted."""
+        metrics = instrumentation.get()
+        error = None
+        with metrics.stage("insert", frames[-1]):
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    metrics.count("insert_retries", 1, frames[-1])
+                    time.sleep(params.INSERT_BACKOFF * 2 ** (attempt - 1))
+                try:
+                    answer = self.client.insert_regions(self.provenance,
+                                                        features)
+                    if "message" in answer:
+                        raise InsertError(answer["message"])
+                except Exception as e:
+                    error = str(e)
+                    trace = traceback.format_exc()
+                else:
+                    self.inserted_features += len(features)
+                    metrics.count("inserted_features", len(features),
+                                  frames[-1])
+                    break
+            else:
+                print("error while inserting property groups of %d frames "
+                      "(%s - %s): %s" % (len(frames), frames[0], frames[-1],
+                                         error))
+                print(metrics.error("insert", frames[-1], trace))
+                self.failed_batches.append((frames, features, error))
+                return False
+        return True
+
+    def flush(self):
+        """Inserts the features added so far without waiting for the batch
+        to fill up (e.g. in the daemon, after every frame).
+        """
+        self._queue.put(_FLUSH)
+
+    def close(self):
+        """Flushes the buffered features and waits for the worker thread."""
+        self._queue.put(_CLOSE)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,125 @@
+"""Differential rotation with precomputed remap tables. HMI magnetograms
+arrive at a fixed cadence, so the rotation is called again and again with the
+same geometry and time difference. The source column of every output pixel
+is computed once per (shape, cx, cy, radius, dt), cached (LRU, optionally
+persisted to params.ROTATION_CACHE_DIR) and applied with cv2.remap, so a
+cached rotation is a single table lookup pass over the frame.
+
+The result follows the inverse mode of native_rotation.rotate: every output
+pixel is interpolated linearly along its row from its source position,
+pixels rotating in from the far side are 0 and off-disk pixels NaN. OpenCV
+quantizes the interpolation weights to 1/32 pixel, so values differ from the
+native inverse mode by at most 1/64 of the difference of neighbouring source
+pixels. This module only needs NumPy and OpenCV and is the fallback if the C
+extension is not built.
+"""
+import numpy as np
+
+import cv2
+
+import geometry_cache
+import params
+
+# source column of the pixels rotating in from the far side, outside of the
+# image so cv2.remap fills them with the border value 0
+_FAR_SIDE = -2.0
+
+_tables = geometry_cache.GeometryCache(params.ROTATION_CACHE_MAX_BYTES,
+                                       params.ROTATION_CACHE_DIR)
+
+
+def rotation_angles(rows, cy, radius, dt):
+    """Rotation angle in radians of every row, like
+    calculateRotationInRadians of native_rotation.
+    """
+    with np.errstate(invalid="ignore"):
+        latitude = np.arcsin((np.arange(rows) - cy) / float(radius))
+    return differential_angle(latitude, dt)
+
+
+def differential_angle(latitude, dt):
+    """Rotation angle in radians at 'latitude' (radians) after 'dt'
+    seconds.
+    """
+    sin2l = np.sin(latitude) ** 2
+    return 1.0e-6 * dt * (2.894 - 0.428 * sin2l - 0.37 * sin2l * sin2l)
+
+
+def source_columns(shape, cx, cy, radius, dt):
+    """Returns the remap table: the (fractional) source column of every
+    pixel, -2 for pixels rotating in from the far side and off-disk pixels.
+    """
+    rows, cols = shape
+    y = np.arange(rows)[:, None] - cy
+    x = (np.arange(cols) - cx).astype(np.float64)[None, :]
+    dist = x * x + y * y
+    off_disk = dist > radius * radius
+    z = np.sqrt(np.where(off_disk, 0, radius * radius - dist))
+
+    angle = rotation_angles(rows, cy, radius, dt)[:, None]
+    cos_angle = np.cos(angle)
+    sin_angle = np.sin(angle)
+    source_x = x * cos_angle + z * sin_angle
+    source_z = z * cos_angle - x * sin_angle
+
+    columns = (cx + source_x).astype(np.float32)
+    columns[off_disk | ~(source_z > 0)] = _FAR_SIDE
+    return columns
+
+
+def _off_disk(shape, cx, cy, radius):
+    y = np.arange(shape[0])[:, None] - cy
+    x = np.arange(shape[1])[None, :] - cx
+    return x * x + y * y > radius * radius
+
+
+def _rows(shape):
+    return np.repeat(np.arange(shape[0], dtype=np.float32)[:, None],
+                     shape[1], axis=1)
+
+
+def rotate(data, cx, cy, radius, dt, out=None):
+    """Rotates 'data' by 'dt' seconds, the parameters are the same as for
+    native_rotation.rotate. 'out' is an optional float32 output array.
+    """
+    data = np.asarray(data, np.float32)
+    shape = data.shape
+    dt = geometry_cache.quantize(dt, params.ROTATION_DT_QUANTUM)
+    key = (shape, cx, cy, radius)
+    columns = _tables.get("rotation_columns", key + (dt,),
+                          lambda: source_columns(shape, cx, cy, radius, dt))
+    rows = _tables.get("rotation_rows", (shape,), lambda: _rows(shape))
+    off_disk = _tables.get("rotation_off_disk", key,
+                           lambda: _off_disk(shape, cx, cy, radius))
+
+    out = cv2.remap(data, columns, rows, cv2.INTER_LINEAR, dst=out,
+                    borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    # cv2.remap interpolates between rows as well, with zero weight, but a
+    # NaN neighbour row still yields NaN: interpolate these pixels along
+    # their row, using the valid neighbour if the other one is NaN
+    invalid_rows, invalid_cols = np.nonzero(np.isnan(out))
+    if len(invalid_rows):
+        position = columns[invalid_rows, invalid_cols].astype(np.float64)
+        left = np.floor(position).astype(np.intp)
+        weight = position - left
+        a = _take(data, invalid_rows, left)
+        b = _take(data, invalid_rows, left + 1)
+        value = a + weight * (b - a)
+        value = np.where(np.isnan(a), b, np.where(np.isnan(b), a, value))
+        out[invalid_rows, invalid_cols] = np.nan_to_num(value)
+
+    np.copyto(out, np.nan, where=off_disk)
+    return out
+
+
+def _take(data, rows, cols):
+    valid = (cols >= 0) & (cols < data.shape[1])
+    values = np.full(len(rows), np.nan, np.float32)
+    values[valid] = data[rows[valid], cols[valid]]
+    return values
+
+
+def table_cache():
+    """Returns the cache of the remap tables."""
+    return _tables
@@ -2,21 +2,64 @@
 Represents one feature produced by the feature extraction algorithm of SMART.
 """
 import numpy as np
-import scipy.stats
-import scipy
 import iso8601
 import json
 
 import cv2
 
-import img_operations
-import params
+import feature_batch
+
+
+# the arrays of a feature cutout, kept only with keep_arrays (see arrays())
+ARRAYS = ("mask", "cos_map", "abs_data", "hg_longitude_map",
+          "hg_latitude_map", "area_map", "phi_map", "phi_delta", "psl_mask",
+          "psl_thin_mask")
+
+
+def _array_property(name):
+    def get(self):
+        try:
+            return self._arrays[name]
+        except KeyError:
+            pass
+        if name == "mask" and self.contour is not None:
+            return self._contour_mask()
+        raise AttributeError(
+            "%s of feature %s is not kept (params.KEEP_FEATURE_ARRAYS), "
+            "use arrays() to recompute it" % (name, self.index))
+
+    def set(self, value):
+        self._arrays[name] = value
+
+    return property(get, set)
+
+
+class SMARTFeature(object):
+    """The scalar properties, position, shape and contour of a feature. The
+    arrays of the cutout (ARRAYS) are only kept if the feature was created
+    with keep_arrays, otherwise arrays() recomputes them from the
+    magnetograms, so features of many frames fit into little memory. The
+    mask is drawn from the contour if it is not kept.
+    """
+    __slots__ = ("id", "contour", "phi_imb", "WL_sg_star", "R_star",
+                 "SG_len", "PSL_len", "phi_net_emrg", "phi_abs", "phi_neg",
+                 "phi_pos", "area", "kurtosis", "skewness", "variance",
+                 "mean", "abs_sum", "sum", "min", "max", "position", "time",
+                 "index", "shape", "track_id", "_arrays")
+
+    mask = _array_property("mask")
+    cos_map = _array_property("cos_map")
+    abs_data = _array_property("abs_data")
+    hg_longitude_map = _array_property("hg_longitude_map")
+    hg_latitude_map = _array_property("hg_latitude_map")
+    area_map = _array_property("area_map")
+    phi_map = _array_property("phi_map")
+    phi_delta = _array_property("phi_delta")
+    psl_mask = _array_property("psl_mask")
+    psl_thin_mask = _array_property("psl_thin_mask")
 
-
-class SMARTFeature:
     def __init__(self):
         self.id = None
-        self.mask = None
         self.contour = None
         self.phi_imb = None
         self.WL_sg_star = None
@@ -24,7 +67,6 @@ class SMARTFeature:
         self.SG_len = None
         self.PSL_len = None
         self.phi_net_emrg = None
-        self.phi_imb = None
         self.phi_abs = None
         self.phi_neg = None
         self.phi_pos = None
@@ -41,10 +83,12 @@ class SMARTFeature:
         self.time = None
         self.index = None
         self.shape = None
+        self.track_id = None
+        self._arrays = {}
 
     @classmethod
     def from_hmi(cls, hmi_magnetogram, index, feature_contour, delta_t,
-                 delta_t_magnetogram):
+                 delta_t_magnetogram, keep_arrays=None):
         """
         Parameters:
           hmi_magnetogram: HMIMagnetogram instance
@@ -55,119 +99,53 @@ class SMARTFeature:
           in seconds.
           delta_t_magnetogram: HMIMagnetogram to calculate delta phi,
           may be None
-        """
+          keep_arrays: Keep the arrays of the cutout (True for all ARRAYS
+          or a sequence of their names), default: params.KEEP_FEATURE_ARRAYS.
 
-        o = cls()
-
-        # initial code
+        The feature is characterized by feature_batch.features_from_hmi, so
+        it is identical to the feature of a batch of all contours.
+        """
+        o = feature_batch.features_from_hmi(
+            hmi_magnetogram, [feature_contour], delta_t, delta_t_magnetogram,
+            keep_arrays)[0]
         o.index = index
-        o.time = hmi_magnetogram.time
-        x, y, w, h = cv2.boundingRect(feature_contour)
-        o.shape = {"x": int(x), "y": int(y), "width": int(w), "height": int(h)}
-        o.contour = feature_contour.squeeze()
-        o.mask = np.zeros((h, w), dtype=np.uint8)
-
-        cv2.drawContours(o.mask, [feature_contour - (x, y)], 0, 1, -1)
-        o.mask *= hmi_magnetogram.data_mask[y:y + h, x:x + w]
-        cos_map = hmi_magnetogram.get_cosine_map()
-        o.cos_map = cos_map[y:y + h, x:x + w]
-        hg_lont_map, hg_latd_map = \
-            hmi_magnetogram.get_heliographic_coordinates()
-
-        # feature characterization: arrays-------------------------------------
-        data = np.ma.array(hmi_magnetogram.data[y:y + h, x:x + w] * o.mask,
-                           mask=1 - o.mask)
-        data *= (~cv2.inRange(data,
-                              -params.STATIC_BACKGROUND_THRESHOLD,
-                              params.STATIC_BACKGROUND_THRESHOLD)) & 1
-        o.abs_data = np.ma.absolute(data)
-        o.hg_longitude_map = np.ma.array(hg_lont_map[y:y + h, x:x + w],
-                                         mask=1 - o.mask)
-        o.hg_latitude_map = np.ma.array(hg_latd_map[y:y + h, x:x + w],
-                                        mask=1 - o.mask)
-
-        o.area_map = np.ma.array(
-            (o.mask / o.cos_map) * params.AREA_PER_PIXEL, mask=1 - o.mask)
-        o.phi_map = np.ma.array(data * 10 ** 4 * o.area_map,
-                                mask=1 - o.mask)  # 1 G = 1 Mx/cm^2, 1 Gauss
-        if delta_t_magnetogram is None:
-            o.phi_delta = np.zeros(data.shape)
-        else:
-            # the shapes may not be euqal, so we take the maximum area of both
-            delta_phi_map = delta_t_magnetogram.data[y:y + h,
-                                                     x:x + w] * o.area_map
-            o.phi_delta = (np.ma.absolute(o.phi_map) - np.ma.absolute(
-                delta_phi_map)) / delta_t
-
-        # feature characterization: properties---------------------------------
-        o.max = np.ma.amax(data)
-        o.min = np.ma.amin(data)
-        o.sum = np.ma.sum(data)
-        o.abs_sum = np.ma.sum(o.abs_data)
-        hg_longitude = np.ma.sum(o.abs_data * o.hg_longitude_map) / o.abs_sum
-        hg_latitude = np.ma.sum(o.abs_data * o.hg_latitude_map) / o.abs_sum
-        o.position = {"longitude": hg_longitude, "latitude": hg_latitude}
-        o.mean = np.ma.mean(data)
-        o.variance = np.ma.var(data)
-        o.skewness = scipy.stats.mstats.skew(data, axis=None)
-        o.kurtosis = scipy.stats.mstats.kurtosis(data, axis=None)
-        o.area = np.ma.sum(o.area_map)
-
-        o.phi_pos = np.ma.sum(o.phi_map[o.phi_map > 0])
-        if o.phi_pos is np.ma.masked:
-            o.phi_pos = 0
-        o.phi_neg = np.ma.sum(o.phi_map[o.phi_map < 0])
-        if o.phi_neg is np.ma.masked:
-            o.phi_neg = 0
-        o.phi_abs = np.ma.sum(np.ma.absolute(o.phi_map))
-        o.phi_imb = abs(o.phi_pos - abs(o.phi_neg)) / o.phi_abs
-        o.phi_net_emrg = np.sum(o.phi_delta)
-
-        # polarity separation lines--------------------------------------------
-        r = params.PSL_DILATION_RADIUS
-        kernel = img_operations.create_circle_mask(r, (r, r), (2 * r, 2 * r))
-        positive = cv2.dilate(
-            cv2.threshold(data, 1, 1, cv2.THRESH_BINARY)[1], kernel)
-        negative = cv2.dilate(
-            cv2.threshold(data, -1, 1, cv2.THRESH_BINARY_INV)[1], kernel)
-        o.psl_mask = positive * negative
-
-        # from http://opencvpython.blogspot.ch/2012/05/skeletonization-using-
-        # opencv-python.html
-        orig_mask = o.psl_mask.astype(np.uint8)
-        size = np.size(o.psl_mask)
-        o.psl_thin_mask = np.zeros(o.psl_mask.shape, np.uint8)
-        element = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
-        done = False
-
-        while not done:
-            eroded = cv2.erode(orig_mask, element)
-            temp = cv2.dilate(eroded, element)
-            temp = cv2.subtract(orig_mask, temp)
-            o.psl_thin_mask = cv2.bitwise_or(o.psl_thin_mask, temp)
-            orig_mask = eroded.copy()
-            zeros = size - cv2.countNonZero(orig_mask)
-            if zeros == size:
-                done = True
-        # end from opencvpython blogspot
-
-        o.PSL_len = np.sum(o.psl_thin_mask)
-        gradient_map = cv2.Sobel(data, -1, 1, 1)
-        gradient_per_area = (
-            gradient_map / (params.METERS_PER_PIXEL / 10 ** 6)
-        )
-        o.SG_len = np.sum(
-            o.psl_thin_mask * (gradient_per_area > params.SG_THRESHOLD)
-        )
-        o.WL_sg_star = np.sum(o.psl_thin_mask * gradient_map)
-        r_star_map = data * cv2.GaussianBlur(o.psl_mask, (
-            params.GAUSSIAN_BLUR_KERNEL_SIZE * 2 + 1,
-            params.GAUSSIAN_BLUR_KERNEL_SIZE * 2 + 1),
-            16.8)
-        o.R_star = np.sum(r_star_map)
-
         return o
 
+    def arrays(self, hmi_magnetogram, delta_t=None, delta_t_magnetogram=None):
+        """Recomputes the arrays of the feature (ARRAYS) and returns them as
+        a dict, they are not kept. The parameters are those of from_hmi:
+        the magnetogram of the feature and, for phi_delta, the previous
+        magnetogram rotated to its time (pipeline.process_pair replaces the
+        data of mag_t0 by the rotated data).
+        """
+        contour = np.asarray(self.contour, np.int32).reshape(-1, 1, 2)
+        return feature_batch.features_from_hmi(
+            hmi_magnetogram, [contour], delta_t, delta_t_magnetogram,
+            True)[0]._arrays
+
+    def has_array(self, name):
+        """Whether the array 'name' (see ARRAYS) is kept."""
+        return name in self._arrays
+
+    def release_arrays(self):
+        """Drops the kept arrays."""
+        self._arrays = {}
+
+    def _contour_mask(self):
+        mask = np.zeros((self.shape["height"], self.shape["width"]),
+                        dtype=np.uint8)
+        contour = np.asarray(self.contour, np.int32).reshape(-1, 1, 2)
+        cv2.drawContours(mask, [contour - (self.shape["x"], self.shape["y"])],
+                         0, 1, -1)
+        return mask
+
+    def _set_psl(self, properties):
+        """Sets the properties computed by psl.psl_properties."""
+        self.PSL_len = properties["PSL_len"]
+        self.SG_len = properties["SG_len"]
+        self.WL_sg_star = properties["WL_sg_star"]
+        self.R_star = properties["R_star"]
+
     @classmethod
     def from_json(cls, _dict):
         o = cls()
@@ -183,13 +161,6 @@ class SMARTFeature:
             "height": int(_dict["data"]["height"])
         }
         o.contour = np.array(json.loads(_dict["data"]["contour"]))
-        o.mask = np.zeros((o.shape["height"], o.shape["width"]),
-                          dtype=np.uint8)
-        cv2.drawContours(o.mask,
-                         [o.contour - (o.shape["x"], o.shape["y"])],
-                         0,
-                         1,
-                         -1)
         o.max = _dict["data"]["max"]
         o.min = _dict["data"]["min"]
         o.sum = _dict["data"]["sum"]
@@ -0,0 +1,299 @@
+"""Sources of magnetograms and sinks of features for main.extract.
+
+A source returns the metadata of the frames of a time range, a list of dicts
+with "url" and "date_obs" in time order; the url is downloaded (or, for a
+local path, read) by downloader.url2magnetogram. metadata() may be passed a
+requests session to reuse (the daemon). A sink receives the features of
+every frame, flush() stores them without waiting for a full batch.
+
+  HMIServiceSource: the FlareCast HMI metadata service
+  LocalArchiveSource: a directory tree of HMI FITS files, indexed by T_REC
+  PropertyServiceSink: the FlareCast property service (RegionInserter)
+  DiskSink: a columnar feature store (feature_store.FeatureWriter)
+
+The local source and the disk sink need neither of the FlareCast services,
+e.g. to reprocess an archive mounted on a compute node.
+"""
+from __future__ import print_function
+
+import fnmatch
+import json
+import os
+import tempfile
+import traceback
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+import astropy.io.fits as fits
+import requests
+
+import checkpoint
+import feature_store
+from hmi_magnetogram import STRING_TO_DATETIME
+import params
+from region_inserter import RegionInserter
+
+
+class HMIServiceSource:
+    def __init__(self, url=None):
+        self.url = params.HMI_SERVICE if url is None else url
+
+    def metadata(self, start, end, session=None):
+        query_params = {
+            "start": start.isoformat() + "Z",
+            "end": end.isoformat() + "Z"
+        }
+        getter = requests if session is None else session
+        answer = getter.get(self.url, params=query_params,
+                            timeout=params.DOWNLOAD_TIMEOUT)
+        answer.raise_for_status()
+        return answer.json()
+
+
+# levels the archive walk descends to split the tree, e.g. YYYY/MM/DD
+_MAX_SPLIT_DEPTH = 3
+
+
+def _read_time(path):
+    """T_REC of the HMI magnetogram 'path' as ISO string, None if the file is
+    no magnetogram or cannot be read. Only the header is read.
+    """
+    try:
+        header = fits.getheader(path, 1)
+        if header.get("CONTENT") != "MAGNETOGRAM":
+            return None
+        return datetime.strptime(header["T_REC"],
+                                 STRING_TO_DATETIME).isoformat()
+    except Exception:
+        return None
+
+
+class LocalArchiveSource:
+    """The magnetograms below 'directory' whose file names match 'pattern'.
+
+    The index of all files (path, size, modification time and T_REC) is
+    kept in 'index_file' (default: .smart_index.json in 'directory'), a
+    rescan only reads the headers of new or modified files. The directory
+    tree is walked and the headers are read by 'workers' threads, the scan
+    is dominated by I/O on network file systems. The walk descends until
+    the tree splits into at least 'workers' subtrees (e.g. below a single
+    YYYY/ directory), which are walked in parallel.
+    """
+
+    def __init__(self, directory, index_file=None, pattern=None,
+                 workers=None):
+        self.directory = os.path.abspath(directory)
+        self.index_file = index_file or os.path.join(self.directory,
+                                                     ".smart_index.json")
+        self.pattern = params.ARCHIVE_PATTERN if pattern is None \
+            else pattern
+        self.workers = params.ARCHIVE_SCAN_WORKERS if workers is None \
+            else workers
+        self._index = None
+
+    def _entry(self, path):
+        stat = os.stat(path)
+        return (os.path.relpath(path, self.directory), stat.st_size,
+                stat.st_mtime)
+
+    def _walk(self, directory):
+        paths = []
+        for root, _, names in os.walk(directory):
+            for name in fnmatch.filter(names, self.pattern):
+                paths.append(self._entry(os.path.join(root, name)))
+        return paths
+
+    def _list(self, directory):
+        """The files matching the pattern and the subdirectories of
+        'directory'.
+        """
+        files = []
+        subdirectories = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                subdirectories.append(path)
+            elif fnmatch.fnmatch(name, self.pattern) and \
+                    os.path.isfile(path):
+                files.append(self._entry(path))
+        return files, subdirectories
+
+    def _scan(self, pool):
+        """Returns (relative path, size, mtime) of all files."""
+        files = []
+        directories = [self.directory]
+        for _ in range(_MAX_SPLIT_DEPTH):
+            if not directories or len(directories) >= self.workers:
+                break
+            subdirectories = []
+            for found, below in pool.map(self._list, directories):
+                files.extend(found)
+                subdirectories.extend(below)
+            directories = subdirectories
+        for paths in pool.map(self._walk, directories):
+            files.extend(paths)
+        return files
+
+    def _load_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        try:
+            directory = os.path.dirname(self.index_file)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(index, f)
+            os.rename(tmp_path, self.index_file)
+        except (IOError, OSError):
+            # e.g. a read-only archive, the next run scans again
+            print("Warning: the archive index could not be written:\n%s" %
+                  traceback.format_exc())
+
+    def index(self):
+        """Returns the index: relative path -> [size, mtime, T_REC]. Every
+        call rescans the directories, so new files are found (e.g. by the
+        daemon), only the headers of new or modified files are read.
+        """
+        cached = self._index
+        if cached is None:
+            cached = self._load_index()
+        pool = ThreadPool(max(1, self.workers))
+        try:
+            files = self._scan(pool)
+            index = {}
+            changed = []
+            for path, size, mtime in files:
+                entry = cached.get(path)
+                if entry is not None and entry[:2] == [size, mtime]:
+                    index[path] = entry
+                else:
+                    changed.append((path, size, mtime))
+            times = pool.map(_read_time, [os.path.join(self.directory, path)
+                                          for path, _, _ in changed])
+        finally:
+            pool.close()
+            pool.join()
+
+        for (path, size, mtime), time in zip(changed, times):
+            index[path] = [size, mtime, time]
+        if changed or self._index is None:
+            print("archive %s: %d files, %d headers read" % (
+                self.directory, len(index), len(changed)))
+        if changed or len(index) != len(cached):
+            self._save_index(index)
+        self._index = index
+        return index
+
+    def metadata(self, start, end, session=None):
+        frames = {}
+        start = start.isoformat()
+        end = end.isoformat()
+        for path, (_, _, time) in sorted(self.index().items()):
+            if time is not None and start <= time <= end and \
+                    time not in frames:
+                frames[time] = os.path.join(self.directory, path)
+        return [{"url": frames[time], "date_obs": time}
+                for time in sorted(frames)]
+
+
+class PropertyServiceSink:
+    """Inserts the features (JSON dicts) into the property service."""
+    # the pipeline hands JSON dicts to this sink
+    json_features = True
+
+    def __init__(self, url=None, provenance="smart-python"):
+        from flarecast.utils.property_db_client import PropertyDBClient
+
+        url = params.PROPERTY_SERVICE if url is None else url
+        self.url = url
+        self.provenance = provenance
+        self.client = PropertyDBClient(url)
+        self.client.insert_provenances([provenance])
+        self.on_inserted = None
+        self._inserter = None
+
+    def stored_times(self, start, end):
+        return checkpoint.stored_times(self.url, self.provenance, start, end)
+
+    def _inserted(self, frames):
+        if self.on_inserted is not None:
+            self.on_inserted(frames)
+
+    def write(self, frame, features):
+        if self._inserter is None:
+            self._inserter = RegionInserter(self.client, self.provenance,
+                                            on_inserted=self._inserted)
+        self._inserter.add(features, frame)
+
+    def flush(self):
+        """Inserts the written features now, on the inserter thread."""
+        if self._inserter is not None:
+            self._inserter.flush()
+
+    def close(self):
+        if self._inserter is None:
+            return
+        self._inserter.close()
+        failed = self._inserter.failed_batches
+        if failed:
+            print("Warning: %d batches could not be inserted (%d frames)" % (
+                len(failed), sum(len(frames) for frames, _, _ in failed)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class DiskSink:
+    """Writes the features to a feature store in 'directory'. Every flush()
+    writes one file: in the daemon, which flushes after every frame, the
+    store holds one file per frame.
+    """
+    # the pipeline hands SMARTFeature instances to this sink
+    json_features = False
+
+    def __init__(self, directory, format=None):
+        self.directory = directory
+        self.format = params.FEATURE_STORE_FORMAT if format is None \
+            else format
+        self.on_inserted = None
+        self._writer = None
+
+    def stored_times(self, start, end):
+        return sorted(checkpoint.parse_time(frame) for frame in
+                      feature_store.stored_frames(self.directory))
+
+    def _inserted(self, frames):
+        if self.on_inserted is not None:
+            self.on_inserted(frames)
+
+    def write(self, frame, features):
+        if self._writer is None:
+            self._writer = feature_store.FeatureWriter(
+                self.directory, format=self.format,
+                on_inserted=self._inserted)
+        self._writer.write(frame, features)
+
+    def flush(self):
+        """Writes the buffered frames to a file now."""
+        if self._writer is not None:
+            self._writer.flush()
+
+    def close(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        print("%d features written to %s" % (self._writer.written_features,
+                                             self.directory))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
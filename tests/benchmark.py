@@ -0,0 +1,121 @@
+"""Times the stages of the pipeline on synthetic magnetograms, offline.
+
+Usage (from the repository root):
+  python -m tests.benchmark --sizes 1024 4096 --regions 10 40 --repeat 3
+
+Every stage is timed separately, the median of 'repeat' runs is reported:
+  load: HMIMagnetogram from the FITS bytes
+  rotate: differential rotation (native_rotation, or rotation.py if the C
+    extension is not built) and rotate_remap (rotation.py, cached tables)
+  extract_features: contours of the current frame
+  from_hmi, json: SMARTFeature.from_hmi and json() of all features
+  feature_batch: feature_batch.features_from_hmi of all features
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import time
+from io import BytesIO
+
+import numpy as np
+
+from hmi_magnetogram import HMIMagnetogram
+import feature_batch
+import params
+import rotation
+from smart_feature import SMARTFeature
+from tests import synthetic
+
+try:
+    from native_rotation import native_rotation
+except ImportError:
+    native_rotation = None
+
+
+def _median_time(function, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        times.append(time.time() - start)
+    return float(np.median(times)), result
+
+
+def benchmark(size, regions, repeat=3, seed=0):
+    """Returns a dict of stage name -> median seconds for one configuration,
+    plus the number of features.
+    """
+    (t0, fits_t0), (t1, fits_t1) = synthetic.make_sequence(
+        2, size, regions, seed)
+    results = {"size": size, "regions": regions}
+
+    results["load"], mag_t1 = _median_time(
+        lambda: HMIMagnetogram(BytesIO(fits_t1)), repeat)
+    mag_t0 = HMIMagnetogram(BytesIO(fits_t0))
+
+    dt = (t1 - t0).total_seconds()
+    center = (int(mag_t0.disk_center[0]), int(mag_t0.disk_center[1]))
+    radius = int(mag_t0.disk_radius)
+    if native_rotation is not None:
+        results["rotate"], rotated = _median_time(
+            lambda: native_rotation.rotate(mag_t0.data, center[0], center[1],
+                                           radius, dt), repeat)
+    else:
+        rotated = None
+    results["rotate_remap"], remapped = _median_time(
+        lambda: rotation.rotate(mag_t0.data, center[0], center[1], radius,
+                                dt), repeat)
+    if rotated is None:
+        rotated = remapped
+        results["rotate"] = results["rotate_remap"]
+    mag_t0.data = rotated
+
+    def extract():
+        mag_t1.smoothed = None
+        return mag_t1.get_contours(mag_t0)
+
+    results["extract_features"], contours = _median_time(extract, repeat)
+    results["features"] = len(contours)
+
+    results["from_hmi"], features = _median_time(
+        lambda: [SMARTFeature.from_hmi(mag_t1, j, contour, dt, mag_t0)
+                 for j, contour in enumerate(contours)], repeat)
+    results["json"], _ = _median_time(
+        lambda: [feature.json() for feature in features], repeat)
+    results["feature_batch"], _ = _median_time(
+        lambda: feature_batch.features_from_hmi(mag_t1, contours, dt,
+                                                mag_t0), repeat)
+    return results
+
+
+STAGES = ("load", "rotate", "rotate_remap", "extract_features", "from_hmi",
+          "json", "feature_batch")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 4096])
+    parser.add_argument("--regions", type=int, nargs="+", default=[10, 40])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append the results as JSON lines")
+    args = parser.parse_args()
+
+    print("detection=%s dilation=%s psl=%s" % (
+        params.DETECTION, params.DILATION_METHOD, params.PSL_THINNING))
+    print(("%6s %7s %8s " % ("size", "regions", "features")) +
+          " ".join("%16s" % stage for stage in STAGES))
+    for size in args.sizes:
+        for regions in args.regions:
+            results = benchmark(size, regions, args.repeat, args.seed)
+            print(("%6d %7d %8d " % (size, regions, results["features"])) +
+                  " ".join("%15.3fs" % results[stage] for stage in STAGES))
+            if args.output:
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(results) + "\n")
+
+
+if __name__ == "__main__":
+    main()
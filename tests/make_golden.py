@@ -0,0 +1,195 @@
+"""Generates the golden outputs in tests/golden from the baseline revision of
+the repository, the reference the regression tests compare the current code
+against.
+
+Usage (from the repository root, needs git and a C compiler):
+  python -m tests.make_golden
+
+The baseline tree is exported with git archive into a temporary directory.
+Its native_rotation extension is built for Python 3: only the module
+initialization is replaced, the rotation code is compiled unchanged.
+
+golden/rotation.npz: native_rotation.rotate of the baseline on
+  rotation_input(), with the parameters ROTATION_PARAMETERS
+golden/features.json: the feature JSON of the baseline pipeline for every
+  pair of feature_sequence(), one list per pair
+
+The baseline pipeline runs in a child process, its modules have the names of
+the current ones. sunpy.wcs.wcs, removed from sunpy, is replaced by
+tests/sunpy_wcs.py. cv2.normalize of the OpenCV versions the baseline was
+written for ignored the NaN of the off-disk coordinates, current versions
+return NaN everywhere, so it is replaced by a NaN-ignoring linear map (as
+coordinates._normalize does).
+"""
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+from io import BytesIO
+
+import cv2
+import numpy as np
+
+from tests import sunpy_wcs, synthetic
+
+BASELINE = "8bf0b83"
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "golden")
+
+ROTATION_SIZE = 1024
+# cx, cy, radius, dt (seconds): one day, so that the gap filling of the
+# forward mode is exercised
+ROTATION_PARAMETERS = (512, 511, 460, 86400.0)
+
+FEATURE_FRAMES = 3
+FEATURE_SIZE = 1024
+FEATURE_REGIONS = 12
+
+_PY2_INIT = """PyMODINIT_FUNC
+initnative_rotation(void)
+{
+   (void)Py_InitModule("native_rotation", methods);
+   import_array();
+}"""
+
+_PY3_INIT = """static struct PyModuleDef moduledef = {
+  PyModuleDef_HEAD_INIT, "native_rotation", NULL, -1, methods
+};
+
+PyMODINIT_FUNC
+PyInit_native_rotation(void)
+{
+   import_array();
+   return PyModule_Create(&moduledef);
+}"""
+
+
+def rotation_input():
+    """The frame rotated by golden/rotation.npz, without noise to keep the
+    file small.
+    """
+    return np.nan_to_num(synthetic.make_data(ROTATION_SIZE, 40, seed=3,
+                                             noise=0.0))
+
+
+def feature_sequence():
+    """The (time, FITS content) frames of golden/features.json."""
+    return synthetic.make_sequence(FEATURE_FRAMES, FEATURE_SIZE,
+                                   FEATURE_REGIONS)
+
+
+def export_baseline(directory):
+    """Extracts the baseline tree into 'directory'."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    archive = subprocess.Popen(["git", "archive", BASELINE], cwd=root,
+                               stdout=subprocess.PIPE)
+    subprocess.check_call(["tar", "-x", "-C", directory],
+                          stdin=archive.stdout)
+    archive.stdout.close()
+    if archive.wait() != 0:
+        raise RuntimeError("git archive %s failed" % BASELINE)
+
+
+def build_baseline_rotation(directory):
+    """Builds the native_rotation extension of the baseline tree in
+    'directory' and returns the module.
+    """
+    source_dir = os.path.join(directory, "native_rotation")
+    path = os.path.join(source_dir, "native_rotation.c")
+    with open(path) as f:
+        source = f.read()
+    if _PY2_INIT not in source:
+        raise RuntimeError("unexpected module initialization in %s" % path)
+    # memset is used without including string.h
+    source = "#include <string.h>\n" + source.replace(_PY2_INIT, _PY3_INIT)
+    with open(path, "w") as f:
+        f.write(source)
+    subprocess.check_call([sys.executable, "setup.py", "build_ext",
+                           "--inplace"], cwd=source_dir,
+                          stdout=subprocess.DEVNULL)
+    sys.path.insert(0, source_dir)
+    try:
+        import native_rotation
+    finally:
+        sys.path.remove(source_dir)
+    return native_rotation
+
+
+def make_rotation(directory):
+    native_rotation = build_baseline_rotation(directory)
+    cx, cy, radius, dt = ROTATION_PARAMETERS
+    rotated = native_rotation.rotate(rotation_input(), cx, cy, radius, dt)
+    path = os.path.join(GOLDEN_DIR, "rotation.npz")
+    np.savez_compressed(path, rotated=rotated)
+    print("wrote %s" % path)
+
+
+def _nan_normalize(src, dst, alpha, beta, norm_type):
+    """cv2.normalize (NORM_MINMAX) ignoring NaN."""
+    low, high = np.nanmin(src), np.nanmax(src)
+    return (src - low) * ((beta - alpha) / (high - low)) + alpha
+
+
+def baseline_features(directory):
+    """Runs the pipeline of the baseline tree in 'directory' on
+    feature_sequence(), in this process: the baseline modules are imported
+    under the names of the current ones.
+    """
+    native_rotation = build_baseline_rotation(directory)
+    sunpy = types.ModuleType("sunpy")
+    sunpy.wcs = types.ModuleType("sunpy.wcs")
+    sunpy.wcs.wcs = sunpy_wcs
+    sys.modules.update({"sunpy": sunpy, "sunpy.wcs": sunpy.wcs,
+                        "sunpy.wcs.wcs": sunpy_wcs})
+    cv2.normalize = _nan_normalize
+    sys.path.insert(0, directory)
+    from hmi_magnetogram import HMIMagnetogram
+    from smart_feature import SMARTFeature
+
+    mags = [HMIMagnetogram(BytesIO(content))
+            for _, content in feature_sequence()]
+    result = []
+    for mag_t0, mag_t1 in zip(mags, mags[1:]):
+        dt = (mag_t1.time - mag_t0.time).total_seconds()
+        mag_t0.data = native_rotation.rotate(
+            mag_t0.data, int(mag_t0.disk_center[0]),
+            int(mag_t0.disk_center[1]), int(mag_t0.disk_radius), dt)
+        contours = mag_t1.get_contours(mag_t0)
+        result.append([SMARTFeature.from_hmi(mag_t1, j, contour, dt,
+                                             mag_t0).json()
+                       for j, contour in enumerate(contours)])
+    return result
+
+
+def make_features(directory):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.check_call([sys.executable, "-m", "tests.make_golden",
+                           "--features", directory], cwd=root)
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == "--features":
+        path = os.path.join(GOLDEN_DIR, "features.json")
+        with open(path, "w") as f:
+            json.dump(baseline_features(sys.argv[2]), f)
+        print("wrote %s" % path)
+        return
+    if not os.path.isdir(GOLDEN_DIR):
+        os.makedirs(GOLDEN_DIR)
+    # the rotation and the pipeline each build the extension once
+    for make in (make_rotation, make_features):
+        directory = tempfile.mkdtemp()
+        try:
+            export_baseline(directory)
+            make(directory)
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
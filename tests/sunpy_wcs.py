@@ -0,0 +1,63 @@
+"""Float64 port of the sunpy.wcs functions used by the original code
+(sunpy 0.7; the module was removed in sunpy 0.8): the reference for the
+coordinate maps of coordinates.py and, in make_golden, the coordinates of
+the baseline revision.
+"""
+import numpy as np
+
+RSUN_METERS = 695508000.0  # sunpy.sun.constants.radius
+AU = 149597870691.0  # sunpy.sun.constants.au
+
+
+def convert_pixel_to_data(size, scale, reference_pixel, reference_coordinate,
+                          x=None, y=None):
+    """Helioprojective coordinates (arcsec) of the pixels."""
+    cdelt = np.array(scale)
+    crpix = np.array(reference_pixel)
+    crval = np.array(reference_coordinate)
+    if x is None and y is None:
+        x, y = np.meshgrid(np.arange(size[0]), np.arange(size[1]))
+    else:
+        x = np.array(x)
+        y = np.array(y)
+    # crpix counts from 1
+    coordx = (x - (crpix[0] - 1)) * cdelt[0] + crval[0]
+    coordy = (y - (crpix[1] - 1)) * cdelt[1] + crval[1]
+    return coordx, coordy
+
+
+def convert_hpc_hcc(x, y, dsun_meters=None, angle_units="arcsec", z=False):
+    """Heliocentric coordinates (meters) of helioprojective coordinates."""
+    c = np.deg2rad(1) / 3600.0 if angle_units == "arcsec" else 1.0
+    cosx = np.cos(x * c)
+    sinx = np.sin(x * c)
+    cosy = np.cos(y * c)
+    siny = np.sin(y * c)
+    if dsun_meters is None:
+        dsun_meters = AU
+    q = dsun_meters * cosy * cosx
+    with np.errstate(invalid="ignore"):
+        distance = q ** 2 - dsun_meters ** 2 + RSUN_METERS ** 2
+        distance = q - np.sqrt(distance)
+    rx = distance * cosy * sinx
+    ry = distance * siny
+    rz = dsun_meters - distance * cosy * cosx
+    if np.all(z):
+        return rx, ry, rz
+    return rx, ry
+
+
+def convert_hcc_hg(x, y, z=None, b0_deg=0, l0_deg=0, radius=False):
+    """Stonyhurst heliographic longitude and latitude (degrees) of
+    heliocentric coordinates.
+    """
+    if z is None:
+        z = np.sqrt(RSUN_METERS ** 2 - x ** 2 - y ** 2)
+    cosb = np.cos(np.deg2rad(b0_deg))
+    sinb = np.sin(np.deg2rad(b0_deg))
+    hecr = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+    hgln = np.arctan2(x, z * cosb - y * sinb) + np.deg2rad(l0_deg)
+    hglt = np.arcsin((y * cosb + z * sinb) / hecr)
+    if radius:
+        return np.rad2deg(hgln), np.rad2deg(hglt), hecr
+    return np.rad2deg(hgln), np.rad2deg(hglt)
@@ -0,0 +1,120 @@
+"""Generator for synthetic HMI level 1.5 magnetograms, used by the benchmark
+and the regression tests instead of downloaded data.
+
+The frames are Rice-compressed FITS files with the header keywords used by
+HMIMagnetogram (TELESCOP, BUNIT, CONTENT, CRPIX, CDELT, CRVAL, RSUN_OBS,
+DSUN_OBS, CROTA2, T_REC) and the integer encoding of JSOC (BSCALE, BLANK
+outside of the disk). The data contains Gaussian noise and bipolar active
+regions on the disk, scaled from a 4096x4096 frame.
+"""
+from datetime import datetime, timedelta
+from io import BytesIO
+
+import astropy.io.fits as fits
+import numpy as np
+
+HMI_SIZE = 4096
+HMI_CDELT = 0.504365  # arcsec/pixel
+RSUN_OBS = 975.0  # arcsec
+DSUN_OBS = 1.496e11  # meter
+BSCALE = 0.1
+BLANK = -2147483648
+NOISE = 10.0  # Gauss
+T_REC_FORMAT = "%Y.%m.%d_%H:%M:%S_TAI"
+
+
+def make_header(size=HMI_SIZE, time=datetime(2014, 1, 1), crota2=180.08):
+    """Returns the FITS header of a synthetic frame of size x size pixels."""
+    header = fits.Header()
+    header["TELESCOP"] = "SDO/HMI"
+    header["BUNIT"] = "Gauss"
+    header["CONTENT"] = "MAGNETOGRAM"
+    header["CDELT1"] = header["CDELT2"] = HMI_CDELT * HMI_SIZE / size
+    header["CRPIX1"] = size / 2.0 + 0.3
+    header["CRPIX2"] = size / 2.0 - 0.2
+    header["CRVAL1"] = header["CRVAL2"] = 0.0
+    header["RSUN_OBS"] = RSUN_OBS
+    header["DSUN_OBS"] = DSUN_OBS
+    header["CROTA2"] = crota2
+    header["T_REC"] = time.strftime(T_REC_FORMAT)
+    return header
+
+
+def make_regions(size=HMI_SIZE, regions=10, seed=0):
+    """Returns a list of (x, y, separation, sigma, amplitude) tuples of
+    bipolar regions in pixels and Gauss.
+    """
+    rng = np.random.RandomState(seed)
+    scale = size / float(HMI_SIZE)
+    radius = RSUN_OBS / (HMI_CDELT / scale)
+    result = []
+    for _ in range(regions):
+        distance = 0.7 * radius * np.sqrt(rng.uniform())
+        angle = rng.uniform(0, 2 * np.pi)
+        result.append((size / 2.0 + distance * np.cos(angle),
+                       size / 2.0 + distance * np.sin(angle),
+                       rng.uniform(30, 80) * scale,
+                       rng.uniform(10, 30) * scale,
+                       rng.uniform(500, 2500)))
+    return result
+
+
+def make_data(size=HMI_SIZE, regions=10, seed=0, shift=0.0, noise=NOISE):
+    """Returns the magnetic field (Gauss, float32) with noise and bipolar
+    regions, NaN outside of the disk. 'shift' moves the regions along the
+    rows (pixels), e.g. to imitate the rotation between two frames.
+    """
+    rng = np.random.RandomState(seed + 1)
+    data = rng.normal(0, noise, (size, size)).astype(np.float32)
+    for x, y, separation, sigma, amplitude in make_regions(size, regions,
+                                                           seed):
+        for sign in (1, -1):
+            cx = x + shift + sign * separation / 2
+            extent = int(4 * sigma)
+            x0, x1 = max(0, int(cx) - extent), min(size, int(cx) + extent)
+            y0, y1 = max(0, int(y) - extent), min(size, int(y) + extent)
+            yy, xx = np.mgrid[y0:y1, x0:x1]
+            data[y0:y1, x0:x1] += (sign * amplitude * np.exp(
+                -((xx - cx) ** 2 + (yy - y) ** 2) / (2 * sigma ** 2))
+            ).astype(np.float32)
+
+    header = make_header(size)
+    yy, xx = np.mgrid[0:size, 0:size]
+    radius = RSUN_OBS / header["CDELT1"]
+    off_disk = ((xx - header["CRPIX1"]) ** 2 + (yy - header["CRPIX2"]) ** 2 >
+                radius ** 2)
+    data[off_disk] = np.nan
+    return data
+
+
+def make_fits(size=HMI_SIZE, regions=10, seed=0, time=datetime(2014, 1, 1),
+              crota2=180.08, shift=0.0):
+    """Returns the bytes of a synthetic Rice-compressed FITS file."""
+    data = make_data(size, regions, seed, shift)
+    raw = np.full(data.shape, BLANK, np.int32)
+    on_disk = ~np.isnan(data)
+    raw[on_disk] = np.round(data[on_disk] / BSCALE).astype(np.int32)
+
+    hdu = fits.CompImageHDU(data=raw, header=make_header(size, time, crota2),
+                            compression_type="RICE_1")
+    hdu.header["BSCALE"] = BSCALE
+    hdu.header["BZERO"] = 0.0
+    hdu.header["BLANK"] = BLANK
+    stream = BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(stream)
+    return stream.getvalue()
+
+
+def make_sequence(frames=2, size=HMI_SIZE, regions=10, seed=0,
+                  start=datetime(2014, 1, 1), cadence=720):
+    """Returns a list of (time, FITS bytes) of consecutive frames, 'cadence'
+    seconds apart. The regions drift by about the solar rotation.
+    """
+    # ~ 0.5 pixels per minute at disk center on a 4096x4096 frame
+    drift = 0.5 * size / float(HMI_SIZE) * cadence / 60.0
+    sequence = []
+    for k in range(frames):
+        time = start + timedelta(seconds=k * cadence)
+        sequence.append((time, make_fits(size, regions, seed, time,
+                                         shift=k * drift)))
+    return sequence
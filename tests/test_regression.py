@@ -0,0 +1,1062 @@
+"""Golden checks: the fast paths of the pipeline have to produce the output of
+their reference paths on synthetic magnetograms. Run offline with
+  python -m unittest discover tests
+"""
+import asyncio
+import glob
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from datetime import timedelta
+from io import BytesIO
+
+import astropy.io.fits as fits
+import cv2
+import numpy as np
+
+from hmi_magnetogram import HMIMagnetogram
+import checkpoint
+import cutout_store
+import daemon
+import downloader
+import feature_batch
+import feature_store
+import geometry_cache
+import img_operations
+import instrumentation
+import magnetogram_cache
+import parallel
+import params
+import pipeline
+import psl
+import region_inserter
+import quicklook
+import rotation
+import sources
+import tracking
+import smart_feature
+from smart_feature import SMARTFeature
+from tests import make_golden, sunpy_wcs, synthetic
+
+try:
+    from native_rotation import native_rotation
+except ImportError:
+    native_rotation = None
+
+SIZE = 1024
+REGIONS = 12
+
+# absolute tolerances of the comparison with the baseline features, on top
+# of a relative one of 1e-3: the decoding differs by up to 0.15 Gauss
+BASELINE_ATOL = {"sum": 1.0, "mean": 1e-4, "skewness": 1e-5,
+                 "phi_imb": 1e-6, "WL_sg_star": 0.1, "R_star": 0.1,
+                 "lat_hg": 5e-5, "long_hg": 5e-5}
+# exact properties of the baseline features
+BASELINE_EXACT = ("index", "contour", "pos_x", "pos_y", "width", "height",
+                  "class")
+
+
+def _reference_load(content):
+    """The original HMIMagnetogram decoding: astropy scaling, nan_to_num,
+    flip and rotation.
+    """
+    hdu = fits.open(BytesIO(content))[1]
+    data = np.nan_to_num(np.array(hdu.data, np.float32))
+    center = (hdu.header["CRPIX1"], hdu.header["CRPIX2"])
+    matrix = cv2.getRotationMatrix2D(center, hdu.header["CROTA2"], 1)
+    return cv2.warpAffine(cv2.flip(data, 0), matrix, data.shape)
+
+
+def _reference_process_stl(img, center, disk_radius):
+    """The original img_operations.process_stl, with the cosine correction
+    map computed in float64 on every call.
+    """
+    ret = cv2.GaussianBlur(img, (params.GAUSSIAN_BLUR_KERNEL_SIZE,
+                                 params.GAUSSIAN_BLUR_KERNEL_SIZE),
+                           params.GAUSSIAN_BLUR_SIGMA)
+    ret *= (~cv2.inRange(ret, -params.STATIC_BACKGROUND_THRESHOLD,
+                         params.STATIC_BACKGROUND_THRESHOLD)) & 1
+    x, y = np.mgrid[-center[0]:-center[0] + img.shape[0],
+                    -center[1]:-center[1] + img.shape[1]]
+    dist = np.sqrt(x * x + y * y)
+    with np.errstate(invalid="ignore"):
+        cos_correction = np.sin(np.arccos(dist / disk_radius))
+        cos_correction[cos_correction < np.tan(np.pi / 3)] = 1
+    return np.nan_to_num(ret / cos_correction)
+
+
+def _cutouts(mag, contours):
+    cutouts = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        mask = np.zeros((h, w), np.uint8)
+        cv2.drawContours(mask, [contour - (x, y)], 0, 1, -1)
+        data = mag.data[y:y + h, x:x + w] * mask
+        data[np.abs(data) <= params.STATIC_BACKGROUND_THRESHOLD] = 0
+        cutouts.append(data.astype(np.float32))
+    return cutouts
+
+
+def _reference_psl(data):
+    """The polarity separation line properties of the original
+    SMARTFeature.from_hmi for the thresholded cutout 'data'.
+    """
+    r = params.PSL_DILATION_RADIUS
+    kernel = img_operations.create_circle_mask(r, (r, r), (2 * r, 2 * r))
+    positive = cv2.dilate(cv2.threshold(data, 1, 1, cv2.THRESH_BINARY)[1],
+                          kernel)
+    negative = cv2.dilate(
+        cv2.threshold(data, -1, 1, cv2.THRESH_BINARY_INV)[1], kernel)
+    psl_mask = positive * negative
+    thin_mask = psl.legacy_skeleton(psl_mask)
+    gradient_map = cv2.Sobel(data, -1, 1, 1)
+    gradient_per_area = gradient_map / (params.METERS_PER_PIXEL / 10 ** 6)
+    blur_size = params.GAUSSIAN_BLUR_KERNEL_SIZE * 2 + 1
+    r_star_map = data * cv2.GaussianBlur(psl_mask, (blur_size, blur_size),
+                                         16.8)
+    return {"psl_mask": psl_mask, "psl_thin_mask": thin_mask,
+            "PSL_len": np.sum(thin_mask),
+            "SG_len": np.sum(thin_mask *
+                             (gradient_per_area > params.SG_THRESHOLD)),
+            "WL_sg_star": np.sum(thin_mask * gradient_map),
+            "R_star": np.sum(r_star_map)}
+
+
+class RegressionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        (cls.t0, cls.fits_t0), (cls.t1, cls.fits_t1) = \
+            synthetic.make_sequence(2, SIZE, REGIONS)
+        cls.mag_t0 = HMIMagnetogram(BytesIO(cls.fits_t0))
+        cls.mag_t1 = HMIMagnetogram(BytesIO(cls.fits_t1))
+        cls.dt = (cls.t1 - cls.t0).total_seconds()
+        cls.center = (int(cls.mag_t0.disk_center[0]),
+                      int(cls.mag_t0.disk_center[1]))
+        cls.radius = int(cls.mag_t0.disk_radius)
+        cls.contours = cls.mag_t1.get_contours()
+
+    def test_features_found(self):
+        self.assertGreater(len(self.contours), 0)
+
+    def test_load(self):
+        reference = _reference_load(self.fits_t1) * self.mag_t1.data_mask
+        np.testing.assert_allclose(self.mag_t1.data, reference, atol=0.5)
+
+    def test_load_exact_flip(self):
+        content = synthetic.make_fits(SIZE, REGIONS, crota2=180.0)
+        mag = HMIMagnetogram(BytesIO(content))
+        reference = _reference_load(content) * mag.data_mask
+        np.testing.assert_allclose(mag.data, reference, atol=1e-3)
+
+    def test_memory_window(self):
+        if instrumentation._status_memory("VmRSS") is None:
+            self.skipTest("no /proc/self/status")
+        previous = instrumentation._metrics
+        try:
+            instrumentation.configure(enabled=True)
+            # may be 0, the buffers of earlier loads are reused
+            self.assertGreaterEqual(
+                HMIMagnetogram(BytesIO(self.fits_t1)).peak_memory, 0)
+            # no resets of the high-water mark without instrumentation
+            instrumentation.configure()
+            self.assertIsNone(
+                HMIMagnetogram(BytesIO(self.fits_t1)).peak_memory)
+        finally:
+            instrumentation._metrics = previous
+        size = 64 * 1024 ** 2
+        with instrumentation.MemoryWindow() as outer:
+            data = np.ones(size, np.uint8)
+            del data
+            # resets the high-water mark, outer keeps its peak
+            with instrumentation.MemoryWindow() as inner:
+                pass
+        self.assertGreaterEqual(outer.growth(), size * 0.9)
+        self.assertLess(inner.growth(), size // 2)
+
+    def test_process_stl(self):
+        center = self.mag_t1.disk_center
+        radius = self.mag_t1.disk_radius
+        reference = _reference_process_stl(self.mag_t1.data, center, radius)
+        tile_size = params.TILE_SIZE
+        try:
+            for params.TILE_SIZE in (0, tile_size):
+                smoothed = img_operations.process_stl(self.mag_t1.data,
+                                                      center, radius)
+                self.assertEqual(smoothed.dtype, np.float64)
+                np.testing.assert_array_equal(smoothed, reference)
+        finally:
+            params.TILE_SIZE = tile_size
+
+    def test_coordinates(self):
+        # full-frame float64 maps of the original sunpy.wcs code
+        shape, cdelt1, cdelt2, crpix1, crpix2, crval1, crval2, dsun = \
+            self.mag_t1._geometry()
+        hpc_x, hpc_y = sunpy_wcs.convert_pixel_to_data(
+            shape, [cdelt1, -cdelt2], [crpix1, crpix2], [crval1, crval2])
+        hcc_x, hcc_y, hcc_z = sunpy_wcs.convert_hpc_hcc(
+            hpc_x, hpc_y, dsun_meters=dsun, z=True)
+        longitude, latitude = sunpy_wcs.convert_hcc_hg(hcc_x, hcc_y, hcc_z)
+        cosine = (hcc_z - np.nanmin(hcc_z)) / (np.nanmax(hcc_z) -
+                                              np.nanmin(hcc_z))
+
+        provider = self.mag_t1.get_coordinate_provider()
+        on_disk = self.mag_t1.data_mask > 0
+        rows, cols = np.nonzero(on_disk)
+        # a window across the limb and the values of single pixels
+        x, y, width, height = SIZE // 2, SIZE // 4, SIZE // 2, SIZE // 2
+        inside = np.s_[y:y + height, x:x + width]
+        window_maps = provider.heliographic(x, y, width, height) + \
+            (provider.cosine(x, y, width, height),)
+        pixel_maps = provider.pixels(cols, rows)
+        for k, (reference, tolerance) in enumerate(
+                ((longitude, 5e-5), (latitude, 5e-5), (cosine, 1e-6))):
+            np.testing.assert_allclose(pixel_maps[k], reference[rows, cols],
+                                       rtol=0, atol=tolerance)
+            on = on_disk[inside]
+            np.testing.assert_allclose(window_maps[k][on],
+                                       reference[inside][on], rtol=0,
+                                       atol=tolerance)
+
+    def test_incremental_smoothing(self):
+        settings = (params.USE_DELTA_MAGNETOGRAM,
+                    params.INCREMENTAL_SMOOTHING, params.FEATURE_STORE_DIR)
+        classes = []
+        try:
+            params.USE_DELTA_MAGNETOGRAM = True
+            params.FEATURE_STORE_DIR = None
+            for params.INCREMENTAL_SMOOTHING in (False, True):
+                mag_t0 = HMIMagnetogram(BytesIO(self.fits_t0))
+                # left over from the previous pair in the pipeline
+                mag_t0.get_smoothed()
+                mag_t1 = HMIMagnetogram(BytesIO(self.fits_t1))
+                classes.append([feature["data"]["class"] for feature in
+                                pipeline.process_pair(mag_t0, mag_t1)])
+                # kept for the next pair only with incremental smoothing
+                if params.INCREMENTAL_SMOOTHING:
+                    self.assertEqual(mag_t1.smoothed.dtype, np.float32)
+                else:
+                    self.assertIsNone(mag_t1.smoothed)
+            params.USE_DELTA_MAGNETOGRAM = False
+            mag_t1 = HMIMagnetogram(BytesIO(self.fits_t1))
+            mag_t1.get_contours()
+            self.assertIsNone(mag_t1.smoothed)
+        finally:
+            (params.USE_DELTA_MAGNETOGRAM, params.INCREMENTAL_SMOOTHING,
+             params.FEATURE_STORE_DIR) = settings
+        self.assertGreater(len(classes[0]), 0)
+        self.assertEqual(classes[0], classes[1])
+
+    def test_smoothing_difference(self):
+        method = params.ROTATION_METHOD
+        try:
+            for params.ROTATION_METHOD in ("native", "remap"):
+                mag = HMIMagnetogram(BytesIO(self.fits_t0))
+                smoothed = mag.get_smoothed().astype(np.float32)
+                rotated_smoothed = np.nan_to_num(pipeline._rotate(
+                    mag, smoothed, self.dt, "smoothed"))
+                rotated = pipeline._rotate(mag, mag.data, self.dt)
+                difference = img_operations.smoothing_difference(
+                    rotated_smoothed, rotated, mag.disk_center,
+                    mag.disk_radius)
+                # measured: max 0.001 / 69 Gauss, mean 5e-8 / 0.05 Gauss,
+                # mismatch 0 / 0.09 % (native / remap)
+                self.assertLess(difference["max_abs"], 100)
+                self.assertLess(difference["mean_abs"], 0.5)
+                self.assertLess(difference["binary_mismatch"], 0.005)
+        finally:
+            params.ROTATION_METHOD = method
+
+    def test_dilation(self):
+        smoothed = img_operations.process_stl(self.mag_t1.data,
+                                              self.mag_t1.disk_center,
+                                              self.mag_t1.disk_radius)
+        mask = img_operations.binarize(smoothed)
+        for radius in (params.PSL_DILATION_RADIUS,
+                       params.FEATURE_DILATION_RADIUS):
+            np.testing.assert_array_equal(
+                img_operations.dilate_circle(mask, radius, "distance"),
+                img_operations.dilate_circle(mask, radius, "kernel"))
+        empty = np.zeros((50, 60), np.uint8)
+        self.assertEqual(
+            img_operations.dilate_circle(empty, 16, "distance").sum(), 0)
+
+    def test_tiling(self):
+        center = self.mag_t1.disk_center
+        radius = self.mag_t1.disk_radius
+        tile_size = params.TILE_SIZE
+        results = []
+        try:
+            # 100 does not divide the frame, the last tiles are smaller
+            for params.TILE_SIZE in (0, 100):
+                smoothed = [img_operations.process_stl(mag.data, center,
+                                                       radius)
+                            for mag in (self.mag_t1, self.mag_t0)]
+                m_t, m_t_delta = [img_operations.binarize(s)
+                                  for s in smoothed]
+                grown = [img_operations._grow_features(
+                    m_t, delta, params.FEATURE_DILATION_RADIUS)
+                    for delta in (m_t_delta, m_t)]
+                results.append(smoothed + grown)
+        finally:
+            params.TILE_SIZE = tile_size
+        for full, tiled in zip(*results):
+            self.assertEqual(full.dtype, tiled.dtype)
+            self.assertEqual(full.tobytes(), tiled.tobytes())
+
+    def test_pyramid_detection(self):
+        for delta in (self.mag_t1.data, self.mag_t0.data):
+            report = img_operations.pyramid_accuracy(
+                self.mag_t1.data, delta, self.mag_t1.disk_center,
+                self.mag_t1.disk_radius)
+            self.assertEqual(report["missed"], 0)
+            self.assertEqual(report["extra"], 0)
+            self.assertEqual(report["identical"], report["full_features"])
+        # the smoothed previous frame of incremental smoothing
+        smoothed = img_operations.process_stl(
+            self.mag_t0.data, self.mag_t1.disk_center,
+            self.mag_t1.disk_radius).astype(np.float32)
+        report = img_operations.pyramid_accuracy(
+            self.mag_t1.data, self.mag_t0.data, self.mag_t1.disk_center,
+            self.mag_t1.disk_radius, smoothed_dt=smoothed)
+        self.assertEqual(report["identical"], report["full_features"])
+        self.assertEqual(report["pyramid_features"], report["full_features"])
+
+        # windows which cannot be grown enough fall back to the full frame
+        settings = params.PYRAMID_MARGIN, params.PYRAMID_MAX_GROW
+        try:
+            params.PYRAMID_MARGIN, params.PYRAMID_MAX_GROW = 0, 0
+            report = img_operations.pyramid_accuracy(
+                self.mag_t1.data, self.mag_t1.data, self.mag_t1.disk_center,
+                self.mag_t1.disk_radius)
+        finally:
+            params.PYRAMID_MARGIN, params.PYRAMID_MAX_GROW = settings
+        self.assertEqual(report["identical"], report["full_features"])
+        self.assertEqual(report["pyramid_features"], report["full_features"])
+
+    def test_psl_batch(self):
+        cutouts = _cutouts(self.mag_t1, self.contours)
+        for method in ("thinning", "legacy"):
+            batch = psl.psl_properties(cutouts, method)
+            for cutout, properties in zip(cutouts, batch):
+                single = psl.psl_properties([cutout], method)[0]
+                for key in ("psl_mask", "psl_thin_mask", "PSL_len",
+                            "SG_len"):
+                    np.testing.assert_array_equal(properties[key],
+                                                  single[key])
+                for key in ("WL_sg_star", "R_star"):
+                    self.assertEqual(properties[key], single[key], key)
+
+    def test_psl_legacy(self):
+        cutouts = _cutouts(self.mag_t1, self.contours)
+        batch = psl.psl_properties(cutouts, "legacy")
+        for cutout, properties in zip(cutouts, batch):
+            reference = _reference_psl(cutout)
+            for key in ("psl_mask", "psl_thin_mask"):
+                np.testing.assert_array_equal(properties[key],
+                                              reference[key])
+            for key in ("PSL_len", "SG_len", "WL_sg_star", "R_star"):
+                self.assertEqual(properties[key], reference[key], key)
+
+    def test_thinning(self):
+        cutouts = _cutouts(self.mag_t1, self.contours)
+        for properties in psl.psl_properties(cutouts):
+            thin = properties["psl_thin_mask"]
+            # the skeleton is part of the mask and has no 2x2 blocks
+            self.assertFalse(np.any(thin & (properties["psl_mask"] == 0)))
+            blocks = thin[:-1, :-1] & thin[1:, :-1] & thin[:-1, 1:] & \
+                thin[1:, 1:]
+            self.assertFalse(np.any(blocks))
+
+    def test_feature_batch(self):
+        singles = [SMARTFeature.from_hmi(self.mag_t1, j, contour, self.dt,
+                                         self.mag_t0).json()
+                   for j, contour in enumerate(self.contours)]
+        batch = [feature.json() for feature in feature_batch.features_from_hmi(
+            self.mag_t1, self.contours, self.dt, self.mag_t0)]
+        self.assertEqual(batch, singles)
+
+    @unittest.skipIf(native_rotation is None, "native_rotation is not built")
+    def test_rotation_remap(self):
+        data = self.mag_t0.data
+        native = native_rotation.rotate(data, self.center[0], self.center[1],
+                                        self.radius, self.dt, mode=1)
+        remapped = rotation.rotate(data, self.center[0], self.center[1],
+                                   self.radius, self.dt)
+        np.testing.assert_array_equal(np.isnan(native), np.isnan(remapped))
+        # 1/32 pixel interpolation weights of cv2.remap, about 0.02 Gauss
+        np.testing.assert_allclose(remapped, native, atol=0.1)
+
+    @unittest.skipIf(native_rotation is None, "native_rotation is not built")
+    def test_rotation_baseline(self):
+        golden = np.load(os.path.join(make_golden.GOLDEN_DIR,
+                                      "rotation.npz"))["rotated"]
+        rotated = native_rotation.rotate(make_golden.rotation_input(),
+                                         *make_golden.ROTATION_PARAMETERS)
+        np.testing.assert_array_equal(rotated, golden)
+
+    def _assert_baseline_features(self, skip=()):
+        with open(os.path.join(make_golden.GOLDEN_DIR,
+                               "features.json")) as f:
+            golden = json.load(f)
+        mags = [HMIMagnetogram(BytesIO(content))
+                for _, content in make_golden.feature_sequence()]
+        self.assertEqual(len(golden), len(mags) - 1)
+        for mag_t0, mag_t1, expected in zip(mags, mags[1:], golden):
+            features = pipeline.process_pair(mag_t0, mag_t1, None, True)
+            self.assertEqual(len(features), len(expected))
+            for feature, reference in zip(features, expected):
+                self.assertEqual(feature["time_start"],
+                                 reference["time_start"])
+                values = dict(feature["data"], lat_hg=feature["lat_hg"],
+                              long_hg=feature["long_hg"])
+                references = dict(reference["data"],
+                                  lat_hg=reference["lat_hg"],
+                                  long_hg=reference["long_hg"])
+                for name in BASELINE_EXACT:
+                    self.assertEqual(values[name], references[name], name)
+                for name, value in references.items():
+                    if name in BASELINE_EXACT or name in skip:
+                        continue
+                    np.testing.assert_allclose(
+                        values[name], value, rtol=1e-3,
+                        atol=BASELINE_ATOL.get(name, 0), err_msg=name)
+
+    def test_baseline_features(self):
+        # the Zhang-Suen thinning gives other polarity separation lines
+        self._assert_baseline_features(skip=("PSL_len", "SG_len",
+                                             "WL_sg_star"))
+        thinning = params.PSL_THINNING
+        params.PSL_THINNING = "legacy"
+        try:
+            self._assert_baseline_features()
+        finally:
+            params.PSL_THINNING = thinning
+
+    def test_geometry_cache(self):
+        built = []
+
+        def builder():
+            built.append(1)
+            return np.ones((4, 4)), np.zeros((4, 4))
+
+        cache = geometry_cache.GeometryCache(max_bytes=128)
+        first = cache.get("maps", (1, 2), builder)
+        self.assertIs(cache.get("maps", (1, 2), builder), first)
+        self.assertEqual((cache.hits, cache.misses, len(built)), (1, 1, 1))
+        self.assertEqual((first.shape, first.dtype), ((2, 4, 4), np.float32))
+        self.assertFalse(first.flags.writeable)
+        ones, zeros = first
+        np.testing.assert_array_equal(ones, 1)
+        self.assertEqual(cache.get("maps", (1, 2), builder,
+                                   np.float64).dtype, np.float64)
+        # the float64 entry evicted the float32 one
+        cache.get("maps", (1, 2), builder)
+        self.assertEqual(len(built), 3)
+        self.assertAlmostEqual(geometry_cache.quantize(0.26, 0.1), 0.3)
+
+        directory = tempfile.mkdtemp()
+        try:
+            cache = geometry_cache.GeometryCache(directory=directory)
+            stored = cache.get("maps", (1, 2), builder)
+            self.assertIsInstance(stored, np.memmap)
+            loaded = geometry_cache.GeometryCache(directory=directory).get(
+                "maps", (1, 2), builder)
+            np.testing.assert_array_equal(loaded, stored)
+            self.assertEqual(len(built), 4)
+            self.assertEqual([os.path.splitext(name)[1]
+                              for name in os.listdir(directory)], [".npy"])
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(native_rotation is None, "native_rotation is not built")
+    def test_rotation_out_buffer(self):
+        out = np.empty_like(self.mag_t0.data)
+        result = native_rotation.rotate(self.mag_t0.data, self.center[0],
+                                        self.center[1], self.radius, self.dt,
+                                        out=out)
+        self.assertIs(result, out)
+        np.testing.assert_array_equal(
+            result, native_rotation.rotate(self.mag_t0.data, self.center[0],
+                                           self.center[1], self.radius,
+                                           self.dt))
+
+    def test_magnetogram_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for decoded in (False, True):
+                cache = magnetogram_cache.MagnetogramCache(
+                    os.path.join(directory, str(decoded)), decoded=decoded)
+                self.assertIsNone(cache.get("url", "date"))
+                stored = cache.put("url", "date", self.fits_t1)
+                loaded = cache.get("url", "date")
+                np.testing.assert_array_equal(loaded.data, stored.data)
+                self.assertEqual((cache.hits, cache.misses), (1, 1))
+                names = os.listdir(cache.directory)
+                self.assertEqual([os.path.splitext(name)[1]
+                                  for name in names],
+                                 [".decoded" if decoded else ".fits"])
+
+                # decoded frames are not used with other parameters
+                radius = params.USABLE_DISK_RADIUS
+                params.USABLE_DISK_RADIUS = radius - 0.01
+                try:
+                    self.assertEqual(cache.get("url", "date") is None,
+                                     decoded)
+                finally:
+                    params.USABLE_DISK_RADIUS = radius
+
+                cache.max_bytes = 0
+                cache.put("url", "other", self.fits_t0)
+                self.assertEqual(os.listdir(cache.directory), [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_tracking(self):
+        def square(x, y, size, index):
+            return tracking.Observation([[x, y], [x + size, y],
+                                         [x + size, y + size],
+                                         [x, y + size]], index)
+
+        center = (512, 512)
+        tracker = tracking.Tracker()
+        first = tracker.update(self.t0, [square(500, 500, 40, 0)], center,
+                               480)
+        split = tracker.update(self.t0 + timedelta(seconds=720),
+                               [square(500, 500, 18, 0),
+                                square(520, 500, 18, 1)], center, 480)
+        self.assertEqual(split[0], first[0])
+        self.assertEqual(tracker.events, [{"event": "split",
+                                           "track": split[1],
+                                           "parent": first[0]}])
+        # a tracker restored from a checkpoint continues the tracks
+        restored = tracking.Tracker()
+        restored.restore(tracker.state())
+        merge = tracker.update(self.t0 + timedelta(seconds=1440),
+                               [square(498, 498, 44, 0)], center, 480)
+        self.assertEqual(merge, first)
+        self.assertEqual(tracker.events[0]["event"], "merge")
+        self.assertEqual(restored.update(self.t0 + timedelta(seconds=1440),
+                                         [square(498, 498, 44, 0)], center,
+                                         480), merge)
+        self.assertEqual(restored.events, tracker.events)
+        # rotated behind the limb
+        tracker.update(self.t0 + timedelta(days=8), [], center, 480)
+        self.assertEqual(tracker.events[0]["reason"], "limb")
+        self.assertEqual(tracker.tracks, [])
+
+    def test_checkpoint(self):
+        metadata = [{"date_obs": (self.t0 + timedelta(seconds=720 * k))
+                     .isoformat() + "Z"} for k in range(6)]
+        stored = [checkpoint.parse_time(metadata[k]["date_obs"]) +
+                  timedelta(seconds=30) for k in (2, 5)]
+        runs = checkpoint.plan(metadata, stored)
+        self.assertEqual([[metadata.index(meta) for meta in run]
+                          for run in runs], [[0, 1], [2, 3, 4]])
+
+        directory = tempfile.mkdtemp()
+        try:
+            state = checkpoint.Checkpoint(os.path.join(directory, "c.npz"),
+                                          interval=1)
+            tracker = tracking.Tracker()
+            tracker.update(self.mag_t1.time, [tracking.Observation(
+                [[500, 500], [520, 500], [520, 520]], 0)],
+                self.mag_t1.disk_center, self.mag_t1.disk_radius)
+            state.offer(metadata[1], self.mag_t1, tracker)
+            state.inserted([metadata[1]["date_obs"]])
+            loaded = checkpoint.Checkpoint(state.path)
+            frame, mag = loaded.load()
+            self.assertEqual(loaded.tracks, tracker.state())
+            self.assertEqual(frame, metadata[1]["date_obs"])
+            self.assertEqual(mag.time, self.mag_t1.time)
+            np.testing.assert_array_equal(mag.data, self.mag_t1.data)
+
+            # frames without features are reported as inserted as well and
+            # are skipped on restart
+            class Client:
+                inserted = []
+
+                def insert_regions(self, provenance, features):
+                    Client.inserted.append(features)
+                    return {}
+
+            state.offer(metadata[3])
+            with region_inserter.RegionInserter(
+                    Client(), on_inserted=state.inserted) as inserter:
+                inserter.add([], metadata[2]["date_obs"])
+                inserter.add([{"index": 0}], metadata[3]["date_obs"])
+                inserter.add([], metadata[4]["date_obs"])
+            self.assertEqual(Client.inserted, [[{"index": 0}]])
+            restarted = checkpoint.Checkpoint(state.path)
+            self.assertEqual(restarted.load()[0], metadata[3]["date_obs"])
+            # the frames up to the checkpoint frame are done by their time
+            self.assertEqual(restarted.processed,
+                             set([metadata[4]["date_obs"]]))
+            runs = checkpoint.plan(metadata, [], restarted.frame,
+                                   processed=restarted.processed)
+            self.assertEqual([[metadata.index(meta) for meta in run]
+                              for run in runs], [[4, 5]])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_prefetcher(self):
+        directory = tempfile.mkdtemp()
+        try:
+            metadata = []
+            for k, content in enumerate([self.fits_t0, None, self.fits_t1]):
+                path = os.path.join(directory, "frame%d.fits" % k)
+                if content is not None:
+                    with open(path, "wb") as f:
+                        f.write(content)
+                metadata.append({"url": path, "date_obs": str(k)})
+            with downloader.MagnetogramPrefetcher(
+                    metadata, prefetch=1, session=object(),
+                    workers=2) as frames:
+                result = list(frames)
+            self.assertEqual([meta for meta, _ in result], metadata)
+            self.assertIsNone(result[1][1])
+            for (_, mag), reference in zip([result[0], result[2]],
+                                           [self.mag_t0, self.mag_t1]):
+                self.assertEqual(mag.time, reference.time)
+                np.testing.assert_array_equal(mag.data, reference.data)
+
+            # closing stops the workers before the end
+            with downloader.MagnetogramPrefetcher(
+                    metadata, prefetch=1, session=object()) as frames:
+                self.assertEqual(next(iter(frames))[0], metadata[0])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_region_inserter(self):
+        class Client:
+            def __init__(self, failures):
+                self.failures = failures
+                self.batches = []
+
+            def insert_regions(self, provenance, features):
+                if self.failures > 0:
+                    self.failures -= 1
+                    return {"message": "unavailable"}
+                self.batches.append(list(features))
+                return {}
+
+        backoff, retries = params.INSERT_BACKOFF, params.INSERT_RETRIES
+        params.INSERT_BACKOFF = 0
+        try:
+            inserted = []
+            client = Client(failures=1)
+            with region_inserter.RegionInserter(
+                    client, batch_size=3, flush_interval=60, retries=1,
+                    on_inserted=inserted.append) as inserter:
+                for frame in range(4):
+                    inserter.add([frame, frame], frame)
+            self.assertEqual(client.batches, [[0, 0, 1, 1], [2, 2, 3, 3]])
+            self.assertEqual(inserted, [[0, 1], [2, 3]])
+            self.assertEqual(inserter.inserted_features, 8)
+            self.assertEqual(inserter.failed_batches, [])
+
+            # batches which still fail after the retries are collected, the
+            # defaults are read when the inserter is created
+            params.INSERT_RETRIES = 1
+            inserted = []
+            client = Client(failures=2)
+            with region_inserter.RegionInserter(
+                    client, batch_size=3,
+                    on_inserted=inserted.append) as inserter:
+                inserter.add([0], "a")
+                inserter.flush()
+                inserter.add([1], "b")
+            self.assertEqual(inserter.failed_batches,
+                             [(["a"], [0], "unavailable")])
+            self.assertEqual(client.batches, [[1]])
+            self.assertEqual(inserted, [["b"]])
+        finally:
+            params.INSERT_BACKOFF, params.INSERT_RETRIES = backoff, retries
+
+    def test_feature_store(self):
+        features = feature_batch.features_from_hmi(
+            self.mag_t1, self.contours, self.dt, self.mag_t0)
+        references = [feature.json() for feature in features]
+        directory = tempfile.mkdtemp()
+        try:
+            with feature_store.FeatureWriter(directory, batch_frames=2,
+                                             format="npz") as writer:
+                writer.write("frame 0", features)
+                writer.write("frame 1", [])
+                writer.write("frame 2", references)
+            table = feature_store.read(directory)
+            self.assertEqual(table["frames"].tolist(),
+                             ["frame 0", "frame 1", "frame 2"])
+            loaded = feature_store.features(table)
+            self.assertEqual(len(loaded), 2 * len(features))
+            for k, feature in enumerate(loaded):
+                self.assertEqual(feature.json(),
+                                 references[k % len(references)])
+
+            # frame 1 written again: only the newer file is read
+            with feature_store.FeatureWriter(directory, format="npz") as \
+                    writer:
+                writer.write("frame 1", references[:1])
+                writer.write("frame 3", references[1:2])
+            path, = glob.glob(os.path.join(directory, "smart_frame1_*"))
+            later = os.path.getmtime(path) + 10
+            os.utime(path, (later, later))
+            # a rerun starting at frame 0 keeps the file of frames 0 and 1
+            with feature_store.FeatureWriter(directory, format="npz") as \
+                    writer:
+                writer.write("frame 0", references)
+            self.assertEqual(len(os.listdir(directory)), 4)
+            path, = glob.glob(os.path.join(directory,
+                                           "smart_frame0_frame0_*"))
+            os.utime(path, (later + 10, later + 10))
+            table = feature_store.read(directory)
+            self.assertEqual(table["frames"].tolist(),
+                             ["frame 0", "frame 1", "frame 2", "frame 3"])
+            self.assertEqual([feature.json() for feature in
+                              feature_store.features(table)],
+                             references + references[:1] + references +
+                             references[1:2])
+            self.assertEqual(feature_store.stored_frames(directory),
+                             ["frame 0", "frame 1", "frame 2", "frame 3"])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_feature_arrays(self):
+        contour = self.contours[0]
+        kept = SMARTFeature.from_hmi(self.mag_t1, 0, contour, self.dt,
+                                     self.mag_t0, keep_arrays=True)
+        slim = SMARTFeature.from_hmi(self.mag_t1, 0, contour, self.dt,
+                                     self.mag_t0, keep_arrays=False)
+        self.assertEqual(slim.json(), kept.json())
+        self.assertFalse(hasattr(slim, "phi_map"))
+        arrays = slim.arrays(self.mag_t1, self.dt, self.mag_t0)
+        for name in smart_feature.ARRAYS:
+            np.testing.assert_array_equal(arrays[name], getattr(kept, name))
+        # the mask of the slim feature is drawn from the contour
+        self.assertFalse(np.any(kept.mask & (slim.mask == 0)))
+
+    def test_feature_batch_arrays(self):
+        keep = params.KEEP_FEATURE_ARRAYS
+        try:
+            params.KEEP_FEATURE_ARRAYS = True
+            batch = feature_batch.features_from_hmi(
+                self.mag_t1, self.contours, self.dt, self.mag_t0)
+        finally:
+            params.KEEP_FEATURE_ARRAYS = keep
+        for feature in batch:
+            reference = SMARTFeature.from_hmi(
+                self.mag_t1, feature.index, self.contours[feature.index],
+                self.dt, self.mag_t0, keep_arrays=True)
+            for name in smart_feature.ARRAYS:
+                self.assertTrue(feature.has_array(name), name)
+                array = getattr(feature, name)
+                expected = getattr(reference, name)
+                np.testing.assert_array_equal(np.ma.getmaskarray(array),
+                                              np.ma.getmaskarray(expected))
+                np.testing.assert_array_equal(np.ma.filled(array, 0),
+                                              np.ma.filled(expected, 0))
+
+    def test_daemon(self):
+        directory = tempfile.mkdtemp()
+        try:
+            metadata = []
+            for k, (time, content) in enumerate(
+                    synthetic.make_sequence(3, SIZE, REGIONS)):
+                path = os.path.join(directory, "frame%d.fits" % k)
+                with open(path, "wb") as f:
+                    f.write(content)
+                metadata.append({"url": path, "date_obs": time.isoformat()})
+
+            class Source:
+                # one more frame appears on every poll
+                polls = 0
+
+                def metadata(self, start, end, session=None):
+                    self.session = session
+                    Source.polls += 1
+                    if Source.polls > len(metadata):
+                        runner.stop()
+                    return metadata[:Source.polls]
+
+            output = os.path.join(directory, "features")
+            runner = daemon.Daemon(Source(), sources.DiskSink(output),
+                                   poll_interval=0.01)
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(runner.run())
+            finally:
+                loop.close()
+            self.assertEqual(sorted(feature_store.stored_frames(output)),
+                             [i["date_obs"] for i in metadata[1:]])
+            self.assertEqual(runner.latency_summary()["frames"], 2)
+            # the daemon polls with its session, no frame is left pending
+            self.assertIs(runner.source.session, runner.session)
+            self.assertEqual(len(runner._found), 0)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_local_archive(self):
+        directory = tempfile.mkdtemp()
+        try:
+            # one YYYY/ directory, the walk has to split it further
+            paths = []
+            for k, (time, content) in enumerate(
+                    synthetic.make_sequence(3, 64, 2)):
+                day = os.path.join(directory, "2014", "01", "%02d" % (k + 1))
+                os.makedirs(day)
+                paths.append(os.path.join(day, "hmi_%d.fits" % k))
+                with open(paths[-1], "wb") as f:
+                    f.write(content)
+            header = fits.PrimaryHDU().header
+            header["CONTENT"] = "CONTINUUM INTENSITY"
+            fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(
+                np.zeros((8, 8), np.float32), header)]).writeto(
+                os.path.join(directory, "2014", "continuum.fits"))
+            with open(os.path.join(directory, "2014", "notes.txt"), "w") as f:
+                f.write("not a FITS file")
+
+            source = sources.LocalArchiveSource(directory, workers=4)
+            index = source.index()
+            self.assertEqual(sorted(index), sorted(
+                [os.path.relpath(path, directory) for path in paths] +
+                [os.path.join("2014", "continuum.fits")]))
+            self.assertIsNone(index[os.path.join("2014", "continuum.fits")][2])
+            start = self.t0 - timedelta(hours=1)
+            metadata = source.metadata(start, start + timedelta(days=1))
+            self.assertEqual(metadata, [
+                {"url": path, "date_obs": time.isoformat()}
+                for path, (time, _) in zip(paths, synthetic.make_sequence(
+                    3, 64, 2))])
+
+            # unchanged files are taken from the index file without reading
+            # their header, modified files are read again
+            with open(source.index_file) as f:
+                cached = json.load(f)
+            first, second = [os.path.relpath(path, directory)
+                             for path in paths[:2]]
+            cached[first][2] = cached[second][2] = "cached"
+            with open(source.index_file, "w") as f:
+                json.dump(cached, f)
+            os.utime(paths[1], (0, 0))
+            index = sources.LocalArchiveSource(directory, workers=1).index()
+            self.assertEqual(index[first][2], "cached")
+            self.assertEqual(index[second][2], metadata[1]["date_obs"])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_hmi_service_source(self):
+        class Session:
+            def get(self, url, params=None, timeout=None):
+                self.timeout = timeout
+                return self
+
+            def raise_for_status(self):
+                pass
+
+            def json(self):
+                return [{"url": "frame", "date_obs": "2014-01-01T00:00:00"}]
+
+        session = Session()
+        source = sources.HMIServiceSource("http://hmi")
+        self.assertEqual(source.metadata(self.t0, self.t1, session),
+                         session.json())
+        self.assertEqual(session.timeout, params.DOWNLOAD_TIMEOUT)
+
+    @unittest.skipIf(parallel.shared_memory is None,
+                     "parallel extraction requires Python 3.8+")
+    def test_parallel(self):
+        directory = tempfile.mkdtemp()
+        try:
+            metadata = []
+            for k, (time, content) in enumerate(
+                    synthetic.make_sequence(5, SIZE, REGIONS)):
+                path = os.path.join(directory, "frame%d.fits" % k)
+                with open(path, "wb") as f:
+                    f.write(content)
+                metadata.append({"url": path, "date_obs": time.isoformat()})
+
+            def output(results):
+                return [(i["date_obs"], features) for i, features in results]
+
+            serial = output(pipeline.extract_serial(metadata))
+            self.assertEqual(len(serial), 4)
+            self.assertEqual(output(parallel.extract_parallel(
+                metadata, processes=2, shard_frames=3)), serial)
+
+            # a URL listed twice does not shift the frames of later shards
+            repeated = metadata[:3] + [dict(metadata[3],
+                                            url=metadata[1]["url"])] + \
+                metadata[4:]
+            self.assertEqual(output(parallel.extract_parallel(
+                repeated, processes=2, shard_frames=3)),
+                output(pipeline.extract_serial(repeated)))
+
+            # a frame which could not be downloaded by the parent is
+            # downloaded again by the worker for the next pair
+            frames = [parallel.SharedFrame(HMIMagnetogram(i["url"]))
+                      for i in metadata[:3]]
+            try:
+                results, _ = parallel._process_shard(
+                    [(metadata[0], frames[0]), (metadata[1], None),
+                     (metadata[2], frames[2])])
+            finally:
+                for frame in frames:
+                    frame.release()
+            self.assertEqual(output(results), serial[1:2])
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(cutout_store.h5py is None, "h5py is not installed")
+    def test_cutout_store(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "cutouts_test.h5")
+            with cutout_store.CutoutWriter(path, batch_frames=2) as writer:
+                slim = feature_batch.features_from_hmi(
+                    self.mag_t1, self.contours, self.dt, self.mag_t0, False)
+                self.assertRaises(ValueError, writer.write, slim, self.mag_t1)
+                features = feature_batch.features_from_hmi(
+                    self.mag_t1, self.contours, self.dt, self.mag_t0,
+                    writer.feature_arrays)
+                self.assertFalse(features[0].has_array("cos_map"))
+                writer.write(features, self.mag_t1)
+                writer.write([], self.mag_t0)
+                writer.write(features[:1], self.mag_t1)
+            with cutout_store.CutoutStore(directory) as store:
+                self.assertEqual(len(store), len(features) + 1)
+                for feature in features:
+                    reference = SMARTFeature.from_hmi(
+                        self.mag_t1, feature.index, self.contours[
+                            feature.index], self.dt, self.mag_t0,
+                        keep_arrays=True)
+                    x, y, w, h = feature.get_shape()
+                    np.testing.assert_array_equal(
+                        store.read(self.mag_t1.time, feature.index, "data"),
+                        self.mag_t1.data[y:y + h, x:x + w])
+                    for name in ("mask", "phi_map", "psl_thin_mask"):
+                        np.testing.assert_array_equal(
+                            store.read(self.mag_t1.time, feature.index,
+                                       name),
+                            np.ma.filled(getattr(reference, name),
+                                         0).astype(cutout_store._DTYPES[name]))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_quicklook(self):
+        data = self.mag_t1.data.copy()
+        full = self.mag_t1.as_image()
+        np.testing.assert_array_equal(self.mag_t1.data, data)
+        # the gray levels of the original implementation
+        reference = np.clip(data, -2048, 2047) + 2048
+        reference *= self.mag_t1.data_mask
+        reference = np.right_shift(reference.astype(np.uint32), 4)
+        np.testing.assert_array_equal(full, reference.astype(np.uint8))
+
+        features = feature_batch.features_from_hmi(
+            self.mag_t1, self.contours, self.dt, self.mag_t0)
+        directory = tempfile.mkdtemp()
+        try:
+            path = quicklook.write(self.mag_t1, features, directory,
+                                   (256, 256))
+            image = cv2.imread(path)
+            self.assertEqual(image.shape, (256, 256, 3))
+            np.testing.assert_array_equal(self.mag_t1.data, data)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_metrics(self):
+        directory = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(directory, "metrics.jsonl")
+            prometheus_path = os.path.join(directory, "smart.prom")
+            metrics = instrumentation.Metrics(log_path, prometheus_path,
+                                              interval=3600)
+            stop = time.time() + 0.2
+
+            def spin():
+                while time.time() < stop:
+                    pass
+
+            with metrics.stage("rotate", "f1"):
+                # CPU time of another thread, like the OpenMP threads
+                worker = threading.Thread(target=spin)
+                worker.start()
+                worker.join()
+            with self.assertRaises(ValueError):
+                with metrics.stage("decode", "f1"):
+                    raise ValueError("broken frame")
+            metrics.count("features", 3, "f1")
+            try:
+                raise KeyError("url")
+            except KeyError:
+                trace = metrics.error("process", "f1")
+            self.assertIn("KeyError", trace)
+
+            # totals handed to another instance, e.g. from a worker
+            parent = instrumentation.Metrics()
+            parent.merge(metrics.take_totals())
+            self.assertEqual(metrics.take_totals()[0], {})
+            metrics.merge(parent.take_totals())
+            metrics.close()
+
+            with open(log_path) as f:
+                records = [json.loads(line) for line in f]
+            stages = dict((r["stage"], r) for r in records if "stage" in r)
+            self.assertGreater(stages["rotate"]["cpu"], 0.1)
+            self.assertFalse(stages["rotate"]["failed"])
+            self.assertTrue(stages["decode"]["failed"])
+            if instrumentation._status_memory("VmRSS") is not None:
+                self.assertGreater(stages["rotate"]["peak_memory"], 0)
+            self.assertIn({"counter": "features", "frame": "f1",
+                           "value": 3},
+                          [dict((k, r[k]) for k in ("counter", "frame",
+                                                     "value"))
+                           for r in records if "counter" in r])
+            errors = [r for r in records if "error" in r]
+            self.assertEqual(errors[0]["error"], "process")
+            self.assertEqual(errors[0]["traceback"], trace)
+
+            with open(prometheus_path) as f:
+                samples = dict((name, float(value)) for name, value in
+                               (line.split() for line in f
+                                if not line.startswith("#")))
+            self.assertEqual(
+                samples['smart_stage_calls_total{stage="rotate"}'], 1)
+            self.assertEqual(
+                samples['smart_stage_failures_total{stage="decode"}'], 1)
+            self.assertEqual(samples["smart_features_total"], 3)
+            self.assertEqual(samples['smart_errors_total{stage="process"}'],
+                             1)
+            self.assertIn("smart_peak_memory_bytes", samples)
+            self.assertEqual([name for name in os.listdir(directory)
+                              if name.endswith(".tmp")], [])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_null_metrics(self):
+        previous = instrumentation._metrics
+        try:
+            metrics = instrumentation.configure()
+            self.assertIsInstance(metrics, instrumentation.NullMetrics)
+            self.assertFalse(metrics.enabled)
+            self.assertIs(instrumentation.get(), metrics)
+            with metrics.stage("rotate", "f1") as stage:
+                self.assertIs(stage, metrics.stage("decode"))
+            metrics.count("features", 3, "f1")
+            try:
+                raise KeyError("url")
+            except KeyError:
+                self.assertIn("KeyError", metrics.error("process"))
+            self.assertIsNone(metrics.take_totals())
+            metrics.merge(None)
+            metrics.close()
+            self.assertTrue(instrumentation.configure(enabled=True).enabled)
+        finally:
+            instrumentation._metrics = previous
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,345 @@
+"""Feature tracking across frames. The contour of the last observation of every
+track is differentially rotated to the time of the new frame (forward, like
+native_rotation), the features of the new frame are looked up in a grid over
+heliographic longitude and latitude and scored by the overlap of their masks
+with the rotated mask. Features without overlap are linked by the distance
+of their centroids, if it is below params.TRACKING_MAX_DISTANCE.
+
+A feature overlapping several tracks is a merge: it continues the track it
+shares the most pixels with, the other tracks end. A track overlapping
+several features is a split: the feature sharing the most pixels continues
+the track, the others start new tracks. Tracks which were not seen for more
+than params.TRACKING_MAX_MISSED frames, or rotated behind the limb, end.
+Only the active tracks are kept, so the memory does not grow with the time
+range.
+
+Track IDs are the time of the first observation and the index of the
+feature in that frame, e.g. "20140101T000000_3", so they are the same when a
+time range is processed again. The active tracks are saved with the
+checkpoint (state() and restore()), so a resumed run continues them.
+
+Usage:
+  tracker = Tracker()
+  for time, features, center, radius in frames:
+      track_ids = tracker.update(time, [Observation.from_feature(f)
+                                        for f in features], center, radius)
+      tracker.events  # starts, splits, merges and ends of this frame
+"""
+import json
+
+import iso8601
+import numpy as np
+
+import cv2
+
+import params
+import rotation
+
+
+class Observation:
+    """The contour (pixels) of a feature on one frame. 'index' is the index
+    of the feature on its frame.
+    """
+
+    def __init__(self, contour, index=None):
+        self.contour = np.asarray(contour, np.int32).reshape(-1, 2)
+        self.index = index
+        self.box = cv2.boundingRect(self.contour)
+        self._mask = None
+
+    @classmethod
+    def from_feature(cls, feature):
+        """Observation of a SMARTFeature."""
+        o = cls(feature.contour, feature.index)
+        o.box = feature.get_shape()
+        return o
+
+    @classmethod
+    def from_json(cls, _dict):
+        """Observation of a feature in the JSON format of SMARTFeature, the
+        contour may be a list or a JSON string (property service).
+        """
+        contour = _dict["data"]["contour"]
+        if not isinstance(contour, list):
+            contour = json.loads(contour)
+        return cls(contour, _dict["data"]["index"])
+
+    def mask(self):
+        """The filled contour inside of 'box', uint8."""
+        if self._mask is None:
+            x, y, w, h = self.box
+            self._mask = np.zeros((h, w), np.uint8)
+            cv2.drawContours(self._mask, [self.contour - (x, y)], 0, 1, -1)
+        return self._mask
+
+    def area(self):
+        return int(np.count_nonzero(self.mask()))
+
+    def centroid(self):
+        """Centroid of the filled contour in pixels."""
+        moments = cv2.moments(self.contour)
+        if moments["m00"] == 0:
+            # degenerate contour (a line or a single pixel)
+            return tuple(self.contour.mean(axis=0))
+        return (moments["m10"] / moments["m00"],
+                moments["m01"] / moments["m00"])
+
+
+class Track:
+    def __init__(self, track_id, time, observation):
+        self.id = track_id
+        self.start = time
+        self.frames = 0
+        self.observe(time, observation)
+
+    def observe(self, time, observation):
+        self.time = time
+        self.observation = observation
+        self.frames += 1
+        self.missed = 0
+
+
+def _parse_time(value):
+    """Naive UTC datetime of an isoformat() string."""
+    return iso8601.parse_date(value).replace(tzinfo=None)
+
+
+def rotate_points(points, center, radius, dt):
+    """Moves the pixel positions 'points' (n x 2, x and y) to their position
+    after 'dt' seconds of differential rotation. Returns the new positions
+    (float64) and which points are still on the visible side, points behind
+    the limb are moved onto the limb.
+    """
+    x = points[:, 0] - center[0]
+    y = points[:, 1] - center[1]
+    sin_latitude = np.clip(y / float(radius), -1, 1)
+    angle = rotation.differential_angle(np.arcsin(sin_latitude), dt)
+    z = np.sqrt(np.maximum(radius * radius - x * x - y * y, 0))
+    cos_angle = np.cos(angle)
+    sin_angle = np.sin(angle)
+    rot_x = x * cos_angle - z * sin_angle
+    rot_z = x * sin_angle + z * cos_angle
+    visible = rot_z > 0
+    limb = np.sqrt(np.maximum(radius * radius - y * y, 0))
+    rot_x = np.where(visible, rot_x, np.copysign(limb, rot_x))
+    return np.stack([center[0] + rot_x, center[1] + y], axis=1), visible
+
+
+def heliographic(points, center, radius):
+    """Longitude and latitude (degrees) of the pixel positions 'points' on a
+    disk seen from the ecliptic (b0 = 0).
+    """
+    x = points[:, 0] - center[0]
+    y = points[:, 1] - center[1]
+    sin_latitude = np.clip(y / float(radius), -1, 1)
+    z = np.sqrt(np.maximum(radius * radius - x * x - y * y, 0))
+    return (np.rad2deg(np.arctan2(x, z)),
+            np.rad2deg(np.arcsin(sin_latitude)))
+
+
+class _Grid:
+    """Spatial index of observations over heliographic coordinates."""
+
+    def __init__(self, cell):
+        self.cell = cell
+        self.cells = {}
+
+    def _keys(self, longitude, latitude, margin):
+        lon0, lon1 = [int(np.floor(v / self.cell)) for v in
+                      (longitude.min() - margin, longitude.max() + margin)]
+        lat0, lat1 = [int(np.floor(v / self.cell)) for v in
+                      (latitude.min() - margin, latitude.max() + margin)]
+        return [(i, j) for i in range(lon0, lon1 + 1)
+                for j in range(lat0, lat1 + 1)]
+
+    def insert(self, item, longitude, latitude):
+        for key in self._keys(longitude, latitude, 0):
+            self.cells.setdefault(key, []).append(item)
+
+    def query(self, longitude, latitude, margin):
+        found = set()
+        for key in self._keys(longitude, latitude, margin):
+            found.update(self.cells.get(key, ()))
+        return found
+
+
+def _overlap(a, b):
+    """Number of pixels in both masks of the observations a and b."""
+    ax, ay, aw, ah = a.box
+    bx, by, bw, bh = b.box
+    x0, y0 = max(ax, bx), max(ay, by)
+    x1, y1 = min(ax + aw, bx + bw), min(ay + ah, by + bh)
+    if x0 >= x1 or y0 >= y1:
+        return 0
+    return int(np.count_nonzero(
+        a.mask()[y0 - ay:y1 - ay, x0 - ax:x1 - ax] &
+        b.mask()[y0 - by:y1 - by, x0 - bx:x1 - bx]))
+
+
+def _distance(a, b):
+    """Angular distance (degrees) of two (longitude, latitude) pairs."""
+    cos_latitude = np.cos(np.deg2rad((a[1] + b[1]) / 2))
+    return float(np.hypot((a[0] - b[0]) * cos_latitude, a[1] - b[1]))
+
+
+class Tracker:
+    """Links the features of consecutive frames to tracks, see the module
+    documentation. 'events' holds the events of the last update as dicts:
+      {"event": "start", "track": id}
+      {"event": "split", "track": new id, "parent": id}
+      {"event": "merge", "track": id, "into": id}
+      {"event": "end", "track": id, "reason": "missed" or "limb",
+       "start": time of the first observation, "frames": observations}
+    The defaults of the arguments are the params.TRACKING_* values.
+    """
+
+    def __init__(self, min_overlap=None, max_distance=None, max_missed=None,
+                 grid_cell=None):
+        self.min_overlap = params.TRACKING_MIN_OVERLAP \
+            if min_overlap is None else min_overlap
+        self.max_distance = params.TRACKING_MAX_DISTANCE \
+            if max_distance is None else max_distance
+        self.max_missed = params.TRACKING_MAX_MISSED if max_missed is None \
+            else max_missed
+        self.grid_cell = params.TRACKING_GRID_CELL if grid_cell is None \
+            else grid_cell
+        self.tracks = []
+        self.events = []
+
+    def update(self, time, observations, center, radius):
+        """Adds the observations of the frame at 'time' (datetime), 'center'
+        and 'radius' are the disk geometry of the frame in pixels. Returns
+        the track ID of every observation.
+        """
+        self.events = []
+        center = (float(center[0]), float(center[1]))
+        grid = _Grid(self.grid_cell)
+        positions = []
+        for k, observation in enumerate(observations):
+            grid.insert(k, *heliographic(observation.contour, center,
+                                         radius))
+            positions.append(self._position(observation.centroid(), center,
+                                            radius))
+
+        links = []
+        candidates = []
+        active = []
+        for track in self.tracks:
+            dt = (time - track.time).total_seconds()
+            contour, visible = rotate_points(
+                track.observation.contour.astype(np.float64), center, radius,
+                dt)
+            if not visible.any():
+                self._end(track, "limb")
+                continue
+            rotated = Observation(np.round(contour))
+            t = len(active)
+            active.append(track)
+            centroid, _ = rotate_points(
+                np.array([track.observation.centroid()]), center, radius, dt)
+            position = self._position(centroid[0], center, radius)
+            area = max(1, rotated.area())
+            for k in grid.query(*heliographic(rotated.contour, center, radius),
+                                margin=self.max_distance):
+                overlap = _overlap(rotated, observations[k])
+                if overlap > 0 and overlap >= self.min_overlap * min(
+                        area, max(1, observations[k].area())):
+                    links.append((overlap, t, k))
+                distance = _distance(position, positions[k])
+                if distance <= self.max_distance:
+                    candidates.append((distance, t, k))
+
+        track_of = [None] * len(observations)
+        matched = [False] * len(active)
+        # continuations, the largest overlaps first
+        links.sort(key=lambda link: -link[0])
+        for _, t, k in links:
+            if not matched[t] and track_of[k] is None:
+                matched[t] = True
+                track_of[k] = active[t]
+        # the remaining links are splits and merges
+        parents = {}
+        merged = set()
+        for _, t, k in links:
+            if track_of[k] is None and k not in parents:
+                parents[k] = active[t]
+            elif track_of[k] is not None and not matched[t] and \
+                    t not in merged:
+                merged.add(t)
+                self.events.append({"event": "merge", "track": active[t].id,
+                                    "into": track_of[k].id})
+        # small features without overlap
+        candidates.sort()
+        for _, t, k in candidates:
+            if not matched[t] and t not in merged and track_of[k] is None \
+                    and k not in parents:
+                matched[t] = True
+                track_of[k] = active[t]
+
+        self.tracks = []
+        for t, track in enumerate(active):
+            if t in merged:
+                continue
+            if not matched[t]:
+                track.missed += 1
+                if track.missed > self.max_missed:
+                    self._end(track, "missed")
+                    continue
+            self.tracks.append(track)
+
+        track_ids = []
+        for k, observation in enumerate(observations):
+            track = track_of[k]
+            if track is None:
+                index = k if observation.index is None else observation.index
+                track = Track("%s_%d" % (time.strftime("%Y%m%dT%H%M%S"),
+                                         index), time, observation)
+                self.tracks.append(track)
+                if k in parents:
+                    self.events.append({"event": "split", "track": track.id,
+                                        "parent": parents[k].id})
+                else:
+                    self.events.append({"event": "start", "track": track.id})
+            else:
+                track.observe(time, observation)
+            track_ids.append(track.id)
+        return track_ids
+
+    @staticmethod
+    def _position(point, center, radius):
+        longitude, latitude = heliographic(np.array([point], np.float64),
+                                           center, radius)
+        return longitude[0], latitude[0]
+
+    def state(self):
+        """The active tracks as a JSON string, see restore()."""
+        return json.dumps([{
+            "id": track.id,
+            "start": track.start.isoformat(),
+            "time": track.time.isoformat(),
+            "frames": track.frames,
+            "missed": track.missed,
+            "contour": track.observation.contour.tolist(),
+            "index": track.observation.index,
+            "box": [int(v) for v in track.observation.box]
+        } for track in self.tracks])
+
+    def restore(self, state):
+        """Replaces the active tracks by those of state() (e.g. of a
+        checkpoint).
+        """
+        self.tracks = []
+        for t in json.loads(state):
+            observation = Observation(t["contour"], t["index"])
+            observation.box = tuple(t["box"])
+            track = Track(t["id"], _parse_time(t["start"]), observation)
+            track.time = _parse_time(t["time"])
+            track.frames = t["frames"]
+            track.missed = t["missed"]
+            self.tracks.append(track)
+
+    def _end(self, track, reason):
+        self.events.append({"event": "end", "track": track.id,
+                            "reason": reason,
+                            "start": track.start.isoformat(),
+                            "frames": track.frames})